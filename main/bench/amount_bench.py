@@ -0,0 +1,96 @@
+"""
+Measures how fast and how accurately `AmountMatcher` matches transactions without an order nr to generated open
+orders.
+
+Usage: python -m main.bench.amount_bench [open orders] [transactions]
+
+"""
+import random
+import sys
+import time
+
+from main.bench import sandbox  # noqa, amount_matcher loads the models and thereby the database
+from main.importer.amount_matcher import AmountMatcher
+from main.importer.order_balances import OrderBalance
+
+FIRST_NAMES = ('Anna', 'Ben', 'Clara', 'David', 'Emma', 'Felix', 'Greta', 'Hannah', 'Jonas', 'Jörg', 'Lena', 'Leon',
+               'Lukas', 'Marie', 'Mia', 'Noah', 'Paul', 'Sophie', 'Tim', 'Zoe')
+# last names are combined from both lists, e.g. "Rosenberg"
+LAST_NAME_STARTS = ('Ahl', 'Berg', 'Brink', 'Eich', 'Feld', 'Gold', 'Grün', 'Hage', 'Hirsch', 'Kirch', 'Lind', 'Mühl',
+                    'Neu', 'Ober', 'Rosen', 'Schön', 'Stein', 'Wald', 'Weiß', 'Winter')
+LAST_NAME_ENDS = ('bach', 'berg', 'brunner', 'dorf', 'feld', 'hauser', 'hof', 'holz', 'horst', 'kamp', 'mann', 'meier',
+                  'müller', 'reuter', 'schmidt', 'stein', 'thal', 'wald', 'weber', 'wiese')
+PRICES = (1500, 1990, 2250, 2500, 2990, 3490, 3500, 3990, 4500)
+SHIPPING = 490
+THRESHOLD = 0.85
+
+
+def make_orders(n: int, rnd: random.Random):
+    orders = []
+    customers = []
+    for i in range(n):
+        if customers and rnd.random() < 0.3:
+            customer_id, name = rnd.choice(customers)
+        else:
+            name = f'{rnd.choice(FIRST_NAMES)} {rnd.choice(LAST_NAME_STARTS)}{rnd.choice(LAST_NAME_ENDS)}'
+            customer_id = len(customers)
+            customers.append((customer_id, name))
+        amount = sum(rnd.choice(PRICES) for _ in range(rnd.randint(1, 3))) + SHIPPING
+        orders.append(OrderBalance(i, f'ABI{10000 + i}', amount, 0, 0, customer_id, (name, name)))
+    return orders
+
+
+def payer_name(name: str, rnd: random.Random) -> str:
+    first, last = name.split()
+    return rnd.choice((name, f'{last.upper()}, {first.upper()}', f'{first} und Peter {last}', f'Frau {name}',
+                       f'Familie {last}', 'Erika Musterfrau'))
+
+
+def make_transactions(orders, n: int, rnd: random.Random):
+    """Yields a payer's name, the amount and the orders paid (None for amounts which match no orders)."""
+    by_customer = {}
+    for order in orders:
+        by_customer.setdefault(order.customer_id, []).append(order)
+    for _ in range(n):
+        kind = rnd.random()
+        order = rnd.choice(orders)
+        if kind < 0.7:
+            paid = [order]
+        elif kind < 0.9 and len(by_customer[order.customer_id]) > 1:
+            paid = rnd.sample(by_customer[order.customer_id], 2)
+        else:
+            yield payer_name(order.names[0], rnd), rnd.randint(100, 20000), None
+            continue
+        yield payer_name(order.names[0], rnd), sum(order.amount for order in paid), paid
+
+
+def run(n_orders=30000, n_transactions=5000):
+    rnd = random.Random(0)
+    orders = make_orders(n_orders, rnd)
+    transactions = list(make_transactions(orders, n_transactions, rnd))
+    start = time.perf_counter()
+    matcher = AmountMatcher(orders)
+    print(f'Index über {n_orders} offene Bestellungen in {time.perf_counter() - start:.2f} s erstellt')
+    counts = {'automatisch richtig': 0, 'automatisch falsch': 0, 'vorgeschlagen richtig': 0,
+              'vorgeschlagen falsch': 0, 'ohne Vorschlag': 0}
+    slowest = 0
+    start = time.perf_counter()
+    for name, amount, paid in transactions:
+        match_start = time.perf_counter()
+        match = matcher.match(name, amount)
+        slowest = max(slowest, time.perf_counter() - match_start)
+        if match is None:
+            counts['ohne Vorschlag'] += 1
+            continue
+        correct = paid is not None and {order.id for order in match.orders} == {order.id for order in paid}
+        stage = 'automatisch' if match.confidence >= THRESHOLD else 'vorgeschlagen'
+        counts[f'{stage} {"richtig" if correct else "falsch"}'] += 1
+    duration = time.perf_counter() - start
+    print(f'{n_transactions} Transaktionen in {duration:.2f} s ({duration / n_transactions * 1000:.2f} ms pro '
+          f'Transaktion, maximal {slowest * 1000:.1f} ms)')
+    print(', '.join(f'{count} {name}' for name, count in counts.items()))
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    run(int(args[0]) if args else 30000, int(args[1]) if len(args) > 1 else 5000)
@@ -0,0 +1,163 @@
+"""
+Differential test and benchmark of `associate_transactions`: the set-based engine must create exactly the
+associations, decrees and messages the former per-transaction loop over `associate_transaction` created (without
+matching transactions by their amount, which the former loop did not do).
+
+Usage: python -m main.bench.associate_bench [orders]
+
+A generated shop is bulk imported into a temporary database together with generated transactions. Both
+implementations run on copies of it.
+
+"""
+import contextlib
+import io
+import os
+import random
+import shutil
+import sys
+import time
+from datetime import date
+
+from sqlalchemy import event
+
+from main import conf
+from main.bench.sandbox import temp_dir
+from main.bench.bulk_bench import write_bulk_jsonl
+from main.bench.fake_shopify import make_orders, make_products
+from main.db import orm
+from main.db.orm import Order, OrderTransaction, Transaction, sess, update_schemas
+from main.importer import bulk_importer, transactions_importer
+from main.importer.order_nr_matcher import OrderNrMatcher
+from main.importer.transactions_importer import associate_transaction, get_order_nrs
+
+
+def legacy_associate_transactions():
+    """`associate_transactions` before the set-based engine: one query and one commit per transaction."""
+    transactions = sess.query(Transaction).filter(
+        Transaction.associated_completely == False,
+        Transaction.associate == True).all()
+    problematic_transactions = []
+    matcher = OrderNrMatcher.from_settings(known_nrs={nr for nr, in sess.query(Order.nr)})
+    for transaction in transactions:
+        nrs = get_order_nrs(transaction.reference, matcher)
+        orders = sess.query(Order).filter(Order.nr.in_(nrs)).all()
+        if len(orders) == len(nrs):
+            if len(orders) != 0:
+                associate_transaction(transaction, orders, False)
+                if transaction.unassociated_amount > 100:
+                    problematic_transactions += [transaction]
+            else:
+                problematic_transactions += [transaction]
+        else:
+            problematic_transactions += [transaction]
+    sess.commit()
+    return problematic_transactions
+
+
+def make_transactions(seed=0):
+    """
+    Pays (partially, completely, too much or twice) for orders, some of them already partially paid. Like
+    `import_transaction_file`, only incoming transactions are kept.
+
+    """
+    rnd = random.Random(seed)
+    orders = {nr: amount for nr, amount in sess.query(Order.nr, Order.amount)}
+    nrs = sorted(orders)
+    for nr in rnd.sample(nrs, len(nrs) // 10):
+        order = sess.query(Order).filter_by(nr=nr).one()
+        if rnd.random() < 0.5:
+            order.decree = rnd.randint(1, 300)
+        else:
+            transaction = Transaction(name='Alt', iban='DE00', reference=f'Vorkasse {nr}', amount=orders[nr] // 2,
+                                      date_=date(2021, 1, 1))
+            sess.add(transaction)
+            sess.add(OrderTransaction(order=order, transaction=transaction, amount=int(orders[nr] // 2)))
+    rows = []
+    for i, nr in enumerate(nrs):
+        amount = int(orders[nr])
+        reference = rnd.choice(('ABI{} Danke', 'ABI {}', 'AB/{}', 'Bestellung abi{}')).format(nr[3:])
+        kind = rnd.random()
+        if kind < 0.5:
+            pass
+        elif kind < 0.6:
+            amount -= rnd.randint(1, 100)
+        elif kind < 0.7:
+            amount -= rnd.randint(min(101, amount), amount)
+        elif kind < 0.8:
+            amount += rnd.randint(1, 500)
+        elif kind < 0.9 and i + 1 < len(nrs):
+            other = nrs[i + 1]
+            reference = f'{nr} und {other}'
+            # the second order may be paid partially, but the transaction stays incoming
+            amount += max(int(orders[other]) - rnd.choice((0, 0, 50, 5000)), 1 - amount)
+        elif kind < 0.95:
+            reference = rnd.choice(('Danke', 'ABI99999', 'Pulli Max'))
+        if amount <= 0:
+            continue
+        rows.append({'name': f'Kunde {i}', 'iban': f'DE{i:020d}', 'reference': reference, 'amount': amount,
+                     'date_': date(2021, 2, 1), 'associate': rnd.random() > 0.02})
+        if rnd.random() < 0.05:
+            # paid twice
+            rows.append(dict(rows[-1], date_=date(2021, 2, 2)))
+    sess.execute(Transaction.__table__.insert(), rows)
+    sess.commit()
+
+
+def snapshot():
+    return (sorted(sess.query(OrderTransaction.order_id, OrderTransaction.transaction_id, OrderTransaction.amount)),
+            sorted(sess.query(Order.id, Order.decree)))
+
+
+def run_implementation(associate, db_backup: str):
+    sess.close()
+    orm.engine.dispose()
+    shutil.copy(db_backup, conf.paths['sqlite'])
+    statements = [0]
+
+    def count_statement(*args):
+        statements[0] += 1
+
+    event.listen(orm.engine, 'before_cursor_execute', count_statement)
+    output = io.StringIO()
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(output):
+        problematic = associate()
+    duration = time.perf_counter() - start
+    event.remove(orm.engine, 'before_cursor_execute', count_statement)
+    return duration, statements[0], sorted(transaction.id for transaction in problematic), output.getvalue(), \
+        snapshot()
+
+
+def run(n_orders=2000):
+    update_schemas()
+    jsonl_path = os.path.join(temp_dir, 'bulk.jsonl')
+    products = make_products(100)
+    write_bulk_jsonl(jsonl_path, products, make_orders(n_orders, products))
+    with contextlib.redirect_stdout(io.StringIO()):
+        bulk_importer.import_file(jsonl_path)
+    make_transactions()
+    db_backup = os.path.join(temp_dir, 'backup.sqlite')
+    sess.close()
+    orm.engine.dispose()
+    shutil.copy(conf.paths['sqlite'], db_backup)
+
+    results = {}
+    implementations = {'associate_transaction je Transaktion': legacy_associate_transactions,
+                       'Mengenbasiert': lambda: transactions_importer.associate_transactions(match_amounts=False)[0]}
+    for name, associate in implementations.items():
+        duration, n_statements, problematic, output, state = run_implementation(associate, db_backup)
+        results[name] = (problematic, output, state)
+        print(f'{name}: {len(state[0])} Zuweisungen in {duration:.2f} s mit {n_statements} SQL-Anweisungen, '
+              f'{len(problematic)} Transaktionen für die manuelle Zuweisung')
+    (legacy_problematic, legacy_output, legacy_state), (problematic, output, state) = results.values()
+    checks = {'Zuweisungen': legacy_state[0] == state[0], 'Erlasse': legacy_state[1] == state[1],
+              'Manuell zuzuweisende Transaktionen': legacy_problematic == problematic,
+              'Ausgaben': legacy_output == output}
+    for check, equal in checks.items():
+        print(f'{check}: {"identisch" if equal else "ABWEICHEND"}')
+    if not all(checks.values()):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 2000)
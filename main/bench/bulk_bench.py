@@ -0,0 +1,113 @@
+"""
+Times the bulk import (see `bulk_importer`) of a generated JSONL export into a temporary database.
+
+Usage: python -m main.bench.bulk_bench [orders] [JSONL file]
+
+Without a file, a bulk export of a generated shop is written to a temporary directory first.
+
+"""
+import json
+import os
+import sys
+import time
+import tracemalloc
+from typing import List, Optional
+
+from main.bench.sandbox import temp_dir
+from main.bench.fake_shopify import make_orders, make_products
+from main.db.orm import update_schemas, Order, LineItem
+from main.db.sqlalchemy_utils import count
+from main.importer import bulk_importer
+
+
+def gid(type_: str, id_) -> str:
+    return f'gid://shopify/{type_}/{id_}'
+
+
+def money(amount: str) -> dict:
+    return {'shopMoney': {'amount': amount, 'currencyCode': 'EUR'}}
+
+
+def bulk_address(address: Optional[dict]) -> Optional[dict]:
+    if address is None:
+        return None
+    return {'firstName': address['first_name'], 'lastName': address['last_name'], 'address1': address['address1'],
+            'address2': address['address2'], 'city': address['city'], 'zip': address['zip']}
+
+
+def remove_addresses(orders: List[dict]) -> int:
+    """
+    Removes the billing address of every 50th order, which the importer replaces with the shipping address, and both
+    addresses of every 500th order, which cannot be imported then.
+
+    Returns:
+        The number of orders without any address.
+    """
+    for i, order in enumerate(orders):
+        if i % 50 == 25:
+            order['billing_address'] = None
+            if i % 500 == 25:
+                order['shipping_address'] = None
+    return sum(1 for order in orders if order['billing_address'] is None and order.get('shipping_address') is None)
+
+
+def write_bulk_jsonl(path: str, products: List[dict], orders: List[dict]):
+    """Writes `products` and `orders` (in the format of the REST API) as the JSONL file of a bulk operation."""
+    with open(path, 'w', encoding='utf-8') as f:
+        def write(node):
+            f.write(json.dumps(node) + '\n')
+
+        for product in products:
+            product_gid = gid('Product', product['id'])
+            write({'id': product_gid, 'title': product['title'], 'productType': product['product_type'],
+                   'createdAt': product['created_at'], 'updatedAt': product['updated_at'],
+                   'tags': product['tags'].split(', '), 'status': product['status'].upper()})
+            for variant in product['variants']:
+                write({'id': gid('ProductVariant', variant['id']), '__parentId': product_gid,
+                       'selectedOptions': [{'name': 'Größe', 'value': variant['option1']},
+                                           {'name': 'Farbe', 'value': variant['option2']}]})
+        for order in orders:
+            order_gid = gid('Order', order['id'])
+            customer = order['customer']
+            write({'id': order_gid, 'name': order['name'], 'createdAt': order['created_at'],
+                   'updatedAt': order['updated_at'], 'cancelledAt': order['cancelled_at'],
+                   'totalDiscountsSet': money(order['total_discounts']),
+                   'totalShippingPriceSet': money(order['total_shipping_price_set']['shop_money']['amount']),
+                   'tags': [tag for tag in order['tags'].split(', ') if tag], 'note': order['note'],
+                   'billingAddress': bulk_address(order['billing_address']),
+                   'shippingAddress': bulk_address(order.get('shipping_address')),
+                   'customer': {'id': gid('Customer', customer['id']), 'email': customer['email'],
+                                'firstName': customer['first_name'], 'lastName': customer['last_name']}})
+            for i, line_item in enumerate(order['line_items']):
+                write({'id': gid('LineItem', order['id'] * 10 + i), '__parentId': order_gid,
+                       'title': line_item['title'], 'quantity': line_item['quantity'],
+                       'originalUnitPriceSet': money(line_item['price']),
+                       'product': {'id': gid('Product', line_item['product_id'])},
+                       'variant': {'id': gid('ProductVariant', line_item['variant_id'])}})
+
+
+def run(path: str):
+    update_schemas()
+    tracemalloc.start()
+    start = time.perf_counter()
+    bulk_importer.import_file(path)
+    duration = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    n_orders = count(Order)
+    print(f'{n_orders} Bestellungen mit {count(LineItem)} Positionen in {duration:.2f} s '
+          f'({n_orders / duration:.0f} Bestellungen/s) importiert.')
+    print(f'Datei: {os.path.getsize(path) / 2 ** 20:.1f} MiB, maximaler Speicherbedarf: {peak / 2 ** 20:.1f} MiB')
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    if len(args) > 1:
+        jsonl_path = args[1]
+    else:
+        jsonl_path = os.path.join(temp_dir, 'bulk.jsonl')
+        shop_products = make_products(300)
+        shop_orders = make_orders(int(args[0]) if args else 5000, shop_products)
+        print(f'{remove_addresses(shop_orders)} Bestellungen ohne Adresse werden nicht importiert.')
+        write_bulk_jsonl(jsonl_path, shop_products, shop_orders)
+    run(jsonl_path)
@@ -0,0 +1,143 @@
+"""
+Compares the set-oriented helpers of `sqlalchemy_utils` (`get_many`, `get_or_create_many`, `upsert` and `count`)
+with the per-row helpers and ORM code they replace, on a generated shop in a temporary database.
+
+Usage: python -m main.bench.data_access_bench [orders]
+
+Each pair of implementations must give the same result. Changes are rolled back after each run.
+
+"""
+import contextlib
+import io
+import os
+import random
+import sys
+import time
+from datetime import date, timedelta
+
+from sqlalchemy import event
+
+from main.bench.sandbox import temp_dir
+from main.bench.bulk_bench import write_bulk_jsonl
+from main.bench.fake_shopify import make_orders, make_products
+from main.db import orm
+from main.db.orm import Customer, LineItem, Order, Payer, School, Transaction, sess, update_schemas
+from main.db.sqlalchemy_utils import count, get, get_many, get_or_create, get_or_create_many, upsert
+from main.importer import bulk_importer
+from main.importer.transactions_importer import TRANSACTION_KEY
+
+
+def per_row_count(model) -> int:
+    """`count` before it counted with SQL."""
+    return len(sess.query(model).all())
+
+
+def per_row_get(nrs):
+    orders = {nr: get(Order, nr=nr) for nr in nrs}
+    return {nr: order for nr, order in orders.items() if order is not None}
+
+
+def per_row_get_or_create(names):
+    return {name: get_or_create(School, name=name) for name in names}
+
+
+def per_row_payments(payments):
+    """Counts payments like `payer_index.save_payments` would with the ORM."""
+    for (key, customer_id), n in payments.items():
+        payer = get(Payer, key=key, customer_id=customer_id)
+        if payer is None:
+            payer = Payer(key=key, customer_id=customer_id, payments=0)
+            sess.add(payer)
+        payer.payments += n
+    sess.flush()
+    return len(payments)
+
+
+def upsert_payments(payments):
+    return upsert(Payer, [{'key': key, 'customer_id': customer_id, 'payments': n}
+                          for (key, customer_id), n in payments.items()],
+                  ('key', 'customer_id'), {'payments': 'payments + excluded.payments'})
+
+
+def per_row_transactions(rows):
+    """Inserts the transactions which do not exist yet, one lookup per row."""
+    inserted = 0
+    for row in rows:
+        if get(Transaction, **{column: row[column] for column in TRANSACTION_KEY}) is None:
+            sess.add(Transaction(**row))
+            sess.flush()
+            inserted += 1
+    return inserted
+
+
+def measure(run, *args):
+    statements = [0]
+
+    def count_statement(*_):
+        statements[0] += 1
+
+    event.listen(orm.engine, 'before_cursor_execute', count_statement)
+    start = time.perf_counter()
+    result = run(*args)
+    duration = time.perf_counter() - start
+    event.remove(orm.engine, 'before_cursor_execute', count_statement)
+    return result, duration, statements[0]
+
+
+def payer_state():
+    return sorted(sess.query(Payer.key, Payer.customer_id, Payer.payments))
+
+
+def run(n_orders=5000):
+    update_schemas()
+    jsonl_path = os.path.join(temp_dir, 'bulk.jsonl')
+    products = make_products(100)
+    write_bulk_jsonl(jsonl_path, products, make_orders(n_orders, products))
+    with contextlib.redirect_stdout(io.StringIO()):
+        bulk_importer.import_file(jsonl_path)
+    rnd = random.Random(0)
+    nrs = [nr for nr, in sess.query(Order.nr)]
+    lookup_nrs = rnd.sample(nrs, len(nrs) // 2) + [f'ABI{n}' for n in range(90000, 90100)]
+    school_names = [name for name, in sess.query(School.name)] + [f'Neue Schule {i}' for i in range(200)]
+    customer_ids = [id_ for id_, in sess.query(Customer.id)]
+    payments = {(f'DE{rnd.randrange(10 ** 6):020d}', rnd.choice(customer_ids)): rnd.randint(1, 3)
+                for _ in range(2000)}
+    sess.execute(Payer.__table__.insert(), [{'key': key, 'customer_id': customer_id, 'payments': 1}
+                                            for key, customer_id in list(payments)[:1000]])
+    sess.commit()
+    transactions = [{'name': f'Kunde {i}', 'iban': f'DE{i:020d}', 'reference': f'ABI{1000 + i}', 'amount': 1000 + i,
+                     'date_': date(2021, 1, 1) + timedelta(days=i % 300)} for i in range(3000)]
+    sess.execute(Transaction.__table__.insert(), transactions[:1000])
+    sess.commit()
+
+    comparisons = [
+        ('count(Order)', (per_row_count, Order), (count, Order), None),
+        ('count(LineItem)', (per_row_count, LineItem), (count, LineItem), None),
+        (f'{len(lookup_nrs)} Bestellungen nach Nummer', (per_row_get, lookup_nrs),
+         (get_many, Order, 'nr', lookup_nrs), lambda result: sorted(result)),
+        (f'{len(school_names)} Schulen holen oder anlegen', (per_row_get_or_create, school_names),
+         (get_or_create_many, School, 'name', school_names), lambda result: sorted(result)),
+        (f'{len(payments)} Zahlungen zählen', (per_row_payments, payments), (upsert_payments, payments),
+         lambda result: payer_state()),
+        (f'{len(transactions)} Transaktionen einfügen, falls neu', (per_row_transactions, transactions),
+         (upsert, Transaction, transactions, TRANSACTION_KEY), None),
+    ]
+    failures = 0
+    for description, (per_row, *per_row_args), (set_based, *set_based_args), state in comparisons:
+        results = []
+        for implementation, args in ((per_row, per_row_args), (set_based, set_based_args)):
+            result, duration, n_statements = measure(implementation, *args)
+            results.append((state(result) if state else result, duration, n_statements))
+            sess.rollback()
+        (per_row_result, per_row_duration, per_row_statements), (result, duration, n_statements) = results
+        equal = per_row_result == result
+        failures += not equal
+        print(f'{description}: zeilenweise {per_row_duration * 1000:.1f} ms mit {per_row_statements} SQL-Anweisungen, '
+              f'mengenbasiert {duration * 1000:.1f} ms mit {n_statements} '
+              f'({per_row_duration / duration:.0f}x), Ergebnisse {"identisch" if equal else "ABWEICHEND"}')
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 5000)
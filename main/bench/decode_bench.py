@@ -0,0 +1,90 @@
+"""
+Compares decoding recorded Shopify pages (see `PageCache`) into `shopify.Product` and `shopify.Order` objects with
+decoding them into the records of `shopify_records`.
+
+Usage: python -m main.bench.decode_bench [page cache directory]
+
+Without a directory, the pages of a generated shop are recorded from the fake Shopify server first.
+
+"""
+import glob
+import gzip
+import json
+import os
+import sys
+import time
+import tracemalloc
+import urllib.parse
+from typing import Callable, Dict, List, Tuple
+
+import shopify
+
+from main.bench.import_bench import record
+from main.bench.sandbox import temp_dir
+from main.importer.shopify_records import decode_cancelled_order, decode_order, decode_product
+
+DECODERS = {'ActiveResource': {'products': shopify.Product, 'orders': shopify.Order,
+                               'cancelled_orders': shopify.Order},
+            'Records': {'products': decode_product, 'orders': decode_order,
+                        'cancelled_orders': decode_cancelled_order}}
+
+
+def page_kind(url: str) -> str:
+    """The decoder of a page: cancelled orders are requested with fewer fields than the other orders."""
+    parts = urllib.parse.urlsplit(url)
+    resource = parts.path.rsplit('/', 1)[-1].split('.')[0]
+    if resource == 'orders' and dict(urllib.parse.parse_qsl(parts.query)).get('status') == 'cancelled':
+        return 'cancelled_orders'
+    return resource
+
+
+def load_pages(directory: str) -> List[Tuple[str, Dict[str, List[dict]]]]:
+    """Returns the kind of each page (see `page_kind`) with its resources."""
+    pages = []
+    for path in glob.glob(os.path.join(directory, '*.json.gz')):
+        with gzip.open(path, 'rb') as f:
+            header, _, body = f.read().partition(b'\n')
+        pages.append((page_kind(json.loads(header.decode('utf-8'))['url']), json.loads(body.decode('utf-8'))))
+    return pages
+
+
+def decode_pages(pages: List[Tuple[str, Dict[str, List[dict]]]], decoders: Dict[str, Callable]) -> (float, int):
+    """
+    Returns:
+        The time it took to decode all pages and the peak memory used by one decoded page. Both are measured in
+        separate passes, since tracing the allocations slows the decoding down.
+    """
+    def decode(kind_and_page):
+        kind, page = kind_and_page
+        return [decoders[kind](attributes) for resources in page.values() for attributes in resources]
+
+    start = time.perf_counter()
+    for page in pages:
+        decode(page)
+    duration = time.perf_counter() - start
+    peak = 0
+    for page in pages:
+        tracemalloc.start()
+        decode(page)
+        peak = max(peak, tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+    return duration, peak
+
+
+def run(directory: str):
+    pages = load_pages(directory)
+    n_resources = sum(len(resources) for _, page in pages for resources in page.values())
+    print(f'{len(pages)} Seiten mit {n_resources} Produkten und Bestellungen')
+    for name, decoders in DECODERS.items():
+        duration, peak = decode_pages(pages, decoders)
+        print(f'{name}: {duration:.2f} s ({duration / len(pages) * 1000:.1f} ms pro Seite), '
+              f'maximal {peak / 2 ** 20:.2f} MiB pro Seite')
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        page_cache_dir = sys.argv[1]
+    else:
+        page_cache_dir = os.path.join(temp_dir, 'page_cache')
+        record(page_cache_dir)
+    run(page_cache_dir)
@@ -0,0 +1,225 @@
+import datetime
+import gzip
+import json
+import random
+import threading
+import time
+import urllib.parse
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from typing import Dict, List
+
+from main import utils
+from main.conf import paths
+from main.importer.shopify_fetcher import CALL_LIMIT_HEADER, RETRY_AFTER_HEADER
+
+API_PREFIX = '/admin/api/2020-10'
+# the sizes and colors the importer knows, sorted so the generated shops do not depend on the order of a set
+SIZES = sorted(utils.import_list(f'{paths["resources"]}/sizes.list'))
+COLORS = sorted(utils.import_list(f'{paths["resources"]}/colors.list'))
+
+
+def to_datetime(date_str: str) -> datetime.datetime:
+    timestamp = datetime.datetime.fromisoformat(date_str.replace('Z', '+00:00'))
+    return timestamp if timestamp.tzinfo else timestamp.replace(tzinfo=datetime.timezone.utc)
+
+
+def make_products(n: int, seed=0) -> List[dict]:
+    rand = random.Random(seed)
+    products = []
+    for i in range(n):
+        product_id = 1000 + i
+        options = [(size, color) for size in rand.sample(SIZES, rand.randint(2, 4))
+                   for color in rand.sample(COLORS, rand.randint(1, 3))]
+        variants = [{'id': product_id * 100 + j, 'product_id': product_id, 'option1': size, 'option2': color}
+                    for j, (size, color) in enumerate(options)]
+        products.append({'id': product_id, 'title': f'Produkt {i}', 'product_type': 'Shirt',
+                         'created_at': '2021-01-01T12:00:00+01:00', 'updated_at': '2021-01-02T12:00:00+01:00',
+                         'tags': f'Schule {i % 7}', 'status': 'active' if i % 10 else 'archived',
+                         'variants': variants, **unused_product_fields(product_id)})
+    return products
+
+
+def make_orders(n: int, products: List[dict], seed=0) -> List[dict]:
+    rand = random.Random(seed)
+    orders = []
+    for i in range(n):
+        customer_id = 5000 + i % max(1, n // 3)
+        address = {'first_name': f'Vorname{customer_id}', 'last_name': f'Nachname{customer_id}',
+                   'address1': f'Straße {customer_id % 90}', 'address2': '', 'city': 'Berlin', 'zip': '10115'}
+        line_items = []
+        for product in rand.sample(products, min(len(products), rand.randint(1, 3))):
+            variant = rand.choice(product['variants'])
+            line_items.append({'product_id': product['id'], 'variant_id': variant['id'], 'title': product['title'],
+                               'quantity': rand.randint(1, 2), 'price': f'{rand.randint(10, 40)}.00'})
+        orders.append({'id': 9000 + i, 'name': f'ABI{1000 + i}', 'created_at': '2021-02-01T12:00:00+01:00',
+                       'updated_at': '2021-02-02T12:00:00+01:00', 'total_discounts': '0.00',
+                       'total_shipping_price_set': {'shop_money': {'amount': '4.90', 'currency_code': 'EUR'}},
+                       'tags': '', 'note': None, 'cancelled_at': '2021-02-03T12:00:00+01:00' if i % 20 == 0 else None,
+                       'billing_address': address,
+                       'customer': {'id': customer_id, 'email': f'kunde{customer_id}@example.com',
+                                    'first_name': address['first_name'], 'last_name': address['last_name']},
+                       'line_items': line_items, **unused_order_fields(9000 + i, address)})
+    return orders
+
+
+def unused_product_fields(product_id: int) -> dict:
+    """Some of the fields a real shop sends, but the importer does not read."""
+    return {'body_html': '<p>Bio-Baumwolle, fair produziert, bedruckt mit dem Motto des Jahrgangs.</p>' * 4,
+            'handle': f'produkt-{product_id}', 'vendor': 'Abi-Shop', 'published_scope': 'web',
+            'options': [{'id': product_id * 10 + j, 'product_id': product_id, 'name': name, 'position': j + 1}
+                        for j, name in enumerate(('Größe', 'Farbe'))],
+            'images': [{'id': product_id * 10 + j, 'product_id': product_id, 'position': j + 1, 'width': 1200,
+                        'height': 1200, 'src': f'https://cdn.shopify.com/s/files/1/0000/products/{product_id}_{j}.jpg'}
+                       for j in range(3)]}
+
+
+def unused_order_fields(order_id: int, address: dict) -> dict:
+    return {'email': f'kunde{order_id}@example.com', 'currency': 'EUR', 'financial_status': 'pending',
+            'fulfillment_status': None, 'gateway': 'Überweisung', 'shipping_address': dict(address),
+            'client_details': {'browser_ip': '192.0.2.1', 'user_agent': 'Mozilla/5.0 (X11; Linux x86_64)'},
+            'tax_lines': [{'price': '3.19', 'rate': 0.19, 'title': 'MwSt'}],
+            'shipping_lines': [{'id': order_id, 'title': 'Versand', 'price': '4.90', 'code': 'Standard'}],
+            'fulfillments': [], 'refunds': [], 'note_attributes': []}
+
+
+class FakeShopify:
+    """
+    A local stand-in for the Shopify REST Admin API, used to benchmark the importer without network access.
+
+    It serves "products.json" and "orders.json" with cursor based pagination, answers with the
+    "X-Shopify-Shop-Api-Call-Limit" header and responds with 429 once its leaky bucket overflows. Like Shopify, it
+    supports the "fields" parameter, gzip compression and keep-alive connections, and it counts the connections
+    opened as well as the bytes sent (before and after compression).
+
+    """
+
+    def __init__(self, products: List[dict], orders: List[dict], latency=0.0, bucket_size=40, leak_rate=2.0):
+        self.resources = {'products': products, 'orders': orders}
+        self.latency = latency
+        self.bucket_size = bucket_size
+        self.leak_rate = leak_rate
+        self.requests = 0
+        self.throttled = 0
+        self.connections = 0
+        self.bytes_sent = 0
+        self.uncompressed_bytes = 0
+        self._bucket = 0.0
+        self._bucket_updated_at = time.monotonic()
+        self._lock = threading.Lock()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self._handler_class())
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def site(self) -> str:
+        return f'http://127.0.0.1:{self.server.server_address[1]}{API_PREFIX}'
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _take_call(self):
+        with self._lock:
+            self.requests += 1
+            now = time.monotonic()
+            self._bucket = max(0.0, self._bucket - (now - self._bucket_updated_at) * self.leak_rate)
+            self._bucket_updated_at = now
+            if self._bucket + 1 > self.bucket_size:
+                self.throttled += 1
+                return None
+            self._bucket += 1
+            return int(self._bucket)
+
+    def select(self, resource: str, params: Dict[str, str]) -> List[dict]:
+        status = params.get('status')
+        items = self.resources[resource]
+        if 'updated_at_min' in params:
+            updated_at_min = to_datetime(params['updated_at_min'])
+            items = [item for item in items if to_datetime(item['updated_at']) >= updated_at_min]
+        if resource == 'products':
+            return [item for item in items if item['status'] == (status or 'active')]
+        if status == 'cancelled':
+            return [item for item in items if item['cancelled_at']]
+        return [item for item in items if not item['cancelled_at']]
+
+    def page(self, resource: str, query: Dict[str, str]) -> (bytes, str):
+        limit = int(query.get('limit', 50))
+        if 'page_info' in query:
+            cursor = json.loads(query['page_info'])
+            params, offset = cursor['params'], cursor['offset']
+        else:
+            params, offset = {k: v for k, v in query.items() if k not in ('limit', 'fields')}, 0
+        items = self.select(resource, params)
+        page = items[offset:offset + limit]
+        if 'fields' in query:
+            fields = query['fields'].split(',')
+            page = [{field: item[field] for field in fields if field in item} for item in page]
+        body = json.dumps({resource: page}).encode('utf-8')
+        link = None
+        if offset + limit < len(items):
+            page_info = urllib.parse.quote(json.dumps({'params': params, 'offset': offset + limit}))
+            link = f'<{self.site}/{resource}.json?limit={limit}&page_info={page_info}>; rel="next"'
+        return body, link
+
+    def _handler_class(self):
+        shop = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def setup(self):
+                super().setup()
+                with shop._lock:
+                    shop.connections += 1
+
+            def do_GET(self):
+                if shop.latency:
+                    time.sleep(shop.latency)
+                used = shop._take_call()
+                if used is None:
+                    self.send_response(429)
+                    self.send_header(RETRY_AFTER_HEADER, str(1 / shop.leak_rate))
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                url = urllib.parse.urlparse(self.path)
+                resource = url.path[len(API_PREFIX) + 1:-len('.json')]
+                if resource not in shop.resources:
+                    self.send_error(404)
+                    return
+                query = dict(urllib.parse.parse_qsl(url.query))
+                body, link = shop.page(resource, query)
+                uncompressed_size = len(body)
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                if 'gzip' in self.headers.get('Accept-Encoding', ''):
+                    body = gzip.compress(body, compresslevel=5)
+                    self.send_header('Content-Encoding', 'gzip')
+                self.send_header('Content-Length', str(len(body)))
+                with shop._lock:
+                    shop.bytes_sent += len(body)
+                    shop.uncompressed_bytes += uncompressed_size
+                self.send_header(CALL_LIMIT_HEADER, f'{used}/{shop.bucket_size}')
+                if link:
+                    self.send_header('Link', link)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+
+def serve(n_products=100, n_orders=1000, latency=0.0, **kwargs) -> FakeShopify:
+    products = make_products(n_products)
+    return FakeShopify(products, make_orders(n_orders, products), latency=latency, **kwargs)
+
+
+if __name__ == '__main__':
+    with serve(latency=0.05) as shop:
+        print(f'Fake-Shopify läuft auf {shop.site}')
+        input('Beenden mit Enter.')
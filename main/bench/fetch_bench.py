@@ -0,0 +1,47 @@
+"""
+Measures the download throughput of `ShopifyFetcher` against a local fake Shopify server, with and without requesting
+only the fields the importer reads.
+
+Usage: python -m main.bench.fetch_bench [orders] [latency in seconds]
+
+"""
+import sys
+import time
+
+from main.bench import sandbox  # noqa, the fetcher logs retries
+from main.bench.fake_shopify import serve
+from main.importer.shopify_fetcher import ShopifyFetcher
+from main.importer.shopify_records import PRODUCT_FIELDS, ORDER_FIELDS, CANCELLED_ORDER_FIELDS
+
+STREAMS = {'active_products': ('products', {'status': 'active'}),
+           'archived_products': ('products', {'status': 'archived'}),
+           'orders': ('orders', {}),
+           'cancelled_orders': ('orders', {'status': 'cancelled'})}
+FIELDS = {'active_products': PRODUCT_FIELDS, 'archived_products': PRODUCT_FIELDS, 'orders': ORDER_FIELDS,
+          'cancelled_orders': CANCELLED_ORDER_FIELDS}
+PROJECTED_STREAMS = {name: (resource, dict(params, fields=','.join(FIELDS[name])))
+                     for name, (resource, params) in STREAMS.items()}
+
+
+CONFIGURATIONS = (('1 Worker, alle Felder', 1, STREAMS),
+                  (f'{len(STREAMS)} Worker, alle Felder', len(STREAMS), STREAMS),
+                  (f'{len(STREAMS)} Worker, benötigte Felder', len(STREAMS), PROJECTED_STREAMS))
+
+
+def run(n_orders=5000, latency=0.05):
+    for description, workers, streams in CONFIGURATIONS:
+        # a new shop for every configuration, so the rate limit does not carry over
+        with serve(n_products=500, n_orders=n_orders, latency=latency) as shop:
+            start = time.perf_counter()
+            resources = ShopifyFetcher(shop.site, 'token', workers=workers).fetch_all(streams)
+            duration = time.perf_counter() - start
+            n_resources = sum(map(len, resources.values()))
+            print(f'{description}: {n_resources} Ressourcen in {duration:.2f} s ({n_resources / duration:.0f} '
+                  f'Ressourcen/s), {shop.requests} Anfragen über {shop.connections} Verbindungen, '
+                  f'{shop.bytes_sent / 2 ** 20:.2f} MiB übertragen ({shop.uncompressed_bytes / 2 ** 20:.2f} MiB '
+                  f'unkomprimiert), {shop.throttled} vom Server gedrosselt (429)')
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    run(int(args[0]) if args else 5000, float(args[1]) if len(args) > 1 else 0.05)
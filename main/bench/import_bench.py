@@ -0,0 +1,58 @@
+"""
+Times the import of products and orders from recorded Shopify pages (see `PageCache`) into a temporary database.
+
+Usage: python -m main.bench.import_bench [page cache directory]
+
+Without a directory, the pages of a generated shop are recorded from the fake Shopify server first.
+
+"""
+import os
+import sys
+import time
+
+from main import conf
+from main.bench.sandbox import temp_dir
+from main.bench.fake_shopify import serve
+from main.db.orm import update_schemas
+from main.db.sqlalchemy_utils import ImportCache
+from main.importer import shopify_importer
+from main.importer.page_cache import PageCache, RECORD, REPLAY
+from main.importer.shopify_fetcher import ShopifyFetcher
+
+
+def get_streams():
+    return {name: (resource, dict(params, updated_at_min=conf.update_after))
+            for name, (resource, params) in shopify_importer.STREAMS.items()}
+
+
+def record(directory: str, n_orders=5000):
+    with serve(n_products=300, n_orders=n_orders) as shop:
+        ShopifyFetcher(shop.site, 'token', page_cache=PageCache(directory), page_cache_mode=RECORD) \
+            .fetch_all(get_streams())
+
+
+def run(directory: str):
+    update_schemas()
+    fetcher = ShopifyFetcher('http://replay', '', page_cache=PageCache(directory), page_cache_mode=REPLAY)
+    streams = fetcher.stream_all(get_streams())
+    phases = [('Produkte', shopify_importer.import_products, shopify_importer.ACTIVE_PRODUCTS),
+              ('Archivierte Produkte', shopify_importer.archive_products, shopify_importer.ARCHIVED_PRODUCTS),
+              ('Bestellungen', shopify_importer.import_orders, shopify_importer.ORDERS)]
+    timings = []
+    with ImportCache() as cache:
+        for description, import_, stream in phases:
+            start = time.perf_counter()
+            import_(streams[stream], cache)
+            timings.append((description, time.perf_counter() - start))
+    for description, duration in timings:
+        print(f'{description}: {duration:.2f} s')
+    print(f'Cache: {cache}')
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        page_cache_dir = sys.argv[1]
+    else:
+        page_cache_dir = os.path.join(temp_dir, 'page_cache')
+        record(page_cache_dir)
+    run(page_cache_dir)
@@ -0,0 +1,179 @@
+"""
+Checks with the query plans of SQLite that the lookups of the importers and the queries of `queries.sql` use indexes,
+and times them with and without the indexes of the models.
+
+Usage: python -m main.bench.query_plan_bench [orders]
+
+A generated shop is bulk imported into a temporary database together with generated transactions. A lookup passes if
+no table is scanned completely, a query of `queries.sql` if only the table it starts with is. A query which filters on
+a stored balance must also search the balance's index (see `BALANCE_INDEXES`), i.e. start with the open orders
+(transactions) instead of filtering the rows of a join.
+
+"""
+import contextlib
+import io
+import os
+import random
+import sys
+import time
+from datetime import date
+from typing import List, Tuple
+
+from sqlalchemy import or_, text
+
+from main import conf
+from main.bench.sandbox import temp_dir
+from main.bench.bulk_bench import write_bulk_jsonl
+from main.bench.fake_shopify import make_orders, make_products
+from main.db.orm import Address, Base, Customer, LineItem, Order, OrderTransaction, Reminder, Transaction, Variant, \
+    engine, sess, update_schemas
+from main.importer import bulk_importer
+
+REPEAT = 20
+# the index of each stored balance, by its column
+BALANCE_INDEXES = {'stored_unpaid_amount': 'ix_orders_stored_unpaid_amount',
+                   'stored_unassociated_amount': 'ix_transactions_stored_unassociated_amount'}
+
+
+def importer_queries() -> List[Tuple[str, object]]:
+    """The lookups of the importers and of the association, with parameters taken from the database."""
+    orders = sess.query(Order).order_by(Order.id).limit(50).all()
+    nrs = [order.nr for order in orders]
+    ids = [order.id for order in orders]
+    address = orders[0].address
+    transaction_id = sess.query(OrderTransaction.transaction_id).first()[0]
+    unassociated_amount = Transaction.stored_unassociated_amount
+    return [
+        ('Bestellungen nach Nummer (ImportCache.warm)', sess.query(Order).filter(Order.nr.in_(nrs))),
+        ('Adressen nach Fingerabdruck (ImportCache.warm)',
+         sess.query(Address).filter(Address.fingerprint.in_([order.address.fingerprint for order in orders]))),
+        ('Adresse nach Fingerabdruck (ImportCache.get)',
+         sess.query(Address).filter_by(fingerprint=address.fingerprint)),
+        ('Kunden nach Shopify-ID (ImportCache.warm)',
+         sess.query(Customer).filter(Customer.shopify_id.in_([order.customer.shopify_id for order in orders]))),
+        ('Positionen von Bestellungen', sess.query(LineItem).filter(LineItem.order_id.in_(ids))),
+        ('Menge der Varianten eines Produkts (Variant.quantity)',
+         sess.query(Variant.id, Variant.quantity).filter(Variant.product_id == orders[0].line_items[0].variant
+                                                         .product_id)),
+        ('Stornierte Bestellungen mit Zuweisungen',
+         sess.query(Order.id, Order.nr, Order.order_transactions.any()).filter(Order.nr.in_(nrs))),
+        ('Erinnerungen von Bestellungen', sess.query(Reminder).filter(Reminder.order_id.in_(ids))),
+        ('Zuweisungen einer Transaktion',
+         sess.query(OrderTransaction).filter(OrderTransaction.transaction_id == transaction_id)),
+        ('Bestellungen von Kunden (get_payer_open_orders)',
+         sess.query(Order).filter(Order.customer_id.in_([order.customer_id for order in orders]))),
+        ('Offene Transaktionen (load_open_transactions)',
+         sess.query(Transaction, unassociated_amount).filter(
+             Transaction.associate == True, or_(unassociated_amount > 0, unassociated_amount < 0))),
+        ('Offene Bestellungen', sess.query(Order.nr).filter(Order.unpaid_amount > 0)),
+    ]
+
+
+def sql_file_queries(path: str) -> List[Tuple[str, object]]:
+    """The queries of an SQL file, named by the comment in front of them."""
+    queries = []
+    with open(path, encoding='utf-8') as f:
+        for statement in f.read().split(';'):
+            lines = [line for line in statement.strip().splitlines() if line.strip()]
+            comments = [line[2:].strip() for line in lines if line.startswith('--')]
+            sql = '\n'.join(line for line in lines if not line.startswith('--'))
+            if sql:
+                queries.append((comments[0] if comments else sql[:40], text(sql)))
+    return queries
+
+
+def explain(query) -> List[str]:
+    statement = query.statement if hasattr(query, 'statement') else query
+    compiled = statement.compile(engine)
+    params = [compiled.params[name] for name in compiled.positiontup or ()]
+    cursor = sess.connection().connection.cursor()
+    return [row[-1] for row in cursor.execute(f'EXPLAIN QUERY PLAN {compiled}', params)]
+
+
+def execute(query) -> float:
+    start = time.perf_counter()
+    for _ in range(REPEAT):
+        if hasattr(query, 'statement'):
+            query.all()
+        else:
+            sess.execute(query).fetchall()
+    return (time.perf_counter() - start) / REPEAT
+
+
+def make_transactions(seed=0):
+    """Pays for most of the orders, a tenth of them only partially."""
+    rnd = random.Random(seed)
+    orders = sess.query(Order.id, Order.nr, Order.stored_amount).all()
+    rows = [{'name': f'Kunde {i}', 'iban': f'DE{i:020d}', 'reference': nr, 'amount': amount,
+             'date_': date(2021, 2, 1)} for i, (id_, nr, amount) in enumerate(orders)]
+    sess.execute(Transaction.__table__.insert(), rows)
+    transaction_ids = dict(sess.query(Transaction.reference, Transaction.id))
+    sess.execute(OrderTransaction.__table__.insert(), [
+        {'order_id': id_, 'transaction_id': transaction_ids[nr],
+         'amount': amount // 2 if rnd.random() < 0.1 else amount} for id_, nr, amount in orders if rnd.random() < 0.8])
+    sess.commit()
+
+
+def drop_model_indexes():
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            sess.execute(text(f'DROP INDEX IF EXISTS {index.name}'))
+    sess.commit()
+
+
+def create_model_indexes():
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(sess.connection())
+    sess.commit()
+
+
+def full_scans(plan: List[str]) -> List[str]:
+    """The steps of a query plan which read a whole table, or index it for the query only."""
+    return [step for step in plan if step.startswith('SCAN') or 'AUTOMATIC' in step]
+
+
+def missing_balance_indexes(query, plan: List[str]) -> List[str]:
+    """The indexes of the stored balances the query filters on which its plan does not search."""
+    if hasattr(query, 'whereclause'):
+        sql = str(query.whereclause)
+    else:
+        # the statements of `queries.sql` are plain text
+        sql = str(query).upper().partition('WHERE')[2].lower()
+    return [index for column, index in BALANCE_INDEXES.items()
+            if column in sql and not any(f'USING INDEX {index} ' in step for step in plan)]
+
+
+def run(n_orders=2000):
+    update_schemas()
+    jsonl_path = os.path.join(temp_dir, 'bulk.jsonl')
+    products = make_products(100)
+    write_bulk_jsonl(jsonl_path, products, make_orders(n_orders, products))
+    with contextlib.redirect_stdout(io.StringIO()):
+        bulk_importer.import_file(jsonl_path)
+    make_transactions()
+    queries = [(name, query, 0) for name, query in importer_queries()] + \
+              [(name, query, 1) for name, query in sql_file_queries(os.path.join(conf.paths['project'],
+                                                                                  'queries.sql'))]
+    drop_model_indexes()
+    without_indexes = [(len(full_scans(explain(query))), execute(query)) for name, query, allowed_scans in queries]
+    create_model_indexes()
+    failures = 0
+    for (name, query, allowed_scans), (n_scans, duration) in zip(queries, without_indexes):
+        plan = explain(query)
+        missing = missing_balance_indexes(query, plan)
+        ok = len(full_scans(plan)) <= allowed_scans and not missing
+        failures += not ok
+        print(f'{"OK" if ok else "FEHLER"}: {name}: ohne Indizes {n_scans} vollständige Scans in '
+              f'{duration * 1000:.2f} ms, mit Indizes {len(full_scans(plan))} in {execute(query) * 1000:.2f} ms')
+        if missing:
+            print(f'\tnicht genutzt: {", ".join(missing)}')
+        for step in plan:
+            print(f'\t{step}')
+    print(f'{len(queries) - failures} von {len(queries)} Abfragen nutzen Indizes.')
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 2000)
@@ -0,0 +1,118 @@
+"""
+Checks `OrderNrMatcher` against a regression corpus of references and compares its throughput with the former
+pattern scans of `get_order_nrs` on a large generated corpus.
+
+Usage: python -m main.bench.reference_bench [references]
+
+"""
+import random
+import re
+import sys
+import time
+from typing import List, Set
+
+from main.importer.order_nr_matcher import OrderNrMatcher
+
+KNOWN_NRS = {'ABI1001', 'ABI1204', 'ABI1234', 'ABI1235', 'ABI5432', 'ABI12345'}
+
+# references with the order nrs expected to be found, given the known nrs above
+REGRESSION_CORPUS = [
+    ('ABI1234', {'ABI1234'}),
+    ('abi1234 danke', {'ABI1234'}),
+    ('Bestellung ABI 1234', {'ABI1234'}),
+    ('ABI 12345', {'ABI12345'}),
+    ('AB/1234', {'ABI1234'}),
+    ('AB/12345', {'ABI12345'}),
+    ('ABI-1234', {'ABI1234'}),
+    ('ABI.1234', {'ABI1234'}),
+    ('ABI #1234', {'ABI1234'}),
+    ('ABl1234', {'ABI1234'}),
+    ('AB1 1234', {'ABI1234'}),
+    ('AB|1234', {'ABI1234'}),
+    ('ABI1O01', {'ABI1001'}),
+    ('ABI12O4 Max Mustermann', {'ABI1204'}),
+    ('ABI 1234 und ABI1235', {'ABI1234', 'ABI1235'}),
+    ('RechnungABI1234ABI1235', {'ABI1234', 'ABI1235'}),
+    ('ABI1234lt. Rechnung', {'ABI1234'}),
+    ('ABI1o0i', {'ABI1001'}),
+    ('ABI 1OOL', {'ABI1001'}),
+    # digits are never dropped to find a known nr
+    ('ABI54321', {'ABI54321'}),
+    # unknown nrs are kept, so the transaction is left to the user
+    ('ABI9999', {'ABI9999'}),
+    ('ABI 12O9', set()),
+    # a confused prefix counts only with a known nr, "AB1" is not the prefix in front of "2345"
+    ('AB12345', set()),
+    ('ABl9999', set()),
+    ('Bestellung 1234', set()),
+    ('ABI123', set()),
+    ('Abitur 2021', set()),
+    ('', set()),
+]
+
+WORDS = ('Bestellung', 'Rechnung', 'Danke', 'Abiball', 'Pulli', 'Hoodie', 'Klasse', 'Max', 'Mustermann', 'EREF',
+         'SVWZ', 'Überweisung', 'Gutschrift')
+SPELLINGS = ('ABI{}', 'ABI {}', 'abi{}', 'AB/{}', 'ABI-{}', 'ABl{}', 'Abi {}')
+
+
+def legacy_get_order_nrs(reference) -> Set[str]:
+    """`get_order_nrs` as it was before `OrderNrMatcher`, including its typos (`d?` instead of `\\d?`)."""
+    orders = set()
+    if re.search(r"ABI\d{4}\d?", reference, re.IGNORECASE):
+        orders |= set(re.findall(r"ABI\d{4}\d?", reference, re.IGNORECASE))
+    if re.search(r"ABI \d{4}\d?", reference, re.IGNORECASE):
+        order_nr = re.findall(r"ABI \d{4}d?", reference, re.IGNORECASE)
+        orders |= set([o.replace(" ", "") for o in order_nr])
+    if re.search(r"AB/\d{4}\d?", reference, re.IGNORECASE):
+        order_nr = re.findall(r"AB/\d{4}d?", reference, re.IGNORECASE)
+        orders |= set([o.replace("/", "I") for o in order_nr])
+    if len(orders) != 0:
+        return set(map(str.upper, orders))
+    return orders
+
+
+def make_references(n: int, seed=0) -> List[str]:
+    rnd = random.Random(seed)
+    references = []
+    for _ in range(n):
+        words = [rnd.choice(WORDS) for _ in range(rnd.randint(2, 8))]
+        for _ in range(rnd.choice((0, 1, 1, 1, 2))):
+            words.insert(rnd.randrange(len(words) + 1), rnd.choice(SPELLINGS).format(rnd.randint(1000, 12000)))
+        if rnd.random() < 0.3:
+            words.append(f'DE{rnd.randrange(10 ** 20):020d}')
+        references.append(' '.join(words))
+    return references
+
+
+def check_regression_corpus():
+    matcher = OrderNrMatcher(known_nrs=KNOWN_NRS)
+    failures = [(reference, expected, matcher.match(reference)) for reference, expected in REGRESSION_CORPUS
+                if matcher.match(reference) != expected]
+    for reference, expected, found in failures:
+        print(f'"{reference}": {sorted(expected)} erwartet, {sorted(found)} gefunden')
+    print(f'Regressionskorpus: {len(REGRESSION_CORPUS) - len(failures)} von {len(REGRESSION_CORPUS)} Referenzen '
+          f'korrekt')
+    return not failures
+
+
+def run(n_references=200000):
+    ok = check_regression_corpus()
+    references = make_references(n_references)
+    known_nrs = {f'ABI{nr}' for nr in range(1000, 12000)}
+    matcher = OrderNrMatcher(known_nrs=known_nrs)
+    results = {}
+    for name, match in (('get_order_nrs (alt)', legacy_get_order_nrs), ('OrderNrMatcher', matcher.match)):
+        start = time.perf_counter()
+        results[name] = [match(reference) for reference in references]
+        duration = time.perf_counter() - start
+        n_found = sum(map(len, results[name]))
+        print(f'{name}: {n_references / duration:.0f} Referenzen/s, {n_found} Bestellnummern gefunden')
+    legacy, matched = results.values()
+    n_differing = sum(1 for a, b in zip(legacy, matched) if a != b)
+    print(f'{n_differing} Referenzen mit abweichendem Ergebnis (Tippfehler, Verwechslungen und fünfstellige Nummern)')
+    if not ok:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 200000)
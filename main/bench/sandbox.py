@@ -0,0 +1,18 @@
+"""
+Redirects the database and the log of a benchmark to a temporary directory, which is removed when the benchmark exits,
+so benchmarks never touch the files of the project.
+
+Every benchmark imports this module before anything which connects to the database (`main.db.orm`).
+
+"""
+import atexit
+import os
+import shutil
+import tempfile
+
+from main import conf
+
+temp_dir = tempfile.mkdtemp()
+conf.paths['sqlite'] = os.path.join(temp_dir, 'bench.sqlite')
+conf.redirect_log(os.path.join(temp_dir, 'logging.log'))
+atexit.register(shutil.rmtree, temp_dir, ignore_errors=True)
@@ -0,0 +1,99 @@
+"""
+Measures the throughput and the peak memory of the bank statement parsers (see `statement_parsers`) on generated
+statements which hold the same transactions in every format.
+
+Usage: python -m main.bench.statement_bench [transactions]
+
+"""
+import os
+import random
+import sys
+import time
+import tracemalloc
+from datetime import date, timedelta
+from typing import Callable, Dict, List, TextIO
+from xml.sax.saxutils import escape
+
+from main.bench.sandbox import temp_dir
+from main.importer.statement_parsers import CAMT053, CSV, MT940, detect_format, read_statement
+
+FIRST_NAMES = ('Anna', 'Ben', 'Clara', 'David', 'Emma', 'Felix', 'Jörg', 'Lena')
+LAST_NAMES = ('Müller', 'Schmidt', 'Schneider', 'Fischer', 'Weber', 'Meyer', 'Wagner', 'Becker')
+CAMT_NAMESPACE = 'urn:iso:std:iso:20022:tech:xsd:camt.053.001.02'
+
+
+def make_transactions(n: int, seed=0) -> List[dict]:
+    """Every fourth transaction is outgoing. The parsers yield the incoming ones only."""
+    rnd = random.Random(seed)
+    transactions = []
+    for i in range(n):
+        amount = rnd.randint(500, 20000) * (-1 if i % 4 == 3 else 1)
+        transactions.append({'name': f'{rnd.choice(FIRST_NAMES)} {rnd.choice(LAST_NAMES)}',
+                             'iban': f'DE{rnd.randrange(10 ** 20):020d}',
+                             'reference': f'ABI{rnd.randint(1000, 9999)} Bestellung {i}',
+                             'amount': amount,
+                             'date_': date(2021, 1, 1) + timedelta(days=i % 365)})
+    return transactions
+
+
+def write_csv(f: TextIO, transactions: List[dict]):
+    f.write('Index,Amount,Payment reference,Counterparty,Account number,Valuta Date\n')
+    for i, t in enumerate(transactions):
+        f.write(f'{i},"{t["amount"] / 100:,.2f}","{t["reference"]}","{t["name"]}",{t["iban"]},'
+                f'{t["date_"]:%d/%m/%Y}\n')
+
+
+def write_camt053(f: TextIO, transactions: List[dict]):
+    f.write(f'<?xml version="1.0" encoding="UTF-8"?>\n<Document xmlns="{CAMT_NAMESPACE}">'
+            f'<BkToCstmrStmt><Stmt><Id>1</Id>\n')
+    for t in transactions:
+        f.write(f'<Ntry><Amt Ccy="EUR">{abs(t["amount"]) / 100:.2f}</Amt>'
+                f'<CdtDbtInd>{"CRDT" if t["amount"] > 0 else "DBIT"}</CdtDbtInd><Sts>BOOK</Sts>'
+                f'<BookgDt><Dt>{t["date_"]}</Dt></BookgDt><ValDt><Dt>{t["date_"]}</Dt></ValDt>'
+                f'<NtryDtls><TxDtls><RltdPties><Dbtr><Nm>{escape(t["name"])}</Nm></Dbtr>'
+                f'<DbtrAcct><Id><IBAN>{t["iban"]}</IBAN></Id></DbtrAcct></RltdPties>'
+                f'<RmtInf><Ustrd>{escape(t["reference"])}</Ustrd></RmtInf></TxDtls></NtryDtls></Ntry>\n')
+    f.write('</Stmt></BkToCstmrStmt></Document>\n')
+
+
+def write_mt940(f: TextIO, transactions: List[dict]):
+    f.write(':20:STARTUMS\n:25:10020030/1234567890\n:28C:1/1\n:60F:C210101EUR0,00\n')
+    for t in transactions:
+        amount = f'{abs(t["amount"]) / 100:.2f}'.replace('.', ',')
+        f.write(f':61:{t["date_"]:%y%m%d%m%d}{"C" if t["amount"] > 0 else "D"}{amount}NTRFNONREF\n'
+                f':86:166?00GUTSCHRIFT?20{t["reference"][:27]}\n?21{t["reference"][27:]}?3010020030'
+                f'?31{t["iban"]}?32{t["name"]}\n')
+    f.write(':62F:C211231EUR0,00\n-\n')
+
+
+WRITERS: Dict[str, Callable[[TextIO, List[dict]], None]] = {CSV: write_csv, CAMT053: write_camt053,
+                                                              MT940: write_mt940}
+ENCODINGS = {CSV: 'utf-8', CAMT053: 'utf-8', MT940: 'latin-1'}
+
+
+def run(n_transactions=100000):
+    transactions = make_transactions(n_transactions)
+    expected = [t for t in transactions if t['amount'] > 0]
+    print(f'{n_transactions} Transaktionen, davon {len(expected)} eingehende')
+    for format_, write in WRITERS.items():
+        path = os.path.join(temp_dir, f'statement.{format_}')
+        with open(path, 'w', encoding=ENCODINGS[format_]) as f:
+            write(f, transactions)
+        assert detect_format(path) == format_
+        start = time.perf_counter()
+        n_parsed = sum(1 for _ in read_statement(path, format_))
+        duration = time.perf_counter() - start
+        tracemalloc.start()
+        mismatches = []
+        for row, expected_row in zip(read_statement(path, format_), expected):
+            if row != expected_row:
+                mismatches.append(row)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        assert n_parsed == len(expected) and not mismatches, f'{format_}: {mismatches[:1]} weicht ab'
+        print(f'{format_}: {os.path.getsize(path) / 2 ** 20:.1f} MiB in {duration:.2f} s '
+              f'({n_parsed / duration:.0f} Transaktionen/s), maximal {peak / 2 ** 20:.2f} MiB')
+
+
+if __name__ == '__main__':
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
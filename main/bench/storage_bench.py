@@ -0,0 +1,105 @@
+"""
+Measures the throughput of the order import and of the transaction ingest under each storage profile (see
+`orm.STORAGE_PROFILES`), each time in a new temporary database.
+
+Usage: python -m main.bench.storage_bench [orders] [transactions]
+
+The orders are imported from the recorded pages of a generated shop, one commit per page. The transactions are
+appended to a bank statement in batches of `BATCH_SIZE` rows, each batch imported with one commit like "watch" does.
+Finally, transactions are associated one by one like the user does it, one commit per association.
+
+"""
+import contextlib
+import io
+import os
+import sys
+import time
+
+from main import conf
+from main.bench.sandbox import temp_dir
+from main.bench.import_bench import get_streams, record
+from main.bench.statement_bench import make_transactions, write_csv
+from main.db import orm
+from main.db.orm import Order, Transaction, sess, update_schemas
+from main.db.sqlalchemy_utils import ImportCache
+from main.importer import shopify_importer
+from main.importer.page_cache import PageCache, REPLAY
+from main.importer.shopify_fetcher import ShopifyFetcher
+from main.importer.statement_parsers import CSV
+from main.importer.transactions_importer import associate_transaction, import_transaction_file
+
+BATCH_SIZE = 10
+MANUAL_ASSOCIATIONS = 300
+
+
+def reset_database(profile: str):
+    sess.close()
+    orm.engine.dispose()
+    for suffix in ('', '-wal', '-shm', '-journal'):
+        if os.path.exists(conf.paths['sqlite'] + suffix):
+            os.remove(conf.paths['sqlite'] + suffix)
+    orm.storage_profile = profile
+    update_schemas()
+
+
+def import_orders(page_cache_dir: str) -> int:
+    fetcher = ShopifyFetcher('http://replay', '', page_cache=PageCache(page_cache_dir), page_cache_mode=REPLAY)
+    streams = fetcher.stream_all(get_streams())
+    with ImportCache() as cache, contextlib.redirect_stdout(io.StringIO()):
+        shopify_importer.import_products(streams[shopify_importer.ACTIVE_PRODUCTS], cache)
+        shopify_importer.archive_products(streams[shopify_importer.ARCHIVED_PRODUCTS], cache)
+        shopify_importer.import_orders(streams[shopify_importer.ORDERS], cache)
+    return sess.query(Order.id).count()
+
+
+def ingest_transactions(transactions) -> int:
+    """Appends the transactions to a statement batch by batch and imports each batch."""
+    path = os.path.join(temp_dir, 'statement.csv')
+    with open(path, 'w', encoding='utf-8') as f:
+        write_csv(f, [])
+    inserted = 0
+    for i in range(0, len(transactions), BATCH_SIZE):
+        start = os.path.getsize(path)
+        with open(path, 'a', encoding='utf-8') as f:
+            buffer = io.StringIO()
+            write_csv(buffer, transactions[i:i + BATCH_SIZE])
+            # without the header
+            f.write(buffer.getvalue().split('\n', 1)[1])
+        inserted += import_transaction_file(path, CSV, start, os.path.getsize(path))[0]
+    return inserted
+
+
+def associate_manually() -> int:
+    orders = {order.nr: order for order in sess.query(Order)}
+    n_associated = 0
+    with contextlib.redirect_stdout(io.StringIO()):
+        for transaction in sess.query(Transaction).order_by(Transaction.id).limit(MANUAL_ASSOCIATIONS):
+            order = orders.get(transaction.reference.split()[0])
+            if order is not None:
+                associate_transaction(transaction, [order], user_mode=False)
+                n_associated += 1
+    return n_associated
+
+
+def run(n_orders=2000, n_transactions=2000):
+    page_cache_dir = os.path.join(temp_dir, 'page_cache')
+    record(page_cache_dir, n_orders)
+    # references of existing orders, the statement generator draws them from ABI1000 to ABI9999
+    transactions = [dict(transaction, reference=f'ABI{1000 + i % n_orders} Bestellung {i}')
+                    for i, transaction in enumerate(make_transactions(n_transactions))]
+    for profile, pragmas in orm.STORAGE_PROFILES.items():
+        reset_database(profile)
+        print(f'{profile} ({", ".join(f"{pragma}={value}" for pragma, value in pragmas.items())}):')
+        phases = [('Bestellungen importiert', lambda: import_orders(page_cache_dir)),
+                  (f'Transaktionen in Stapeln von {BATCH_SIZE} importiert', lambda: ingest_transactions(transactions)),
+                  ('Transaktionen einzeln zugewiesen', associate_manually)]
+        for description, phase in phases:
+            start = time.perf_counter()
+            n = phase()
+            duration = time.perf_counter() - start
+            print(f'\t{n} {description} in {duration:.2f} s ({n / duration:.0f}/s)')
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    run(int(args[0]) if args else 2000, int(args[1]) if len(args) > 1 else 2000)
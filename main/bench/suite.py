@@ -0,0 +1,131 @@
+"""
+Benchmark suite of the hot paths of "update": the import of products and orders (`import_orders`), the import of bank
+statements (`import_transaction_file`), the search for order nrs in the references (`get_order_nrs`) and the
+automatic association (`associate_transactions`). Reports the throughput and the peak memory of each hot path for
+shops of several sizes.
+
+Usage: python -m main.bench.suite [orders ...]
+
+By default, shops with 1000, 10000 and 100000 orders are generated (see `synthetic_shop`), each with a bank statement
+paying for its orders. The pages of a shop are recorded from the fake Shopify server first and imported from the page
+cache, so the server does not count towards the time and the memory of the import. The hot paths run twice on a new
+temporary database, once timed and once with their memory traced.
+
+"""
+import contextlib
+import io
+import os
+import sys
+import time
+import tracemalloc
+
+from main import conf
+from main.bench.sandbox import temp_dir
+from main.bench.fake_shopify import FakeShopify
+from main.bench.import_bench import get_streams
+from main.bench.statement_bench import write_csv
+from main.bench.synthetic_shop import make_shop, make_statement
+from main.conf import settings
+from main.db import orm
+from main.db.orm import Order, School, Transaction, sess, update_schemas
+from main.db.sqlalchemy_utils import ImportCache
+from main.importer import shopify_importer
+from main.importer.order_nr_matcher import OrderNrMatcher
+from main.importer.page_cache import PageCache, RECORD, REPLAY
+from main.importer.shopify_fetcher import ShopifyFetcher
+from main.importer.statement_parsers import CSV
+from main.importer.transactions_importer import associate_transactions, get_order_nrs, import_transaction_file
+
+SIZES = (1000, 10000, 100000)
+
+
+def reset_database():
+    sess.close()
+    orm.engine.dispose()
+    if os.path.exists(conf.paths['sqlite']):
+        os.remove(conf.paths['sqlite'])
+    update_schemas()
+
+
+def record(directory: str, products, orders):
+    # without rate limit, the suite measures the importer and not the leaky bucket
+    with FakeShopify(products, orders, bucket_size=10 ** 9) as shop:
+        ShopifyFetcher(shop.site, 'token', page_cache=PageCache(directory), page_cache_mode=RECORD) \
+            .fetch_all(get_streams())
+
+
+def import_orders(directory: str) -> int:
+    fetcher = ShopifyFetcher('http://replay', '', page_cache=PageCache(directory), page_cache_mode=REPLAY)
+    streams = fetcher.stream_all(get_streams())
+    with ImportCache() as cache:
+        cache.warm_all(School, 'name')
+        shopify_importer.import_products(streams[shopify_importer.ACTIVE_PRODUCTS], cache)
+        shopify_importer.archive_products(streams[shopify_importer.ARCHIVED_PRODUCTS], cache)
+        shopify_importer.import_orders(streams[shopify_importer.ORDERS], cache)
+    return sess.query(Order.id).count()
+
+
+def measure(hot_path, traced: bool):
+    """
+    Runs a hot path with its output suppressed and returns its result, its duration and, if `traced`, its peak memory.
+
+    """
+    if traced:
+        tracemalloc.start()
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        result = hot_path()
+    duration = time.perf_counter() - start
+    peak = None
+    if traced:
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    return result, duration, peak
+
+
+def run_size(n_orders: int):
+    products, orders = make_shop(n_orders)
+    transactions = make_statement(orders)
+    # order nrs grow with the shop, from ABI1000 on
+    settings['order_nr_max_digits'] = max(settings.get('order_nr_max_digits', 5), len(str(999 + n_orders)))
+    page_cache_dir = os.path.join(temp_dir, f'page_cache_{n_orders}')
+    record(page_cache_dir, products, orders)
+    statement_path = os.path.join(temp_dir, f'statement_{n_orders}.csv')
+    with open(statement_path, 'w', encoding='utf-8') as f:
+        write_csv(f, transactions)
+    del products, orders
+    references = [transaction['reference'] for transaction in transactions]
+
+    def find_order_nrs() -> int:
+        matcher = OrderNrMatcher.from_settings(known_nrs={nr for nr, in sess.query(Order.nr)})
+        for reference in references:
+            get_order_nrs(reference, matcher)
+        return len(references)
+
+    def associate() -> int:
+        n_transactions = sess.query(Transaction.id).count()
+        associate_transactions()
+        return n_transactions
+
+    hot_paths = [('import_orders', 'Bestellungen', lambda: import_orders(page_cache_dir)),
+                 ('import_transaction_file', 'Transaktionen', lambda: import_transaction_file(statement_path, CSV)[0]),
+                 ('get_order_nrs', 'Referenzen', find_order_nrs),
+                 ('associate_transactions', 'Transaktionen', associate)]
+    # tracing the memory slows Python down several times, so the hot paths are timed in a pass without it
+    passes = []
+    for traced in (False, True):
+        reset_database()
+        passes.append([measure(hot_path, traced) for name, unit, hot_path in hot_paths])
+    print(f'{n_orders} Bestellungen, {len(transactions)} Transaktionen:')
+    for (name, unit, hot_path), (n, duration, _), (_, _, peak) in zip(hot_paths, *passes):
+        print(f'\t{name}: {n} {unit} in {duration:.2f} s ({n / duration:.0f}/s), maximaler Speicherbedarf '
+              f'{peak / 2 ** 20:.1f} MiB')
+
+
+def run(sizes=SIZES):
+    for n_orders in sizes:
+        run_size(n_orders)
+
+
+if __name__ == '__main__':
+    run([int(arg) for arg in sys.argv[1:]] or SIZES)
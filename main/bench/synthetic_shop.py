@@ -0,0 +1,82 @@
+import random
+from datetime import date, timedelta
+from typing import List, Tuple
+
+from main.bench.amount_bench import payer_name
+from main.bench.fake_shopify import make_orders, make_products
+from main.bench.reference_bench import SPELLINGS, WORDS
+from main.utils import to_cent
+
+
+def make_shop(n_orders: int, n_products: int = None, seed=0) -> Tuple[List[dict], List[dict]]:
+    """
+    Generates the products and orders of a shop in the format of the REST Admin API (see `fake_shopify`). Every third
+    order is the second or third one of a customer, every twentieth one is cancelled. Equal arguments give equal shops.
+
+    """
+    products = make_products(n_products or max(50, n_orders // 200), seed)
+    return products, make_orders(n_orders, products, seed)
+
+
+def order_amount(order: dict) -> int:
+    """The amount of a generated order in cents, as the importer computes it."""
+    return sum(to_cent(line_item['price']) * line_item['quantity'] for line_item in order['line_items']) \
+        + to_cent(order['total_shipping_price_set']['shop_money']['amount']) - to_cent(order['total_discounts'])
+
+
+def messy_reference(nrs: List[str], rnd: random.Random) -> str:
+    """A reference naming the order nrs in the spellings of customers, between other words."""
+    words = [rnd.choice(WORDS) for _ in range(rnd.randint(0, 4))]
+    for nr in nrs:
+        words.insert(rnd.randrange(len(words) + 1), rnd.choice(SPELLINGS).format(nr[3:]))
+    return ' '.join(words)
+
+
+def make_statement(orders: List[dict], seed=0) -> List[dict]:
+    """
+    Generates the transactions of a bank statement paying for the orders which are not cancelled:
+
+    - most pay one order with the exact amount, a few pay too little or too much,
+    - some pay two orders of the same customer at once,
+    - some do not name an order nr, so only their amount and name identify the order,
+    - some name an order nr which does not exist,
+    - some orders are not paid at all, and some transactions are outgoing ones.
+
+    Each customer pays from an account of their own, under one of the spellings of `amount_bench.payer_name`.
+
+    """
+    rnd = random.Random(seed)
+    open_orders = [order for order in orders if not order['cancelled_at']]
+    by_customer = {}
+    for order in open_orders:
+        by_customer.setdefault(order['customer']['id'], []).append(order)
+    transactions = []
+    for i, order in enumerate(open_orders):
+        customer = order['customer']
+        amount = order_amount(order)
+        paid = [order]
+        kind = rnd.random()
+        if kind < 0.08:
+            continue
+        elif kind < 0.14:
+            amount -= rnd.randint(1, amount // 2)
+        elif kind < 0.18:
+            amount += rnd.randint(1, 1000)
+        elif kind < 0.26:
+            others = [other for other in by_customer[customer['id']] if other is not order]
+            if others:
+                paid.append(rnd.choice(others))
+                amount += order_amount(paid[-1])
+        if kind < 0.26 or kind >= 0.36:
+            reference = messy_reference([paid_order['name'] for paid_order in paid], rnd)
+        elif kind < 0.33:
+            reference = ' '.join(rnd.choice(WORDS) for _ in range(rnd.randint(1, 4)))
+        else:
+            reference = messy_reference([f'ABI{rnd.randint(900000, 999999)}'], rnd)
+        transactions.append({'name': payer_name(f'{customer["first_name"]} {customer["last_name"]}', rnd),
+                             'iban': f'DE{customer["id"]:020d}', 'reference': reference or 'Überweisung',
+                             'amount': amount, 'date_': date(2021, 2, 1) + timedelta(days=i % 90)})
+        if rnd.random() < 0.05:
+            transactions.append({'name': 'Druckerei', 'iban': 'DE00000000000000000001', 'reference': f'Rechnung {i}',
+                                 'amount': -rnd.randint(1000, 100000), 'date_': transactions[-1]['date_']})
+    return transactions
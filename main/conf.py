@@ -1,9 +1,13 @@
 import json
 import logging
 import os
-from datetime import datetime, timedelta, date
+from datetime import datetime, date
+from typing import Dict, Optional
 
 UPDATE_AFTER = 'update_after'
+SYNC_CURSORS = 'sync_cursors'
+CHECKPOINTS = 'checkpoints'
+STATEMENT_OFFSETS = 'statement_offsets'
 
 # project paths
 paths = {'project': os.path.abspath(f'{os.path.dirname(__file__)}/..')}
@@ -13,6 +17,9 @@ paths['sqlite'] = f'{paths["resources"]}/db.sqlite'
 paths['internal_paras'] = f'{paths["resources"]}/internal_paras.json'
 paths['settings'] = f'{paths["resources"]}/settings.json'
 paths['transactions'] = f'{paths["resources"]}/transactions'
+paths['page_cache'] = f'{paths["resources"]}/page_cache'
+paths['profiles'] = f'{paths["resources"]}/profiles'
+paths['log'] = f'{paths["resources"]}/logging.log'
 
 # project settings
 with open(paths['internal_paras'], encoding='utf-8') as f:
@@ -28,19 +35,83 @@ password = settings['password']
 console_handler = logging.StreamHandler()
 console_handler.setLevel(logging.CRITICAL)
 console_handler.setFormatter(logging.Formatter('%(levelname)s: %(message)s'))
-file_handler = logging.FileHandler(f'{paths["resources"]}/logging.log', 'w')
-file_handler.setLevel(logging.INFO)
-file_handler.setFormatter(logging.Formatter('%(asctime)s: %(levelname)s: %(message)s'))
+
+
+def make_file_handler(path: str) -> logging.FileHandler:
+    # the log is only opened (and emptied) when the first record is written, so it can still be redirected (see
+    # `redirect_log`)
+    handler = logging.FileHandler(path, 'w', delay=True)
+    handler.setLevel(logging.INFO)
+    handler.setFormatter(logging.Formatter('%(asctime)s: %(levelname)s: %(message)s'))
+    return handler
+
+
+file_handler = make_file_handler(paths['log'])
 handlers = [console_handler, file_handler]
 
 logging.basicConfig(handlers=handlers, level=logging.INFO)
 
 
+def redirect_log(path: str):
+    """Writes the log to `path` instead of `paths['log']`."""
+    global file_handler
+    logging.getLogger().removeHandler(file_handler)
+    file_handler.close()
+    paths['log'] = path
+    file_handler = make_file_handler(path)
+    logging.getLogger().addHandler(file_handler)
+
+
 def to_date(date_str) -> date:
     return datetime.strptime(date_str, '%Y-%m-%d').date()
 
 
-def update_update_after():
-    internal_paras = {UPDATE_AFTER: (date.today() - timedelta(2)).strftime('%Y-%m-%d')}
-    with open(paths['internal_paras'], 'w', encoding='utf-8') as f:
-        json.dump(internal_paras, f)
+def get_sync_cursor(stream: str) -> str:
+    """
+    Returns the newest "updated_at" timestamp of the stream's resources which was imported successfully. Streams which
+    were never imported start at "update_after".
+
+    """
+    return settings.get(SYNC_CURSORS, {}).get(stream, update_after)
+
+
+def save_sync_cursors(cursors: Dict[str, str]):
+    update_internal_paras(SYNC_CURSORS, cursors)
+
+
+def get_checkpoint(stream: str) -> Optional[dict]:
+    """Returns how far an interrupted update got with the stream (see `SyncCursor.checkpoint`)."""
+    return settings.get(CHECKPOINTS, {}).get(stream)
+
+
+def save_checkpoint(stream: str, checkpoint: Optional[dict]):
+    """Stores the checkpoint of a stream or removes it if `checkpoint` is None."""
+    update_internal_paras(CHECKPOINTS, {stream: checkpoint})
+
+
+def get_statement_offsets() -> Dict[str, dict]:
+    """Returns how far each file of the transactions folder was imported (see `transactions_importer.file_state`)."""
+    return settings.get(STATEMENT_OFFSETS, {})
+
+
+def save_statement_offset(name: str, state: Optional[dict]):
+    """Stores the state of a transaction file or removes it if `state` is None."""
+    update_internal_paras(STATEMENT_OFFSETS, {name: state})
+
+
+def update_internal_paras(key: str, values: Dict[str, Optional[object]]):
+    """Updates the dict `key` in internal_paras.json (and in `settings`). Entries whose value is None are removed."""
+    with open(paths['internal_paras'], encoding='utf-8') as f:
+        internal_paras = json.load(f)
+    entries = internal_paras.setdefault(key, {})
+    for name, value in values.items():
+        if value is None:
+            entries.pop(name, None)
+        else:
+            entries[name] = value
+    # written after every imported page, so never leave a half written file behind
+    temp_path = f'{paths["internal_paras"]}.tmp'
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        json.dump(internal_paras, f, indent=2)
+    os.replace(temp_path, paths['internal_paras'])
+    settings[key] = entries
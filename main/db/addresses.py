@@ -0,0 +1,65 @@
+import hashlib
+from typing import Dict, List
+
+from sqlalchemy import bindparam, text
+
+from main.db.orm import Address, Order, sess
+
+# the fields of an address which make up its fingerprint, in this order
+FIELDS = ('first_name', 'last_name', 'street', 'additional', 'city', 'zip_')
+
+
+def fingerprint(first_name: str, last_name: str, street: str, additional: str, city: str, zip_: str) -> str:
+    """
+    Hashes the fields of an address after collapsing whitespace and ignoring case, so e.g. "Hauptstr. 1" and
+    "hauptstr.  1" give the same fingerprint. Missing fields count as empty.
+
+    """
+    fields = (first_name, last_name, street, additional, city, zip_)
+    normalised = '\x1f'.join(' '.join((field or '').split()).casefold() for field in fields)
+    return hashlib.sha1(normalised.encode('utf-8')).hexdigest()
+
+
+def merge_duplicates() -> Dict[int, int]:
+    """
+    Computes the fingerprint of each address and merges the addresses with equal fingerprints into the oldest one,
+    whose orders they get. The changes are committed with the caller's transaction.
+
+    Returns:
+        The id of the address each merged address was merged into, by the id of the merged address.
+    """
+    kept: Dict[str, int] = {}
+    merged: Dict[int, int] = {}
+    fingerprints: List[dict] = []
+    rows = sess.execute(text(f'SELECT id, {", ".join(FIELDS)} FROM addresses ORDER BY id'))
+    for id_, *fields in rows.fetchall():
+        address_fingerprint = fingerprint(*fields)
+        if address_fingerprint in kept:
+            merged[id_] = kept[address_fingerprint]
+        else:
+            kept[address_fingerprint] = id_
+            fingerprints.append({'address_id': id_, 'address_fingerprint': address_fingerprint})
+    orders, addresses = Order.__table__, Address.__table__
+    if merged:
+        sess.execute(orders.update().where(orders.c.address_id == bindparam('merged_id'))
+                     .values(address_id=bindparam('kept_id')),
+                     [{'merged_id': merged_id, 'kept_id': kept_id} for merged_id, kept_id in merged.items()])
+        sess.execute(addresses.delete().where(addresses.c.id == bindparam('merged_id')),
+                     [{'merged_id': merged_id} for merged_id in merged])
+    if fingerprints:
+        sess.execute(addresses.update().where(addresses.c.id == bindparam('address_id'))
+                     .values(fingerprint=bindparam('address_fingerprint')), fingerprints)
+    return merged
+
+
+def install():
+    """
+    Adds the fingerprint column to databases created before it, fills it and merges the duplicate addresses which
+    became apparent (see `merge_duplicates`). The unique index of the fingerprints replaces the index of the fields.
+
+    """
+    if 'fingerprint' not in {row[1] for row in sess.execute(text('PRAGMA table_info(addresses)'))}:
+        sess.execute(text('ALTER TABLE addresses ADD COLUMN fingerprint VARCHAR'))
+    merge_duplicates()
+    sess.execute(text('DROP INDEX IF EXISTS ix_addresses_lookup'))
+    sess.execute(text('CREATE UNIQUE INDEX IF NOT EXISTS ix_addresses_fingerprint ON addresses (fingerprint)'))
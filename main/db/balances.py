@@ -0,0 +1,149 @@
+from typing import Dict, List, Tuple
+
+from sqlalchemy import bindparam, func, text
+
+from main.db.orm import LineItem, Order, OrderTransaction, Transaction, sess
+
+# the stored balance columns, with the tables they belong to
+COLUMNS = {'orders': ('stored_amount', 'stored_paid_amount', 'stored_unpaid_amount'),
+           'transactions': ('stored_associated_amount', 'stored_unassociated_amount')}
+
+
+def order_delta(order_id: str, amount: str = '0', paid_amount: str = '0') -> str:
+    """An UPDATE statement adding the SQL expressions `amount` and `paid_amount` to the balance of an order."""
+    return f'UPDATE orders SET stored_amount = stored_amount + ({amount}), ' \
+           f'stored_paid_amount = stored_paid_amount + ({paid_amount}), ' \
+           f'stored_unpaid_amount = stored_unpaid_amount + ({amount}) - ({paid_amount}) WHERE id = {order_id};'
+
+
+def transaction_delta(transaction_id: str, amount: str = '0', associated_amount: str = '0') -> str:
+    return f'UPDATE transactions SET stored_associated_amount = stored_associated_amount + ({associated_amount}), ' \
+           f'stored_unassociated_amount = stored_unassociated_amount + ({amount}) - ({associated_amount}) ' \
+           f'WHERE id = {transaction_id};'
+
+
+# Each trigger adds the difference a change makes to the stored balances, so it costs two lookups by primary key at
+# most, also for bulk inserts. The statements of a trigger do not fire other triggers (SQLite's "recursive_triggers"
+# is off), and they do not update the columns the triggers of "orders" and "transactions" watch.
+TRIGGERS = {
+    'balance_order_insert': (
+        'AFTER INSERT ON orders',
+        'UPDATE orders SET stored_amount = IFNULL(NEW.shipping, 0) - IFNULL(NEW.discount, 0), '
+        'stored_paid_amount = IFNULL(NEW.decree, 0), '
+        'stored_unpaid_amount = IFNULL(NEW.shipping, 0) - IFNULL(NEW.discount, 0) - IFNULL(NEW.decree, 0) '
+        'WHERE id = NEW.id;'),
+    'balance_order_update': (
+        'AFTER UPDATE OF discount, shipping, decree ON orders',
+        order_delta('NEW.id', 'IFNULL(NEW.shipping, 0) - IFNULL(OLD.shipping, 0) - IFNULL(NEW.discount, 0) '
+                              '+ IFNULL(OLD.discount, 0)',
+                    'IFNULL(NEW.decree, 0) - IFNULL(OLD.decree, 0)')),
+    'balance_line_item_insert': (
+        'AFTER INSERT ON line_items',
+        order_delta('NEW.order_id', 'NEW.amount * NEW.quantity')),
+    'balance_line_item_update': (
+        'AFTER UPDATE OF order_id, amount, quantity ON line_items',
+        order_delta('OLD.order_id', '-OLD.amount * OLD.quantity') + order_delta('NEW.order_id',
+                                                                               'NEW.amount * NEW.quantity')),
+    'balance_line_item_delete': (
+        'AFTER DELETE ON line_items',
+        order_delta('OLD.order_id', '-OLD.amount * OLD.quantity')),
+    'balance_transaction_insert': (
+        'AFTER INSERT ON transactions',
+        'UPDATE transactions SET stored_associated_amount = 0, stored_unassociated_amount = NEW.amount '
+        'WHERE id = NEW.id;'),
+    'balance_transaction_update': (
+        'AFTER UPDATE OF amount ON transactions',
+        transaction_delta('NEW.id', 'NEW.amount - OLD.amount')),
+    'balance_order_transaction_insert': (
+        'AFTER INSERT ON order_transactions',
+        order_delta('NEW.order_id', paid_amount='NEW.amount')
+        + transaction_delta('NEW.transaction_id', associated_amount='NEW.amount')),
+    'balance_order_transaction_update': (
+        'AFTER UPDATE OF order_id, transaction_id, amount ON order_transactions',
+        order_delta('OLD.order_id', paid_amount='-OLD.amount')
+        + transaction_delta('OLD.transaction_id', associated_amount='-OLD.amount')
+        + order_delta('NEW.order_id', paid_amount='NEW.amount')
+        + transaction_delta('NEW.transaction_id', associated_amount='NEW.amount')),
+    'balance_order_transaction_delete': (
+        'AFTER DELETE ON order_transactions',
+        order_delta('OLD.order_id', paid_amount='-OLD.amount')
+        + transaction_delta('OLD.transaction_id', associated_amount='-OLD.amount')),
+}
+
+
+def install():
+    """
+    Adds the stored balance columns to databases created before them and creates their triggers (see
+    `migrations.MIGRATIONS`, the next migration indexes them). The balances of added columns are computed at once (see
+    `rebuild`).
+
+    """
+    added = False
+    for table, columns in COLUMNS.items():
+        existing = {row[1] for row in sess.execute(text(f'PRAGMA table_info({table})'))}
+        for column in columns:
+            if column not in existing:
+                sess.execute(text(f'ALTER TABLE {table} ADD COLUMN {column} INTEGER NOT NULL DEFAULT 0'))
+                added = True
+    for name, (event, statements) in TRIGGERS.items():
+        sess.execute(text(f'CREATE TRIGGER IF NOT EXISTS {name} {event} BEGIN {statements} END'))
+    if added:
+        rebuild()
+
+
+def expected_balances() -> Tuple[Dict[int, Tuple[int, int]], Dict[int, int]]:
+    """
+    Computes the balances from the line items and associations, with one grouped query per table.
+
+    Returns:
+        The amount and the paid amount of each order and the associated amount of each transaction by their ids.
+    """
+    line_items = dict(sess.query(LineItem.order_id, func.sum(LineItem.amount * LineItem.quantity))
+                      .group_by(LineItem.order_id))
+    paid = dict(sess.query(OrderTransaction.order_id, func.sum(OrderTransaction.amount))
+                .group_by(OrderTransaction.order_id))
+    associated = dict(sess.query(OrderTransaction.transaction_id, func.sum(OrderTransaction.amount))
+                      .group_by(OrderTransaction.transaction_id))
+    orders = {id_: (line_items.get(id_, 0) - (discount or 0) + (shipping or 0), paid.get(id_, 0) + (decree or 0))
+              for id_, discount, shipping, decree in sess.query(Order.id, Order.discount, Order.shipping,
+                                                                Order.decree)}
+    transactions = {id_: associated.get(id_, 0) for id_, in sess.query(Transaction.id)}
+    return orders, transactions
+
+
+def rebuild():
+    """Recomputes all stored balances. They are committed with the caller's transaction."""
+    orders, transactions = expected_balances()
+    if orders:
+        sess.execute(Order.__table__.update().where(Order.id == bindparam('order_id')).values(
+            stored_amount=bindparam('amount'), stored_paid_amount=bindparam('paid_amount'),
+            stored_unpaid_amount=bindparam('amount') - bindparam('paid_amount')),
+            [{'order_id': id_, 'amount': amount, 'paid_amount': paid_amount}
+             for id_, (amount, paid_amount) in orders.items()])
+    if transactions:
+        table = Transaction.__table__
+        sess.execute(table.update().where(table.c.id == bindparam('transaction_id')).values(
+            stored_associated_amount=bindparam('associated_amount'),
+            stored_unassociated_amount=table.c.amount - bindparam('associated_amount')),
+            [{'transaction_id': id_, 'associated_amount': amount} for id_, amount in transactions.items()])
+
+
+def verify() -> List[str]:
+    """Returns a description of each stored balance which differs from the balance computed from scratch."""
+    orders, transactions = expected_balances()
+    differences = []
+    for id_, nr, amount, paid_amount, unpaid_amount in sess.query(
+            Order.id, Order.nr, Order.stored_amount, Order.stored_paid_amount, Order.stored_unpaid_amount):
+        expected_amount, expected_paid_amount = orders[id_]
+        if (amount, paid_amount, unpaid_amount) != (expected_amount, expected_paid_amount,
+                                                    expected_amount - expected_paid_amount):
+            differences.append(f'Bestellung {nr}: Betrag {amount} statt {expected_amount}, bezahlt {paid_amount} '
+                               f'statt {expected_paid_amount}, offen {unpaid_amount} statt '
+                               f'{expected_amount - expected_paid_amount}')
+    for transaction, associated_amount, unassociated_amount in sess.query(
+            Transaction, Transaction.stored_associated_amount, Transaction.stored_unassociated_amount):
+        expected = transactions[transaction.id]
+        if (associated_amount, unassociated_amount) != (expected, transaction.amount - expected):
+            differences.append(f'Transaktion {transaction}: zugewiesen {associated_amount} statt {expected}, offen '
+                               f'{unassociated_amount} statt {transaction.amount - expected}')
+    return differences
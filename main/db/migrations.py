@@ -0,0 +1,80 @@
+import functools
+import logging
+from datetime import datetime
+from typing import List, Tuple
+
+from sqlalchemy import text
+
+from main.db import addresses, balances
+from main.db.orm import sess
+
+SCHEMA_VERSION_TABLE = 'schema_version'
+
+
+# the indexes of migration 2: name, table and columns
+FOREIGN_KEY_AND_BALANCE_INDEXES = [
+    ('ix_addresses_lookup', 'addresses', ('last_name', 'first_name', 'street', 'additional', 'city', 'zip_')),
+    ('ix_transactions_stored_unassociated_amount', 'transactions', ('stored_unassociated_amount',)),
+    ('ix_orders_address_id', 'orders', ('address_id',)),
+    ('ix_orders_customer_id', 'orders', ('customer_id',)),
+    ('ix_orders_stored_unpaid_amount', 'orders', ('stored_unpaid_amount',)),
+    ('ix_payers_customer_id', 'payers', ('customer_id',)),
+    ('ix_products_school_id', 'products', ('school_id',)),
+    ('ix_order_transactions_transaction_id', 'order_transactions', ('transaction_id',)),
+    ('ix_reminders_order_id', 'reminders', ('order_id',)),
+    ('ix_variants_product_id', 'variants', ('product_id',)),
+    ('ix_line_items_order_id', 'line_items', ('order_id',)),
+    ('ix_line_items_variant_id', 'line_items', ('variant_id',)),
+]
+
+
+def create_indexes(indexes: List[Tuple[str, str, Tuple[str, ...]]]):
+    """Creates the `indexes` (name, table and columns) which do not exist yet."""
+    for name, table, columns in indexes:
+        sess.execute(text(f'CREATE INDEX IF NOT EXISTS {name} ON {table} ({", ".join(columns)})'))
+
+
+# The migrations in the order they are applied. The schema version of a database is the number of migrations applied
+# to it; databases created before the migrations have version 0. `update_schemas` creates new databases with the
+# tables of the current models and migrates them as well, so each migration must tolerate changes which are already
+# there. A migration spells out its DDL instead of reading it from the models, which keep changing: an index added to
+# a model needs a migration of its own.
+MIGRATIONS = [
+    ('Gespeicherte Salden der Bestellungen und Transaktionen', balances.install),
+    ('Indizes der Fremdschlüssel, der Salden und der Adresssuche',
+     functools.partial(create_indexes, FOREIGN_KEY_AND_BALANCE_INDEXES)),
+    ('Fingerabdrücke der Adressen, doppelte Adressen zusammengeführt', addresses.install),
+]
+
+
+def get_version() -> int:
+    sess.execute(text(f'CREATE TABLE IF NOT EXISTS {SCHEMA_VERSION_TABLE} '
+                      f'(version INTEGER PRIMARY KEY, description TEXT NOT NULL, migrated_at TEXT NOT NULL)'))
+    return sess.execute(text(f'SELECT MAX(version) FROM {SCHEMA_VERSION_TABLE}')).scalar() or 0
+
+
+def migrate() -> List[str]:
+    """
+    Applies the migrations the database is missing, each within a database transaction of its own.
+
+    Returns:
+        The descriptions of the migrations applied.
+    """
+    applied = []
+    try:
+        for version, (description, migration) in enumerate(MIGRATIONS, start=1):
+            if version <= get_version():
+                continue
+            logging.info(f'Migriere die Datenbank auf Version {version}: {description}.')
+            migration()
+            sess.execute(text(f'INSERT INTO {SCHEMA_VERSION_TABLE} (version, description, migrated_at) '
+                              f'VALUES (:version, :description, :migrated_at)'),
+                         {'version': version, 'description': description,
+                          'migrated_at': datetime.now().isoformat(timespec='seconds')})
+            sess.commit()
+            applied.append(description)
+        sess.commit()
+    except BaseException:
+        sess.rollback()
+        raise
+    return applied
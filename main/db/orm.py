@@ -6,19 +6,49 @@ from sqlalchemy.ext.hybrid import hybrid_property
 from sqlalchemy.orm import relationship, sessionmaker, scoped_session
 from main import utils
 import datetime, enum
+from typing import List
 
 from main.conf import paths, settings
 
 table_names = {'OrderTransaction': 'order_transactions'}
 
+# Storage profiles, selected with "storage_profile" in the settings. Their PRAGMAs are applied to every connection.
+STORAGE_PROFILES = {
+    # SQLite's defaults: a rollback journal which is synced with every commit. A commit survives a power loss, but
+    # every commit waits for several fsyncs.
+    'safe': {'journal_mode': 'DELETE', 'synchronous': 'FULL', 'cache_size': -2000, 'mmap_size': 0,
+             'temp_store': 'DEFAULT'},
+    # A write-ahead log which is synced at checkpoints only. A power loss may undo the last commits, but never
+    # corrupts the database. Reading does not block writing, e.g. while "watch" runs.
+    'balanced': {'journal_mode': 'WAL', 'synchronous': 'NORMAL', 'cache_size': -65536, 'mmap_size': 268435456,
+                 'temp_store': 'MEMORY'},
+    # Never synced. A crash of the program loses nothing, but a power loss or a crash of the operating system may
+    # corrupt the database. Only for databases which can be imported again, e.g. the first import of a whole shop.
+    'fast': {'journal_mode': 'WAL', 'synchronous': 'OFF', 'cache_size': -262144, 'mmap_size': 1073741824,
+             'temp_store': 'MEMORY'},
+}
+storage_profile = settings.get('storage_profile', 'safe')
+if storage_profile not in STORAGE_PROFILES:
+    raise utils.Error(f'Unbekanntes Speicherprofil "{storage_profile}" in den Einstellungen. Mögliche Profile: '
+                      f'{", ".join(STORAGE_PROFILES)}.')
+
 config_url = f'sqlite:///{paths["sqlite"]}?check_same_thread=False'
 engine = create_engine(config_url, echo=False)
 if 'sqlite' in config_url:
     def _fk_pragma_on_connect(dbapi_con, con_record):  # noqa
+        # pysqlite's own transaction handling breaks SAVEPOINTs, so SQLAlchemy emits BEGIN itself (see _begin)
+        dbapi_con.isolation_level = None
         dbapi_con.execute('PRAGMA FOREIGN_KEYS=ON')
+        for pragma, value in STORAGE_PROFILES[storage_profile].items():
+            dbapi_con.execute(f'PRAGMA {pragma}={value}')
+
+
+    def _begin(conn):
+        conn.execute('BEGIN')
 
 
     event.listen(engine, 'connect', _fk_pragma_on_connect)
+    event.listen(engine, 'begin', _begin)
 
 size_names = utils.import_list(f'{paths["resources"]}/sizes.list')
 color_names = utils.import_list(f'{paths["resources"]}/colors.list')
@@ -74,6 +104,8 @@ class Address(Base):
     street = Column(String, nullable=False)
     # house nr is written in additional
     additional = Column(String)
+    # hash of the normalised fields, addresses are looked up and deduplicated by it (see `addresses.fingerprint`)
+    fingerprint = Column(String, nullable=False, index=True, unique=True)
 
     orders = relationship('Order', back_populates='address')
 
@@ -87,13 +119,17 @@ class Order(Base, NamedClass):
 
     id = Column(Integer, primary_key=True, autoincrement=True)
     nr = Column(String, unique=True, nullable=False)
-    customer_id = Column(Integer, ForeignKey(f'{Customer.__tablename__}.id'), nullable=False)
-    address_id = Column(Integer, ForeignKey(f'{Address.__tablename__}.id'), nullable=False)
+    customer_id = Column(Integer, ForeignKey(f'{Customer.__tablename__}.id'), nullable=False, index=True)
+    address_id = Column(Integer, ForeignKey(f'{Address.__tablename__}.id'), nullable=False, index=True)
     created_at = Column(Date, nullable=False)
     discount = Column(Integer, default=0)
     note = Column(String)
     shipping = Column(Integer, default=0)
     decree = Column(Integer, default=0)
+    # maintained by the triggers of `balances`, the expressions of the balance properties below use them
+    stored_amount = Column(Integer, nullable=False, default=0, server_default='0')
+    stored_paid_amount = Column(Integer, nullable=False, default=0, server_default='0')
+    stored_unpaid_amount = Column(Integer, nullable=False, default=0, server_default='0', index=True)
 
     customer = relationship('Customer', back_populates='orders')
     order_transactions = relationship('OrderTransaction', back_populates='order', cascade="all, delete-orphan")
@@ -114,9 +150,7 @@ class Order(Base, NamedClass):
 
     @amount.expression
     def amount(cls) -> int:
-        select1 = select([func.total(LineItem.amount * LineItem.quantity)]).where(
-            LineItem.order_id == cls.id).correlate_except(LineItem).label('amount')
-        return select1 - cls.discount + cls.shipping
+        return cls.stored_amount
 
     @hybrid_property
     def paid_amount(self) -> int:
@@ -124,17 +158,24 @@ class Order(Base, NamedClass):
 
     @paid_amount.expression
     def paid_amount(cls):
-        return select([func.total(OrderTransaction.amount)]).where(
-            OrderTransaction.order_id == cls.id).correlate_except(OrderTransaction).label('covered') + cls.decree
+        return cls.stored_paid_amount
 
     @hybrid_property
     def is_paid(self) -> bool:
         return self.paid_amount >= self.amount
 
+    @is_paid.expression
+    def is_paid(cls):
+        return cls.stored_unpaid_amount <= 0
+
     @hybrid_property
     def unpaid_amount(self) -> int:
         return self.amount - self.paid_amount
 
+    @unpaid_amount.expression
+    def unpaid_amount(cls):
+        return cls.stored_unpaid_amount
+
 
 class Transaction(Base, NamedClass):
     class_name = 'Transaktion'
@@ -148,6 +189,9 @@ class Transaction(Base, NamedClass):
     amount = Column(Integer, nullable=False)
     date_ = Column(Date, nullable=False)
     associate = Column(Boolean, default=True)
+    # maintained by the triggers of `balances`, the expressions of the balance properties below use them
+    stored_associated_amount = Column(Integer, nullable=False, default=0, server_default='0')
+    stored_unassociated_amount = Column(Integer, nullable=False, default=0, server_default='0', index=True)
 
     __table_args__ = (UniqueConstraint('name', 'iban', 'reference', 'date_', 'amount'),
                       )
@@ -173,8 +217,7 @@ class Transaction(Base, NamedClass):
 
     @associated_amount.expression
     def associated_amount(cls):
-        return select([func.total(OrderTransaction.amount)]).where(OrderTransaction.transaction_id == cls.id).label(
-            'associated_amount')
+        return cls.stored_associated_amount
 
     @hybrid_property
     def associated_completely(self) -> bool:
@@ -184,12 +227,16 @@ class Transaction(Base, NamedClass):
 
     @associated_completely.expression
     def associated_completely(cls):
-        return cls.amount - cls.associated_amount == 0
+        return cls.stored_unassociated_amount == 0
 
     @hybrid_property
     def unassociated_amount(self) -> int:
         return self.amount - self.associated_amount
 
+    @unassociated_amount.expression
+    def unassociated_amount(cls):
+        return cls.stored_unassociated_amount
+
     @property
     def description(self) -> str:
         desc = f'###################\n' \
@@ -211,7 +258,7 @@ class OrderTransaction(Base, NamedClass):
 
     __tablename__ = table_names['OrderTransaction']
     order_id = Column(Integer, ForeignKey(f'{Order.__tablename__}.id'), primary_key=True)
-    transaction_id = Column(Integer, ForeignKey(f'{Transaction.__tablename__}.id'), primary_key=True)
+    transaction_id = Column(Integer, ForeignKey(f'{Transaction.__tablename__}.id'), primary_key=True, index=True)
     amount = Column(Integer, nullable=False)
 
     order = relationship('Order', back_populates='order_transactions')
@@ -221,10 +268,24 @@ class OrderTransaction(Base, NamedClass):
         return f'{self.order}-{self.transaction}'
 
 
+class Payer(Base):
+    """A customer who paid from an IBAN (or, for transactions without IBAN, under a name), see `payer_index`."""
+    __tablename__ = 'payers'
+    key = Column(String, primary_key=True)
+    customer_id = Column(Integer, ForeignKey(f'{Customer.__tablename__}.id'), primary_key=True, index=True)
+    # the number of associations of the payer's transactions with the customer's orders
+    payments = Column(Integer, nullable=False, default=0)
+
+    customer = relationship('Customer')
+
+    def __repr__(self):
+        return f'{self.key}-{self.customer}'
+
+
 class Product(Base):
     __tablename__ = 'products'
     id = Column(Integer, primary_key=True, autoincrement=True)
-    school_id = Column(Integer, ForeignKey(f'{School.__tablename__}.id'))
+    school_id = Column(Integer, ForeignKey(f'{School.__tablename__}.id'), index=True)
     shopify_id = Column(Integer, unique=True)
     name = Column(String, nullable=False)
     created_at = Column(Date, nullable=False)
@@ -243,7 +304,7 @@ class Variant(Base):
     __tablename__ = 'variants'
     id = Column(Integer, primary_key=True, autoincrement=True)
     shopify_id = Column(Integer, unique=True)
-    product_id = Column(Integer, ForeignKey(f'{Product.__tablename__}.id'), nullable=False)
+    product_id = Column(Integer, ForeignKey(f'{Product.__tablename__}.id'), nullable=False, index=True)
     size = Column(String)
     color = Column(String)
     active = Column(Boolean, nullable=False)
@@ -273,8 +334,8 @@ class Variant(Base):
 class LineItem(Base):
     __tablename__ = 'line_items'
     id = Column(Integer, primary_key=True, autoincrement=True)
-    order_id = Column(Integer, ForeignKey(f'{Order.__tablename__}.id'), nullable=False)
-    variant_id = Column(Integer, ForeignKey(f'{Variant.__tablename__}.id'), nullable=False)
+    order_id = Column(Integer, ForeignKey(f'{Order.__tablename__}.id'), nullable=False, index=True)
+    variant_id = Column(Integer, ForeignKey(f'{Variant.__tablename__}.id'), nullable=False, index=True)
     quantity = Column(Integer, default=1)
     amount = Column(Integer, nullable=False)
 
@@ -296,13 +357,22 @@ class Reminder(Base):
     __tablename__ = 'reminders'
     id = Column(Integer, primary_key=True, autoincrement=True, )
     date = Column(Date, default=datetime.date.today(), server_default=text("(date('now'))"))
-    order_id = Column(Integer, ForeignKey(f'{Order.__tablename__}.id'))
+    order_id = Column(Integer, ForeignKey(f'{Order.__tablename__}.id'), index=True)
 
     order = relationship('Order', back_populates='reminders')
 
 
-def update_schemas():
+def update_schemas() -> List[str]:
+    """
+    Creates missing tables and upgrades the database to the current schema version (see `migrations`).
+
+    Returns:
+        The descriptions of the migrations applied.
+    """
     Base.metadata.create_all(engine)
+    # the migrations are defined on top of the models
+    from main.db import migrations
+    return migrations.migrate()
 
 
 session_factory = sessionmaker(bind=engine)
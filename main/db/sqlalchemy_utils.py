@@ -1,4 +1,11 @@
+import itertools
+from typing import Iterable, Iterator, List, Union, Tuple, Dict, Set
+
+from sqlalchemy import func, inspect
+from sqlalchemy.ext.compiler import compiles
 from sqlalchemy.orm import Query
+from sqlalchemy.orm.exc import NoResultFound
+from sqlalchemy.sql.expression import Insert
 import sqlite3
 
 from main.db.orm import sess
@@ -27,5 +34,258 @@ def get_or_create(model,**kwargs):
     return instance
 
 
+# SQLite allows at most 999 variables per statement (before version 3.32)
+MAX_VARIABLES = 900
+
+
+def chunked(values: Iterable, size=MAX_VARIABLES) -> Iterator[List]:
+    """Splits `values` into lists of at most `size` items, by default small enough to be bound to one statement."""
+    iterator = iter(values)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def get_many(model, key: Union[str, tuple], values: Iterable, by: str = None) -> Dict:
+    """
+    Returns the instances of `model` whose `key` is one of `values`, by their key. Values without an instance are
+    left out.
+
+    Args:
+        key: The name of an attribute or a tuple of attribute names, whose values are tuples then.
+        by: For keys consisting of several attributes, the attribute the query filters on (by default the first one).
+            The instances found that way are matched to `values` in Python.
+    """
+    values = set(values)
+    if isinstance(key, tuple):
+        index = key.index(by) if by else 0
+        by = key[index]
+        by_values = {value[index] for value in values}
+    else:
+        by = key
+        by_values = values
+    instances = {}
+    for instance in filter_in(model, by, by_values):
+        value = ImportCache.key_of(instance, key)
+        if value in values:
+            instances.setdefault(value, instance)
+    return instances
+
+
+def get_or_create_many(model, key: Union[str, tuple], values: Iterable, by: str = None) -> Dict:
+    """
+    Like `get_many`, but creates an instance for each value without one (with only its key set) and adds it to the
+    session.
+
+    """
+    values = set(values)
+    instances = get_many(model, key, values, by)
+    for value in values - instances.keys():
+        attributes = dict(zip(key, value)) if isinstance(key, tuple) else {key: value}
+        instances[value] = model(**attributes)
+        sess.add(instances[value])
+    return instances
+
+
+# the conflict clause of an INSERT statement, e.g. table.insert(sqlite_on_conflict='ON CONFLICT (id) DO NOTHING')
+Insert.argument_for('sqlite', 'on_conflict', None)
+
+
+@compiles(Insert, 'sqlite')
+def compile_on_conflict(insert: Insert, compiler, **kwargs) -> str:
+    statement = compiler.visit_insert(insert, **kwargs)
+    on_conflict = insert.dialect_options['sqlite']['on_conflict']
+    return f'{statement} {on_conflict}' if on_conflict else statement
+
+
+def upsert(model, rows: List[dict], index_elements: Tuple[str, ...],
+           update: Union[Iterable[str], Dict[str, str]] = ()) -> int:
+    """
+    Inserts `rows` with one statement. A row which conflicts with an existing one on the unique index of
+    `index_elements` updates the existing row instead (SQLite's "ON CONFLICT ... DO UPDATE").
+
+    Args:
+        rows: Dicts with the same keys, the values of the columns. Columns which are left out get their defaults.
+        update: The columns an existing row gets from the conflicting row, or SQL expressions by column names, in
+            which "excluded.<column>" is the value of the conflicting row, e.g. {"n": "n + excluded.n"}. Nothing is
+            updated if empty, i.e. conflicting rows are skipped.
+
+    Returns:
+        The number of inserted or updated rows.
+    """
+    if not rows:
+        return 0
+    if not isinstance(update, dict):
+        update = {column: f'excluded.{quoted(column)}' for column in update}
+    action = f'UPDATE SET {", ".join(f"{quoted(column)} = {expression}" for column, expression in update.items())}' \
+        if update else 'NOTHING'
+    insert = model.__table__.insert(
+        sqlite_on_conflict=f'ON CONFLICT ({", ".join(map(quoted, index_elements))}) DO {action}')
+    return sess.execute(insert, rows).rowcount
+
+
+def quoted(column: str) -> str:
+    """Quotes a column name, e.g. "key", which is a keyword of SQL."""
+    return f'"{column}"'
+
+
+def filter_in(model, attribute: str, values: Iterable) -> List:
+    """
+    Returns all instances of `model` whose `attribute` is one of `values`. Large sets of values are split into several
+    queries.
+
+    """
+    column = getattr(model, attribute)
+    instances = []
+    for chunk in chunked(set(values)):
+        instances += sess.query(model).filter(column.in_(chunk)).all()
+    return instances
+
+
+class ImportCache:
+    """
+    Identity cache for looking up instances by a natural key (e.g. `shopify_id`, `name` or the fingerprint of an
+    address) during one import run.
+
+    A key is the name of an attribute or a tuple of attribute names. `warm` loads the instances for many key values with
+    one query. Values which were looked up but not found are remembered as missing, so asking for them again does not
+    hit the database either. Hence, instances created during the run must be registered with `add`.
+
+    Used as a context manager, the session does not expire the cached instances on commit while the import runs.
+    Otherwise, every commit would make each cached instance reload itself with a query of its own.
+
+    """
+
+    def __init__(self):
+        self._instances: Dict[Tuple[type, Union[str, tuple]], Dict] = {}
+        self._missing: Dict[Tuple[type, Union[str, tuple]], Set] = {}
+        self._complete: Set[Tuple[type, Union[str, tuple]]] = set()
+        self.hits = 0
+        self.misses = 0
+        self.queries = 0
+
+    def __enter__(self):
+        self._expire_on_commit = sess.expire_on_commit
+        sess.expire_on_commit = False
+        return self
+
+    def __exit__(self, *args):
+        sess.expire_on_commit = self._expire_on_commit
+        sess.expire_all()
+
+    @staticmethod
+    def key_of(instance, key: Union[str, tuple]):
+        if isinstance(key, tuple):
+            return tuple(getattr(instance, attribute) for attribute in key)
+        return getattr(instance, key)
+
+    def _maps(self, model, key) -> Tuple[Dict, Set]:
+        return self._instances.setdefault((model, key), {}), self._missing.setdefault((model, key), set())
+
+    def get(self, model, key: Union[str, tuple], value, require_result=False):
+        instances, missing = self._maps(model, key)
+        if value in instances:
+            self.hits += 1
+            return instances[value]
+        if value in missing or (model, key) in self._complete:
+            self.hits += 1
+            instance = None
+        else:
+            self.misses += 1
+            self.queries += 1
+            if isinstance(key, tuple):
+                instance = get(model, **dict(zip(key, value)))
+            else:
+                instance = get(model, **{key: value})
+            if instance is None:
+                missing.add(value)
+            else:
+                instances[value] = instance
+        if instance is None and require_result:
+            raise NoResultFound(f'{model.__name__} mit {key}={value} existiert nicht.')
+        return instance
+
+    def get_or_create(self, model, key: str, value):
+        instance = self.get(model, key, value)
+        if instance is None:
+            instance = model(**{key: value})
+            sess.add(instance)
+            self.add(instance, key)
+        return instance
+
+    def add(self, instance, key: Union[str, tuple]):
+        instances, missing = self._maps(type(instance), key)
+        value = self.key_of(instance, key)
+        instances[value] = instance
+        missing.discard(value)
+
+    def evict(self, model, key: Union[str, tuple], values: Iterable):
+        """
+        Forgets the instances of rows which were deleted in bulk (e.g. `query.delete()`, which leaves them in the
+        session) and removes them from the session, so they are not handed out anymore.
+
+        """
+        instances, missing = self._maps(model, key)
+        for value in values:
+            instance = instances.pop(value, None)
+            if instance is not None and instance in sess:
+                sess.expunge(instance)
+            missing.add(value)
+
+    def warm(self, model, key: Union[str, tuple], values: Iterable, by: str = None):
+        """
+        Loads the instances for all `values` which are not cached yet.
+
+        Args:
+            by: For keys consisting of several attributes, the attribute the query filters on, e.g. the last name of
+                an address. All instances loaded that way are cached.
+        """
+        instances, missing = self._maps(model, key)
+        if (model, key) in self._complete:
+            return
+        unknown = {value for value in values if value not in instances and value not in missing}
+        if not unknown:
+            return
+        if isinstance(key, tuple):
+            index = key.index(by)
+            by_values = {value[index] for value in unknown}
+        else:
+            by = key
+            by_values = unknown
+        self.queries += -(-len(by_values) // MAX_VARIABLES)
+        for instance in filter_in(model, by, by_values):
+            instances.setdefault(self.key_of(instance, key), instance)
+        missing |= unknown - instances.keys()
+
+    def warm_all(self, model, key: str):
+        """Loads all instances of a (small) table, e.g. the schools."""
+        instances, missing = self._maps(model, key)
+        self.queries += 1
+        for instance in sess.query(model).all():
+            instances.setdefault(self.key_of(instance, key), instance)
+        missing.clear()
+        self._complete.add((model, key))
+
+    def forget_transient(self):
+        """Removes the instances which were discarded by a rollback."""
+        for model_key, instances in self._instances.items():
+            for value, instance in list(instances.items()):
+                if inspect(instance).transient:
+                    del instances[value]
+                    self._missing[model_key].add(value)
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def __str__(self):
+        return f'{self.hits} Treffer, {self.misses} Fehlschläge ({self.hit_rate:.1%} Trefferquote), ' \
+               f'{self.queries} Abfragen'
+
+
 def count(model) -> int:
-    return len(sess.query(model).all())
+    """Counts the rows of the model's table with "SELECT COUNT(*)", without loading them."""
+    return sess.query(func.count()).select_from(model).scalar()
@@ -0,0 +1,147 @@
+import re
+from collections import Counter, defaultdict
+from itertools import combinations
+from typing import Dict, Iterable, List, NamedTuple, Optional, Set
+
+from main.importer.order_balances import OrderBalance
+
+# weight of an amount which is paid exactly by a single order (by several orders of one customer)
+SINGLE_ORDER_WEIGHT = 0.4
+SUBSET_WEIGHT = 0.3
+# weight of the share of the customer's name found in the transaction's name
+NAME_WEIGHT = 0.5
+# bonus of the only proposal for a transaction
+UNIQUE_WEIGHT = 0.1
+# the open orders of a customer which are combined to pay a transaction at most
+MAX_SUBSET_ORDERS = 12
+
+UMLAUTS = str.maketrans({'ä': 'ae', 'ö': 'oe', 'ü': 'ue', 'ß': 'ss'})
+IGNORED_TOKENS = {'herr', 'herrn', 'frau', 'dr', 'und', 'fam', 'familie'}
+
+
+class AmountMatch(NamedTuple):
+    orders: List[OrderBalance]
+    confidence: float
+
+    def __str__(self):
+        return f'{",".join(order.nr for order in self.orders)} (Konfidenz {self.confidence:.0%})'
+
+
+class AmountMatcher:
+    """
+    Proposes the open orders a transaction without an order nr pays for, by the transaction's amount and name.
+
+    The open orders are indexed by their unpaid amount, by their customer and by the tokens of their customers' names.
+    A proposal is either a single order whose unpaid amount is the transaction's amount (a lookup) or a combination of
+    up to `max_subset_size` open orders of a customer named in the transaction which add up to it (a search over at
+    most `MAX_SUBSET_ORDERS` orders of each such customer).
+
+    The confidence of a proposal is the sum of
+        - `SINGLE_ORDER_WEIGHT` (`SUBSET_WEIGHT` for several orders),
+        - `NAME_WEIGHT` times the share of the customer's name found in the transaction's name (1 for customers the
+          payer is known to have paid for, see `payer_index`), reduced by the same share of the best competing
+          proposal,
+        - `UNIQUE_WEIGHT` if there is no competing proposal.
+
+    """
+
+    def __init__(self, orders: Iterable[OrderBalance], max_subset_size=3):
+        self.max_subset_size = max_subset_size
+        self.by_amount: Dict[int, Set[OrderBalance]] = defaultdict(set)
+        self.by_customer: Dict[int, Set[OrderBalance]] = defaultdict(set)
+        self.customers_by_token: Dict[str, Set[int]] = defaultdict(set)
+        self.customer_tokens: Dict[int, Set[str]] = {}
+        self.order_tokens: Dict[int, List[Set[str]]] = {}
+        # the unpaid amount an order is indexed by
+        self.indexed_amounts: Dict[int, int] = {}
+        for order in orders:
+            self.add(order)
+
+    def add(self, order: OrderBalance):
+        if order.unpaid_amount <= 0:
+            return
+        self.indexed_amounts[order.id] = order.unpaid_amount
+        self.by_amount[order.unpaid_amount].add(order)
+        self.by_customer[order.customer_id].add(order)
+        if order.id not in self.order_tokens:
+            self.order_tokens[order.id] = [name_tokens(name) for name in order.names]
+        if order.customer_id not in self.customer_tokens:
+            names = self.order_tokens[order.id]
+            self.customer_tokens[order.customer_id] = names[0] or set().union(*names)
+            for token in set().union(*names):
+                self.customers_by_token[token].add(order.customer_id)
+
+    def remove(self, order: OrderBalance):
+        amount = self.indexed_amounts.pop(order.id, None)
+        if amount is not None:
+            self.by_amount[amount].discard(order)
+            self.by_customer[order.customer_id].discard(order)
+
+    def update(self, order: OrderBalance):
+        """Re-indexes an order whose unpaid amount changed."""
+        self.remove(order)
+        self.add(order)
+
+    def match(self, name: str, amount: int, customer_ids: Set[int] = frozenset()) -> Optional[AmountMatch]:
+        """
+        Returns the proposal with the highest confidence, None if no open orders add up to `amount`. `customer_ids`
+        are the customers the payer paid for before, their open orders are proposed as if they were named.
+
+        """
+        tokens = name_tokens(name)
+        customers = self.named_customers(tokens) | {customer_id for customer_id in customer_ids
+                                                    if self.by_customer.get(customer_id)}
+        # single orders of customers who are not named have no share of the name and are only counted
+        singles = self.by_amount.get(amount, ())
+        proposals = [[order] for order in sorted((order for order in singles if order.customer_id in customers),
+                                                 key=lambda order: order.nr)]
+        anonymous = [order for order in singles if order.customer_id not in customers] \
+            if len(proposals) < len(singles) else []
+        for customer_id in customers:
+            orders = sorted((order for order in self.by_customer[customer_id] if order.unpaid_amount < amount),
+                            key=lambda order: order.nr)[:MAX_SUBSET_ORDERS]
+            for size in range(2, self.max_subset_size + 1):
+                proposals += [list(subset) for subset in combinations(orders, size)
+                              if sum(order.unpaid_amount for order in subset) == amount]
+        if anonymous:
+            proposals.append([min(anonymous, key=lambda order: order.nr)])
+        if not proposals:
+            return None
+        shares = [self.name_share(proposal, tokens, customer_ids) for proposal in proposals]
+        # the best competitor of each proposal is the proposal with the highest share, or the second highest one
+        ranked = sorted(range(len(shares)), key=shares.__getitem__, reverse=True)
+        unique = len(proposals) == 1 and len(anonymous) <= 1
+        best = None
+        for i, (proposal, share) in enumerate(zip(proposals, shares)):
+            competitor_share = 0 if len(ranked) == 1 else shares[ranked[1] if i == ranked[0] else ranked[0]]
+            confidence = (SINGLE_ORDER_WEIGHT if len(proposal) == 1 else SUBSET_WEIGHT) \
+                + NAME_WEIGHT * share * (1 - competitor_share) + (UNIQUE_WEIGHT if unique else 0)
+            if best is None or confidence > best.confidence:
+                best = AmountMatch(sorted(proposal, key=lambda order: order.nr), round(confidence, 4))
+        return best
+
+    def named_customers(self, tokens: Set[str]) -> Set[int]:
+        """
+        Returns the customers with open orders of whom more than half of the name is found in `tokens`. Tokens of the
+        billing address' name of their first order count as well.
+
+        """
+        hits = Counter(customer_id for token in tokens for customer_id in self.customers_by_token.get(token, ()))
+        return {customer_id for customer_id, n_hits in hits.items()
+                if self.by_customer[customer_id] and n_hits / len(self.customer_tokens[customer_id]) > 0.5}
+
+    def name_share(self, orders: List[OrderBalance], tokens: Set[str], customer_ids: Set[int] = frozenset()) -> float:
+        """
+        The share of the orders' customer names (or billing address names) found in `tokens`, on average. The names of
+        `customer_ids` count as found completely.
+
+        """
+        shares = [1 if order.customer_id in customer_ids else
+                  max((len(name & tokens) / len(name) for name in self.order_tokens[order.id] if name), default=0)
+                  for order in orders]
+        return sum(shares) / len(shares)
+
+
+def name_tokens(name: Optional[str]) -> Set[str]:
+    tokens = re.split(r'[^a-z0-9]+', (name or '').lower().translate(UMLAUTS))
+    return {token for token in tokens if len(token) > 1 and token not in IGNORED_TOKENS}
@@ -0,0 +1,267 @@
+import json
+import logging
+from typing import Dict, Iterator, List, Tuple, Union
+
+from main.db.addresses import fingerprint
+from main.db.orm import Address, Customer, LineItem, Order, School, Variant, sess
+from main.db.sqlalchemy_utils import ImportCache, get_many, upsert
+from main.importer import shopify_importer
+from main.importer.shopify_fetcher import PAGE_LIMIT
+from main.importer.shopify_records import ShopifyOrder, decode_cancelled_order, decode_order, decode_product
+from main.utils import Error, to_cent
+
+PARENT_ID = '__parentId'
+
+PRODUCT = 'Product'
+VARIANT = 'ProductVariant'
+ORDER = 'Order'
+LINE_ITEM = 'LineItem'
+
+# batches yielded by `read_batches`
+PRODUCTS = 'products'
+ARCHIVED_PRODUCTS = 'archived_products'
+ORDERS = 'orders'
+CANCELLED_ORDERS = 'cancelled_orders'
+
+
+class BulkFormatError(Error):
+    pass
+
+
+def import_file(path: str, batch_size=PAGE_LIMIT):
+    """
+    Imports the products and orders of a JSONL file as written by a Shopify bulk operation.
+
+    The file is parsed line by line and imported in batches of `batch_size` products or orders, so the memory used
+    does not depend on the size of the file. The orders of a batch are written with a few statements per table (see
+    `import_order_batch`). The rows created are the same as those of `shopify_importer.import_all`.
+
+    """
+    print(f'Importiere Bulk-Export "{path}".')
+    n_imported = 0
+    with ImportCache() as cache:
+        cache.warm_all(School, 'name')
+        for kind, batch in read_batches(path, batch_size):
+            if kind in (PRODUCTS, ARCHIVED_PRODUCTS):
+                shopify_importer.import_product_page([decode_product(attributes) for attributes in batch], cache,
+                                                     active=kind == PRODUCTS)
+            elif kind == ORDERS:
+                import_order_batch(shopify_importer.with_address([decode_order(attributes) for attributes in batch]), cache)
+            else:
+                # the summary of the deletion gets a line of its own below the progress
+                print()
+                cancelled = map(decode_cancelled_order, batch)
+                shopify_importer.delete_cancelled_orders({order.name: order.updated_at for order in cancelled},
+                                                         cache=cache)
+            n_imported += len(batch)
+            print(f'\r{n_imported} Produkte und Bestellungen importiert', end='', flush=True)
+    print()
+    logging.info(f'Cache des Bulk-Imports: {cache}')
+
+
+def import_order_batch(shopify_orders: List[ShopifyOrder], cache: ImportCache):
+    """
+    Imports a batch of orders in a single transaction, with one INSERT per table for the new customers, addresses and
+    line items and one upsert (see `sqlalchemy_utils.upsert`) for all orders. The rows written are cached, so later
+    batches find them.
+
+    Orders whose products or variants are not known yet are imported one by one by
+    `shopify_importer.import_order_page`, which creates stubs for them.
+
+    """
+    shopify_importer.warm_cache(shopify_orders, cache)
+    known, unknown = [], []
+    for shopify_order in shopify_orders:
+        (known if shopify_importer.references_known(shopify_order, cache) else unknown).append(shopify_order)
+    customers, addresses = {}, {}
+    for shopify_order in known:
+        customer = shopify_order.customer
+        if cache.get(Customer, 'shopify_id', customer.id) is None:
+            customers[customer.id] = {'shopify_id': customer.id, 'email': customer.email,
+                                      'first_name': customer.first_name, 'last_name': customer.last_name}
+        key = shopify_importer.address_key(shopify_order.billing_address)
+        key_fingerprint = fingerprint(**dict(zip(shopify_importer.ADDRESS_KEY, key)))
+        if cache.get(Address, 'fingerprint', key_fingerprint) is None:
+            addresses[key_fingerprint] = dict(zip(shopify_importer.ADDRESS_KEY, key), fingerprint=key_fingerprint)
+    insert_new(Customer, 'shopify_id', customers, cache)
+    insert_new(Address, 'fingerprint', addresses, cache)
+    orders = {}
+    new_orders = {}
+    for shopify_order in known:
+        order = cache.get(Order, 'nr', shopify_order.name)
+        if order is None:
+            # a later duplicate of a new order only updates it, like in `shopify_importer.upsert_order`
+            new_orders.setdefault(shopify_order.name, shopify_order)
+        else:
+            sess.expire(order)
+        first = new_orders.get(shopify_order.name, shopify_order)
+        address = cache.get(Address, 'fingerprint', shopify_importer.address_fingerprint(shopify_order.billing_address))
+        orders[shopify_order.name] = {
+            'nr': shopify_order.name, 'customer_id': cache.get(Customer, 'shopify_id', first.customer.id).id,
+            'address_id': address.id, 'created_at': shopify_importer.to_date(first.created_at),
+            'discount': to_cent(shopify_order.total_discounts), 'shipping': to_cent(shopify_order.shipping),
+            'note': shopify_importer.get_note(shopify_order)}
+    # the customer and the creation date of an existing order are kept
+    upsert(Order, list(orders.values()), ('nr',), ('address_id', 'discount', 'shipping', 'note'))
+    for order in get_many(Order, 'nr', new_orders).values():
+        cache.add(order, 'nr')
+    line_items = [{'order_id': cache.get(Order, 'nr', nr).id,
+                   'variant_id': cache.get(Variant, 'shopify_id', shopify_line_item.variant_id).id,
+                   'quantity': int(shopify_line_item.quantity), 'amount': to_cent(shopify_line_item.price)}
+                  for nr, shopify_order in new_orders.items() for shopify_line_item in shopify_order.line_items]
+    if line_items:
+        sess.execute(LineItem.__table__.insert(), line_items)
+    sess.commit()
+    if unknown:
+        shopify_importer.import_order_page(unknown, cache)
+
+
+def insert_new(model, key: str, rows: Dict, cache: ImportCache):
+    """Inserts the rows of new instances of `model` by their `key` and caches the instances."""
+    if not rows:
+        return
+    upsert(model, list(rows.values()), (key,))
+    for instance in get_many(model, key, rows).values():
+        cache.add(instance, key)
+
+
+def read_batches(path: str, batch_size=PAGE_LIMIT) -> Iterator[Tuple[str, List[dict]]]:
+    """
+    Yields batches of products and orders in the format of the REST API.
+
+    Products (orders) of the same kind are batched together. All pending products are yielded before the first order
+    which follows them (and vice versa), so orders find the products they reference.
+
+    """
+    batches = {PRODUCTS: [], ARCHIVED_PRODUCTS: [], ORDERS: [], CANCELLED_ORDERS: []}
+    group = None
+    for kind, resource in read_resources(path):
+        if kind_group(kind) != group:
+            for pending_kind, batch in batches.items():
+                if batch:
+                    yield pending_kind, batch
+                    batches[pending_kind] = []
+            group = kind_group(kind)
+        batch = batches[kind]
+        batch.append(resource)
+        if len(batch) >= batch_size:
+            yield kind, batch
+            batches[kind] = []
+    for kind, batch in batches.items():
+        if batch:
+            yield kind, batch
+
+
+def kind_group(kind: str) -> str:
+    return PRODUCT if kind in (PRODUCTS, ARCHIVED_PRODUCTS) else ORDER
+
+
+def read_resources(path: str) -> Iterator[Tuple[str, dict]]:
+    """
+    Assembles the products (orders) of a bulk export with their variants (line items).
+
+    A bulk export writes each node on its own line. Nodes of nested connections follow their parent and reference it
+    by "__parentId". Hence, a product (order) is complete as soon as the next top level node starts.
+
+    """
+    current: Union[Tuple[str, dict], None] = None
+    with open(path, encoding='utf-8') as f:
+        for line_nr, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                node = json.loads(line)
+                type_ = gid_type(node['id'])
+            except (ValueError, KeyError) as e:
+                raise BulkFormatError(f'Zeile {line_nr} in "{path}" ist kein gültiger Knoten: {e}')
+            if PARENT_ID in node:
+                if current is None or gid_to_id(node[PARENT_ID]) != current[1]['id']:
+                    raise BulkFormatError(f'Zeile {line_nr} in "{path}" folgt nicht auf ihr Elternobjekt.')
+                if type_ == VARIANT:
+                    current[1]['variants'].append(to_variant(node))
+                elif type_ == LINE_ITEM:
+                    current[1]['line_items'].append(to_line_item(node))
+                continue
+            if current is not None:
+                yield current
+            current = None
+            if type_ == PRODUCT:
+                status = node.get('status', 'ACTIVE')
+                if status in ('ACTIVE', 'ARCHIVED'):
+                    current = (PRODUCTS if status == 'ACTIVE' else ARCHIVED_PRODUCTS, to_product(node))
+            elif type_ == ORDER:
+                order = to_order(node)
+                current = (CANCELLED_ORDERS if order['cancelled_at'] else ORDERS, order)
+    if current is not None:
+        yield current
+
+
+def gid_type(gid: str) -> str:
+    # e.g. "gid://shopify/ProductVariant/123"
+    return gid.rsplit('/', 2)[-2]
+
+
+def gid_to_id(gid: Union[str, None]) -> Union[int, None]:
+    if not gid:
+        return None
+    return int(gid.rsplit('/', 1)[-1].split('?')[0])
+
+
+def shop_money(node: dict, field: str, default='0.00') -> str:
+    money = node.get(field) or {}
+    return (money.get('shopMoney') or {}).get('amount', default)
+
+
+def to_tags(tags: Union[List[str], str, None]) -> str:
+    if isinstance(tags, list):
+        return ', '.join(tags)
+    return tags or ''
+
+
+def to_product(node: dict) -> dict:
+    return {'id': gid_to_id(node['id']),
+            'title': node['title'],
+            'product_type': node.get('productType'),
+            'created_at': node['createdAt'],
+            'updated_at': node.get('updatedAt', node['createdAt']),
+            'tags': to_tags(node.get('tags')),
+            'variants': []}
+
+
+def to_variant(node: dict) -> dict:
+    options = [option['value'] for option in node.get('selectedOptions') or []]
+    options += [None] * (2 - len(options))
+    return {'id': gid_to_id(node['id']), 'option1': options[0], 'option2': options[1]}
+
+
+def to_address(node: Union[dict, None]) -> Union[dict, None]:
+    if node is None:
+        return None
+    return {'first_name': node.get('firstName'), 'last_name': node.get('lastName'), 'address1': node.get('address1'),
+            'address2': node.get('address2'), 'city': node.get('city'), 'zip': node.get('zip')}
+
+
+def to_order(node: dict) -> dict:
+    customer = node.get('customer') or {}
+    return {'id': gid_to_id(node['id']),
+            'name': node['name'],
+            'created_at': node['createdAt'],
+            'updated_at': node.get('updatedAt', node['createdAt']),
+            'cancelled_at': node.get('cancelledAt'),
+            'total_discounts': shop_money(node, 'totalDiscountsSet'),
+            'total_shipping_price_set': {'shop_money': {'amount': shop_money(node, 'totalShippingPriceSet')}},
+            'tags': to_tags(node.get('tags')),
+            'note': node.get('note'),
+            'billing_address': to_address(node.get('billingAddress')),
+            'shipping_address': to_address(node.get('shippingAddress')),
+            'customer': {'id': gid_to_id(customer.get('id')), 'email': customer.get('email'),
+                         'first_name': customer.get('firstName'), 'last_name': customer.get('lastName')},
+            'line_items': []}
+
+
+def to_line_item(node: dict) -> dict:
+    return {'product_id': gid_to_id((node.get('product') or {}).get('id')),
+            'variant_id': gid_to_id((node.get('variant') or {}).get('id')),
+            'title': node.get('title'),
+            'quantity': node.get('quantity', 1),
+            'price': shop_money(node, 'originalUnitPriceSet')}
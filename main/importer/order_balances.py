@@ -0,0 +1,43 @@
+from typing import Dict, Tuple
+
+from main.db.orm import Address, Customer, Order, sess
+
+
+class OrderBalance:
+    """
+    The amounts of an order the automatic association (see `transactions_importer.associate_transactions`) needs.
+    They are updated by the associations it plans.
+
+    """
+
+    def __init__(self, id_: int, nr: str, amount: int, associated_amount: int, decree: int, customer_id: int,
+                 names: Tuple[str, ...]):
+        self.id = id_
+        self.nr = nr
+        self.amount = amount
+        self.associated_amount = associated_amount
+        self.decree = decree
+        self.stored_decree = decree
+        self.customer_id = customer_id
+        # the names of the customer and of the billing address
+        self.names = names
+
+    def __repr__(self):
+        return self.nr
+
+    @property
+    def unpaid_amount(self) -> int:
+        return self.amount - self.associated_amount - self.decree
+
+
+def load_order_balances() -> Dict[str, OrderBalance]:
+    """Returns the balances of all orders by their nr, read from their stored balances (see `balances`)."""
+    rows = sess.query(Order.id, Order.nr, Order.stored_amount, Order.stored_paid_amount, Order.decree,
+                      Order.customer_id, Customer.first_name, Customer.last_name, Address.first_name,
+                      Address.last_name) \
+        .join(Customer, Order.customer_id == Customer.id) \
+        .join(Address, Order.address_id == Address.id)
+    return {nr: OrderBalance(id_, nr, amount, paid_amount - (decree or 0), decree or 0, customer_id,
+                             (f'{first_name} {last_name}', f'{address_first_name} {address_last_name}'))
+            for id_, nr, amount, paid_amount, decree, customer_id, first_name, last_name, address_first_name,
+            address_last_name in rows}
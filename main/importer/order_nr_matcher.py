@@ -0,0 +1,78 @@
+import re
+from typing import Collection, Iterable, Optional, Set
+
+from main.conf import settings
+
+# characters which are typed (or read by OCR) instead of the key of the dict
+CONFUSIONS = {'I': 'I1l|!', 'O': 'O0'}
+# letters which are written instead of the digits of an order nr, in either case
+DIGIT_LETTERS = {'O': '0', 'I': '1', 'L': '1'}
+DIGIT_TRANSLATION = str.maketrans({letter: digit for upper, digit in DIGIT_LETTERS.items()
+                                   for letter in (upper, upper.lower())})
+# characters written between the prefix and the digits of an order nr, e.g. "ABI 1234" or "ABI-1234"
+SEPARATORS = r'[\s\-./_:#]*'
+
+
+class OrderNrMatcher:
+    """
+    Finds the order nrs (e.g. "ABI1234") referenced in a transaction's reference with one pass of a single compiled
+    regular expression.
+
+    The first of `prefixes` is the prefix of the order nrs, the others are spellings of it used by customers, e.g.
+    "AB/". Letters of the prefixes match the characters they are confused with (see `CONFUSIONS`), the digits may be
+    written as "O", "I" or "L" (see `DIGIT_LETTERS`). Candidates which involve any confusion, of the prefix or of the
+    digits, count only if they are one of `known_nrs`.
+
+    """
+
+    def __init__(self, prefixes: Iterable[str] = ('ABI', 'AB/'), min_digits=4, max_digits=5,
+                 known_nrs: Optional[Collection[str]] = None):
+        prefixes = list(prefixes)
+        self.prefix = prefixes[0].upper()
+        self.prefixes = {prefix.upper() for prefix in prefixes}
+        self.min_digits = min_digits
+        self.known_nrs = known_nrs
+        # the longest prefixes first, so "AB/" is not matched as "AB" followed by a separator
+        alternatives = '|'.join(confusable(prefix) for prefix in sorted(prefixes, key=len, reverse=True))
+        digits = f'[0-9{"".join(DIGIT_LETTERS)}]{{{min_digits},{max_digits}}}'
+        self.pattern = re.compile(rf'({alternatives}){SEPARATORS}({digits})', re.IGNORECASE)
+
+    @classmethod
+    def from_settings(cls, known_nrs: Optional[Collection[str]] = None) -> 'OrderNrMatcher':
+        """Configured by "order_nr_prefixes", "order_nr_min_digits" and "order_nr_max_digits" in the settings."""
+        return cls(settings.get('order_nr_prefixes', ('ABI', 'AB/')), settings.get('order_nr_min_digits', 4),
+                   settings.get('order_nr_max_digits', 5), known_nrs)
+
+    def match(self, reference: str) -> Set[str]:
+        nrs = set()
+        for prefix, digits in self.pattern.findall(reference or ''):
+            nr = self.resolve(digits, confused=prefix.upper() not in self.prefixes)
+            if nr is not None:
+                nrs.add(nr)
+        return nrs
+
+    def resolve(self, digits: str, confused=False) -> Optional[str]:
+        """
+        Returns the order nr of the digits, which are the leading real digits by default. If there are known nrs, the
+        longest known nr the digits start with (after translating letters to digits) is preferred. Letters may be
+        dropped from the end for that, but digits never are, so "ABI12345" is not taken for "ABI1234".
+
+        Args:
+            confused: Whether the prefix in front of the digits was confused (e.g. "AB1" for "ABI"). The order nr must
+                be known then, so "AB12345" is not taken for "ABI2345" unless that order exists.
+        """
+        n_digits = len(digits) - len(digits.lstrip('0123456789'))
+        if self.known_nrs is not None:
+            for end in range(len(digits), max(n_digits, self.min_digits) - 1, -1):
+                nr = self.prefix + digits[:end].translate(DIGIT_TRANSLATION)
+                if nr in self.known_nrs:
+                    return nr
+        if confused or n_digits < self.min_digits:
+            return None
+        return self.prefix + digits[:n_digits]
+
+
+def confusable(text: str) -> str:
+    """Returns a regular expression which matches `text` with any of its characters replaced by a confusion."""
+    return ''.join(f'[{re.escape(CONFUSIONS[char])}]' if char in CONFUSIONS else re.escape(char)
+                   for char in text.upper())
@@ -0,0 +1,91 @@
+import gzip
+import hashlib
+import json
+import os
+import threading
+import urllib.parse
+from typing import Tuple, Optional
+
+from main.utils import Error
+
+RECORD = 'record'
+REPLAY = 'replay'
+MANIFEST = 'manifest.json'
+# parameters which do not change what a stream is, only which part of it is downloaded
+CURSOR_PARAMS = ('page_info', 'updated_at_min')
+
+
+class PageNotCached(Error):
+    pass
+
+
+def page_key(url: str) -> str:
+    """The resource, the sorted query parameters and the page cursor of `url`, without the shop's address."""
+    parts = urllib.parse.urlsplit(url)
+    resource = parts.path.rsplit('/', 1)[-1]
+    params = sorted(urllib.parse.parse_qsl(parts.query))
+    return f'{resource}?{urllib.parse.urlencode(params)}'
+
+
+def stream_key(url: str) -> str:
+    parts = urllib.parse.urlsplit(url)
+    resource = parts.path.rsplit('/', 1)[-1]
+    params = sorted((k, v) for k, v in urllib.parse.parse_qsl(parts.query) if k not in CURSOR_PARAMS)
+    return f'{resource}?{urllib.parse.urlencode(params)}'
+
+
+class PageCache:
+    """
+    Gzip compressed copies of raw Shopify API pages on disk.
+
+    Every page is stored in its own file, named by the hash of its `page_key`, together with the url of the next page.
+    The manifest remembers the first page of the latest recording of each stream, so a replay finds a stream even if
+    its sync cursor moved since it was recorded.
+
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, url: str) -> str:
+        return os.path.join(self.directory, f'{hashlib.sha1(page_key(url).encode("utf-8")).hexdigest()}.json.gz')
+
+    def _manifest_path(self) -> str:
+        return os.path.join(self.directory, MANIFEST)
+
+    def _read_manifest(self) -> dict:
+        if not os.path.exists(self._manifest_path()):
+            return {}
+        with open(self._manifest_path(), encoding='utf-8') as f:
+            return json.load(f)
+
+    def store(self, url: str, body: bytes, next_page_url: Optional[str], first=False):
+        header = json.dumps({'url': url, 'next': next_page_url}).encode('utf-8')
+        with gzip.open(self._path(url), 'wb') as f:
+            f.write(header + b'\n' + body)
+        if first:
+            with self._lock:
+                manifest = self._read_manifest()
+                manifest[stream_key(url)] = url
+                with open(self._manifest_path(), 'w', encoding='utf-8') as f:
+                    json.dump(manifest, f, indent=2)
+
+    def load(self, url: str) -> Tuple[bytes, Optional[str]]:
+        """
+        Returns:
+            The raw body of the page and the url of the next page.
+        """
+        path = self._path(url)
+        if not os.path.exists(path):
+            raise PageNotCached(f'Die Seite "{page_key(url)}" ist nicht im Cache "{self.directory}".')
+        with gzip.open(path, 'rb') as f:
+            header, _, body = f.read().partition(b'\n')
+        return body, json.loads(header.decode('utf-8'))['next']
+
+    def first_page_url(self, url: str) -> str:
+        """Returns `url` if it was recorded, otherwise the first page of the latest recording of its stream."""
+        if os.path.exists(self._path(url)):
+            return url
+        return self._read_manifest().get(stream_key(url), url)
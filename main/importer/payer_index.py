@@ -0,0 +1,88 @@
+from collections import Counter, defaultdict
+from typing import Dict, Optional, Set, Tuple
+
+from main.db.orm import Order, OrderTransaction, Payer, Transaction, sess
+from main.db.sqlalchemy_utils import upsert
+from main.importer.amount_matcher import name_tokens
+
+
+class PayerIndex:
+    """
+    The customers each payer (see `payer_key`) paid for, learned from the associations of their transactions.
+
+    The index is loaded with one query. Associations which are planned while it is used are recorded in memory at once
+    and written by `save`.
+
+    """
+
+    def __init__(self):
+        self.customers: Dict[str, Set[int]] = defaultdict(set)
+        self.new_payments: Counter = Counter()
+
+    @classmethod
+    def load(cls) -> 'PayerIndex':
+        """Loads the index. It is built from the associations first if it was never built before."""
+        if sess.query(Payer.key).first() is None and sess.query(OrderTransaction.order_id).first() is not None:
+            rebuild()
+        index = cls()
+        for key, customer_id in sess.query(Payer.key, Payer.customer_id):
+            index.customers[key].add(customer_id)
+        return index
+
+    def lookup(self, iban: Optional[str], name: Optional[str]) -> Set[int]:
+        return self.customers.get(payer_key(iban, name), set())
+
+    def record(self, iban: Optional[str], name: Optional[str], customer_id: int):
+        key = payer_key(iban, name)
+        if key is not None:
+            self.customers[key].add(customer_id)
+            self.new_payments[key, customer_id] += 1
+
+    def save(self):
+        """Writes the recorded payments. They are committed with the caller's transaction."""
+        save_payments(self.new_payments)
+        self.new_payments = Counter()
+
+
+def payer_key(iban: Optional[str], name: Optional[str]) -> Optional[str]:
+    """The IBAN of a payer or, if there is none, the tokens of the payer's name. None for anonymous payers."""
+    iban = (iban or '').replace(' ', '').upper()
+    if iban:
+        return iban
+    tokens = name_tokens(name)
+    return f'name:{" ".join(sorted(tokens))}' if tokens else None
+
+
+def payer_customers(iban: Optional[str], name: Optional[str]) -> Set[int]:
+    """Looks up the customers a payer paid for in the database, without loading the whole index."""
+    key = payer_key(iban, name)
+    if key is None:
+        return set()
+    return {customer_id for customer_id, in sess.query(Payer.customer_id).filter(Payer.key == key)}
+
+
+def record_payment(transaction: Transaction, order: Order):
+    """Records an association which is added to the session (see `transactions_importer.associate_transaction`)."""
+    key = payer_key(transaction.iban, transaction.name)
+    if key is not None:
+        save_payments({(key, order.customer_id): 1})
+
+
+def save_payments(payments: Dict[Tuple[str, int], int]):
+    upsert(Payer, [{'key': key, 'customer_id': customer_id, 'payments': n}
+                   for (key, customer_id), n in payments.items()],
+           ('key', 'customer_id'), {'payments': 'payments + excluded.payments'})
+
+
+def rebuild():
+    """Builds the index from all associations. It is committed with the caller's transaction."""
+    sess.query(Payer).delete(synchronize_session=False)
+    payments = Counter()
+    rows = sess.query(Transaction.iban, Transaction.name, Order.customer_id) \
+        .join(OrderTransaction, OrderTransaction.transaction_id == Transaction.id) \
+        .join(Order, Order.id == OrderTransaction.order_id)
+    for iban, name, customer_id in rows:
+        key = payer_key(iban, name)
+        if key is not None:
+            payments[key, customer_id] += 1
+    save_payments(payments)
@@ -0,0 +1,372 @@
+import gzip
+import http.client
+import json
+import logging
+import queue
+import threading
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterator, List, Tuple, Optional
+
+from main import profiling
+from main.importer.page_cache import PageCache, RECORD, REPLAY
+from main.utils import Error
+
+CALL_LIMIT_HEADER = 'X-Shopify-Shop-Api-Call-Limit'
+RETRY_AFTER_HEADER = 'Retry-After'
+TOO_MANY_REQUESTS = 429
+# longest wait between two attempts of a request which failed for a transient reason
+MAX_BACKOFF = 60.0
+# maximum page size the REST Admin API allows
+PAGE_LIMIT = 250
+
+
+class ShopifyFetchError(Error):
+    pass
+
+
+class Page(list):
+    """The resources of one page. `next_url` is the url of the following page, None for the last page."""
+
+    def __init__(self, resources: List[dict], next_url: Optional[str]):
+        super().__init__(resources)
+        self.next_url = next_url
+
+
+class PageStream:
+    """
+    Iterates over the pages of one stream while a background thread already downloads the next ones.
+
+    At most `prefetch` pages are held in memory, so the memory used does not grow with the size of the shop. The
+    download blocks while the consumer (e.g. the database import) is busy with older pages.
+
+    """
+    _END = object()
+
+    def __init__(self, pages: Iterator[Page], prefetch=2):
+        self._pages = pages
+        self._queue = queue.Queue(maxsize=max(1, prefetch))
+        self._closed = threading.Event()
+        self._thread = threading.Thread(target=self._download, daemon=True)
+        self._thread.start()
+
+    def _put(self, item):
+        while not self._closed.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _download(self):
+        try:
+            for page in self._pages:
+                if not self._put(page):
+                    return
+            self._put(self._END)
+        except BaseException as e:
+            self._put(e)
+
+    def __iter__(self) -> Iterator[Page]:
+        while True:
+            item = self._queue.get()
+            if item is self._END:
+                return
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+
+    def close(self):
+        """Stops the download, e.g. if the consumer failed."""
+        self._closed.set()
+
+
+class LeakyBucket:
+    """
+    Client side mirror of Shopify's leaky bucket rate limit.
+
+    Every request puts one call into the bucket, Shopify leaks `leak_rate` calls per second out of it. The fill level
+    is corrected with every `X-Shopify-Shop-Api-Call-Limit` header (e.g. "32/40") the API sends back. Callers block in
+    `acquire` until a call can be made without exceeding `size - reserve`.
+
+    """
+
+    def __init__(self, size=40, leak_rate=2.0, reserve=2):
+        self.size = size
+        self.leak_rate = leak_rate
+        self.reserve = reserve
+        self._used = 0.0
+        self._updated_at = time.monotonic()
+        self._blocked_until = 0.0
+        self._lock = threading.Lock()
+
+    def _level(self, now) -> float:
+        return max(0.0, self._used - (now - self._updated_at) * self.leak_rate)
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                level = self._level(now)
+                wait = max(self._blocked_until - now, (level + 1 - (self.size - self.reserve)) / self.leak_rate)
+                if wait <= 0:
+                    self._used = level + 1
+                    self._updated_at = now
+                    return
+            time.sleep(wait)
+
+    def update(self, header_value: Optional[str]):
+        if not header_value:
+            return
+        try:
+            used, size = map(int, header_value.split('/'))
+        except ValueError:
+            logging.warning(f'Unerwarteter {CALL_LIMIT_HEADER}-Header: {header_value}')
+            return
+        with self._lock:
+            self.size = size
+            self._used = float(used)
+            self._updated_at = time.monotonic()
+
+    def block(self, seconds: float):
+        """Called after a 429 response: nobody may call the API for `seconds`."""
+        with self._lock:
+            self._used = float(self.size)
+            self._updated_at = time.monotonic()
+            self._blocked_until = max(self._blocked_until, self._updated_at + seconds)
+
+
+class ConnectionPool:
+    """
+    Keeps the connections to one shop open between requests.
+
+    Each request takes an idle connection (or opens a new one) and hands it back once the response was read, so
+    consecutive pages skip the TCP and TLS handshakes. At most as many connections are opened as requests are made in
+    parallel. Responses are requested gzip compressed.
+
+    """
+
+    def __init__(self, site: str, timeout=60):
+        parts = urllib.parse.urlsplit(site)
+        self.scheme = parts.scheme
+        self.host = parts.netloc
+        self.timeout = timeout
+        self.opened = 0
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+
+    def _get(self) -> Tuple[http.client.HTTPConnection, bool]:
+        try:
+            return self._idle.get_nowait(), True
+        except queue.Empty:
+            pass
+        with self._lock:
+            self.opened += 1
+        if self.scheme == 'https':
+            return http.client.HTTPSConnection(self.host, timeout=self.timeout), False
+        return http.client.HTTPConnection(self.host, timeout=self.timeout), False
+
+    def request(self, url: str, headers: Dict[str, str]) -> Tuple[int, str, http.client.HTTPMessage, bytes]:
+        """
+        Returns:
+            The status, the reason, the headers and the (decompressed) body of the response.
+        """
+        parts = urllib.parse.urlsplit(url)
+        path = f'{parts.path}?{parts.query}' if parts.query else parts.path
+        headers = dict(headers, **{'Accept-Encoding': 'gzip'})
+        while True:
+            connection, reused = self._get()
+            try:
+                connection.request('GET', path, headers=headers)
+                response = connection.getresponse()
+                body = response.read()
+            except (OSError, http.client.HTTPException):
+                connection.close()
+                # the shop closed the idle connection in the meantime
+                if reused:
+                    continue
+                raise
+            if response.will_close:
+                connection.close()
+            else:
+                self._idle.put(connection)
+            if response.getheader('Content-Encoding') == 'gzip':
+                body = gzip.decompress(body)
+            return response.status, response.reason, response.headers, body
+
+    def close(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+class ShopifyFetcher:
+    """
+    Downloads Shopify REST resources page by page.
+
+    Shopify paginates with cursors (the next page's url is in the "Link" header of the current page), so the pages of
+    one stream have to be requested one after another. Different streams (e.g. active products and cancelled orders)
+    are independent, though, and `fetch_all` and `stream_all` download them in parallel, with at most `workers`
+    requests in flight. All threads share one `LeakyBucket`, so the shop's rate limit is respected no matter how many
+    requests are in flight.
+
+    """
+
+    def __init__(self, site: str, token: str, workers=4, bucket: LeakyBucket = None, timeout=60, max_retries=5,
+                 backoff=1.0, page_cache: PageCache = None, page_cache_mode: str = None):
+        """
+        Args:
+            site: Base url of the API including the version, e.g. "https://shop.myshopify.com/admin/api/2020-10".
+            token: Access token (the password of a private app).
+            workers: Maximum number of requests in flight.
+            max_retries: How often a request is repeated after it was throttled or failed for a transient reason (a
+                network error or a server error).
+            backoff: Seconds to wait before the first repetition of a failed request. The wait doubles with every
+                further attempt.
+            page_cache_mode: RECORD stores every downloaded page in `page_cache`, REPLAY reads the pages from
+                `page_cache` without any network access.
+        """
+        self.site = site.rstrip('/')
+        self.token = token
+        self.workers = workers
+        # the streams of `stream_all` download in threads of their own, which share the requests in flight
+        self._requests = threading.Semaphore(max(1, workers))
+        self.bucket = bucket if bucket is not None else LeakyBucket()
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.page_cache = page_cache
+        self.page_cache_mode = page_cache_mode if page_cache is not None else None
+        self.pool = ConnectionPool(self.site, timeout)
+
+    def resource_url(self, resource: str, **params) -> str:
+        params.setdefault('limit', PAGE_LIMIT)
+        return f'{self.site}/{resource}.json?{urllib.parse.urlencode(params)}'
+
+    def get_page(self, url: str, first=False) -> Tuple[dict, Optional[str]]:
+        """
+        Returns:
+            The decoded body of the page and the url of the next page (None if it is the last page).
+        """
+        if self.page_cache_mode == REPLAY:
+            body, next_page_url = self.page_cache.load(url)
+        else:
+            body, next_page_url = self.download_page(url)
+            if self.page_cache_mode == RECORD:
+                self.page_cache.store(url, body, next_page_url, first)
+        profiling.count('api_pages')
+        profiling.count('api_bytes', len(body))
+        return json.loads(body.decode('utf-8')), next_page_url
+
+    def download_page(self, url: str) -> Tuple[bytes, Optional[str]]:
+        headers = {'X-Shopify-Access-Token': self.token, 'Accept': 'application/json'}
+        for attempt in range(self.max_retries + 1):
+            self.bucket.acquire()
+            try:
+                with self._requests:
+                    status, reason, response_headers, body = self.pool.request(url, headers)
+            except (OSError, http.client.HTTPException) as e:
+                status, reason, response_headers, error = None, None, None, str(e)
+            else:
+                error = f'{status} {reason}'
+            if status is not None and status < 300:
+                self.bucket.update(response_headers.get(CALL_LIMIT_HEADER))
+                return body, get_next_page_url(response_headers.get('Link'))
+            transient = status is None or status >= 500
+            if status != TOO_MANY_REQUESTS and not transient or attempt == self.max_retries:
+                raise ShopifyFetchError(f'Shopify-Anfrage "{url}" fehlgeschlagen: {error}')
+            if status == TOO_MANY_REQUESTS:
+                retry_after = float(response_headers.get(RETRY_AFTER_HEADER, 2.0))
+                logging.info(f'Shopify-Ratenlimit erreicht. Warte {retry_after} Sekunden.')
+                self.bucket.block(retry_after)
+            else:
+                wait = min(self.backoff * 2 ** attempt, MAX_BACKOFF)
+                logging.warning(f'Shopify-Anfrage "{url}" fehlgeschlagen: {error}. Neuer Versuch in {wait} Sekunden.')
+                time.sleep(wait)
+        raise ShopifyFetchError(f'Shopify-Anfrage "{url}" fehlgeschlagen.')
+
+    def iter_pages(self, resource: str, start_url: str = None, **params) -> Iterator[Page]:
+        """
+        Args:
+            start_url: Continues an interrupted download at this page (see `Page.next_url`). If the page cannot be
+                downloaded anymore (e.g. because its cursor expired), the download starts over at the first page.
+            params: Query parameters of the first page, e.g. "fields" to download only some fields of each resource.
+        """
+        first_url = self.resource_url(resource, **params)
+        if self.page_cache_mode == REPLAY:
+            first_url = self.page_cache.first_page_url(first_url)
+        url = start_url or first_url
+        first = start_url is None
+        while url is not None:
+            try:
+                body, next_url = self.get_page(url, first)
+            except ShopifyFetchError as e:
+                if url != start_url:
+                    raise
+                logging.warning(f'Fortsetzen des Downloads bei "{url}" fehlgeschlagen: {e.args[0]}. Starte von vorne.')
+                url = start_url = first_url
+                first = True
+                continue
+            first = False
+            # besides the cursor, the following pages only accept "limit" and "fields"
+            if next_url is not None and 'fields' in params:
+                next_url = set_query_param(next_url, 'fields', params['fields'])
+            url = next_url
+            yield Page(body[resource], next_url)
+
+    def fetch(self, resource: str, **params) -> List[dict]:
+        resources = []
+        for page in self.iter_pages(resource, **params):
+            resources += page
+        return resources
+
+    def fetch_all(self, streams: Dict[str, Tuple[str, dict]]) -> Dict[str, List[dict]]:
+        """
+        Downloads several streams in parallel.
+
+        Args:
+            streams: Maps a stream name to the resource name (e.g. "orders") and the query parameters of the stream.
+        Returns:
+            All resources of each stream.
+        """
+        with ThreadPoolExecutor(max_workers=max(1, min(self.workers, len(streams)))) as executor:
+            futures = {name: executor.submit(self.fetch, resource, **params)
+                       for name, (resource, params) in streams.items()}
+            return {name: future.result() for name, future in futures.items()}
+
+    def stream_all(self, streams: Dict[str, Tuple[str, dict]], prefetch=2, start_urls: Dict[str, str] = None) \
+            -> Dict[str, PageStream]:
+        """
+        Starts downloading several streams in parallel without waiting for them to finish. Each stream has a thread of
+        its own, but at most `workers` of them make a request at the same time.
+
+        Args:
+            streams: Maps a stream name to the resource name (e.g. "orders") and the query parameters of the stream.
+            prefetch: Number of pages per stream which are downloaded ahead of the consumer.
+            start_urls: Maps a stream name to the page at which its interrupted download continues.
+        Returns:
+            The pages of each stream, in the order of `streams`.
+        """
+        start_urls = start_urls or {}
+        return {name: PageStream(self.iter_pages(resource, start_urls.get(name), **params), prefetch)
+                for name, (resource, params) in streams.items()}
+
+
+def set_query_param(url: str, name: str, value: str) -> str:
+    parts = urllib.parse.urlsplit(url)
+    params = [(k, v) for k, v in urllib.parse.parse_qsl(parts.query) if k != name] + [(name, value)]
+    return urllib.parse.urlunsplit(parts._replace(query=urllib.parse.urlencode(params)))
+
+
+def get_next_page_url(link_header: Optional[str]) -> Optional[str]:
+    if not link_header:
+        return None
+    for value in link_header.split(','):
+        link, _, rel = value.partition(';')
+        if 'rel="next"' in rel:
+            return link.strip()[1:-1]
+    return None
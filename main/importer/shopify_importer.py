@@ -1,25 +1,43 @@
 import datetime
 import logging
-from typing import Dict
+from typing import Callable, Dict, Iterable, Iterator, TypeVar
 from typing import Union, List
 
 import shopify
 from sqlalchemy.orm.exc import NoResultFound
 
-from main import utils
+from main import utils, conf, profiling
 from main.conf import settings, paths
-from main.db.orm import sess, Order, Customer, Address, Product, Variant, LineItem, School, size_names, \
+from main.db.addresses import fingerprint
+from main.db.orm import sess, Order, Customer, Address, Product, Variant, LineItem, School, Reminder, size_names, \
     color_names
-from main.db.sqlalchemy_utils import get, get_or_create
+from main.db.sqlalchemy_utils import get, get_many, chunked, ImportCache
+from main.importer.page_cache import PageCache, REPLAY
+from main.importer.shopify_fetcher import ShopifyFetcher, Page, PageStream
+from main.importer.shopify_records import ShopifyAddress, ShopifyOrder, ShopifyProduct, ShopifyLineItem, \
+    decode_order, decode_product, decode_cancelled_order, PRODUCT_FIELDS, ORDER_FIELDS, CANCELLED_ORDER_FIELDS
 from main.utils import to_cent, Error
 
+API_VERSION = '2020-10'
+
+# names of the streams downloaded from shopify
+ACTIVE_PRODUCTS = 'active_products'
+ARCHIVED_PRODUCTS = 'archived_products'
+ORDERS = 'orders'
+CANCELLED_ORDERS = 'cancelled_orders'
+
+# natural key of an address
+ADDRESS_KEY = ('first_name', 'last_name', 'street', 'additional', 'city', 'zip_')
+
+# a record of `shopify_records`
+T = TypeVar('T')
+
 
 def activate_shopify_sess():
     shop_url = settings['shop_url']
-    api_version = '2020-10'
     password = settings['password']
 
-    shopify_sess = shopify.Session(shop_url, api_version, password)
+    shopify_sess = shopify.Session(shop_url, API_VERSION, password)
     shopify.ShopifyResource.activate_session(shopify_sess)
 
 
@@ -37,138 +55,399 @@ class OrderNrNotFound(Error):
         self.nr = nr
 
 
-def import_all():
-    import_products()
-    archive_products()
-    import_orders()
-    void_orders()
-
+def import_all(page_cache_mode: str = None):
+    """
+    Imports the products and orders while they are still being downloaded.
 
-def import_products():
-    shopify_products: List[shopify.Product] = get_shopify_resources(shopify.Product, status='active')
-    for shopify_product in shopify_products:
-        update_or_create_product(shopify_product)
+    The products have to be imported before the orders, which reference them. Meanwhile, the order streams are already
+    downloading their first pages.
 
+    Args:
+        page_cache_mode: RECORD additionally stores the raw pages in the page cache, REPLAY imports the pages stored
+            there instead of downloading them. A replay imports every cached resource and leaves the sync cursors
+            untouched.
 
-def archive_products():
-    shopify_products: List[shopify.Product] = get_shopify_resources(shopify.Product, status='archived')
+    Each stream saves its sync cursor as soon as its last page was committed. Until then, it saves a checkpoint after
+    every page, so an update which was interrupted continues at the first page which was not committed yet.
+    """
+    if page_cache_mode == REPLAY:
+        # the cursors only find the recorded streams, the replayed resources are neither filtered nor tracked
+        streams = download_resources({stream: SyncCursor(conf.get_sync_cursor(stream)) for stream in STREAMS},
+                                     get_fetcher(page_cache_mode))
+        cursors = dict.fromkeys(STREAMS)
+    else:
+        cursors = {stream: SyncCursor.restore(stream) for stream in STREAMS}
+        for stream, cursor in cursors.items():
+            if cursor.resume_url:
+                print(f'Setze den unterbrochenen Download von "{stream}" nach {cursor.pages} Seiten fort.')
+        streams = download_resources(cursors, get_fetcher(page_cache_mode))
+    try:
+        with ImportCache() as cache:
+            profiling.track_cache(cache)
+            with profiling.phase('Produkte'):
+                cache.warm_all(School, 'name')
+                import_products(streams[ACTIVE_PRODUCTS], cache, cursors[ACTIVE_PRODUCTS])
+            with profiling.phase('Archivierte Produkte'):
+                archive_products(streams[ARCHIVED_PRODUCTS], cache, cursors[ARCHIVED_PRODUCTS])
+            with profiling.phase('Bestellungen'):
+                import_orders(streams[ORDERS], cache, cursors[ORDERS])
+        with profiling.phase('Stornierte Bestellungen'):
+            void_orders(streams[CANCELLED_ORDERS], cursors[CANCELLED_ORDERS])
+    finally:
+        for stream in streams.values():
+            stream.close()
+    logging.info(f'Cache des Imports: {cache}')
+
+
+def import_products(pages: Iterable[Page], cache: ImportCache = None, cursor: 'SyncCursor' = None):
+    cache = cache or ImportCache()
+    for page in to_resources(pages, decode_product, 'aktive Produkte', cursor):
+        import_product_page(page, cache)
+        if cursor is not None:
+            cursor.committed(page.next_url)
+
+
+def archive_products(pages: Iterable[Page], cache: ImportCache = None, cursor: 'SyncCursor' = None):
+    cache = cache or ImportCache()
+    for page in to_resources(pages, decode_product, 'archivierte Produkte', cursor):
+        import_product_page(page, cache, active=False)
+        if cursor is not None:
+            cursor.committed(page.next_url)
+
+
+def import_product_page(shopify_products: List[ShopifyProduct], cache: ImportCache, active=True):
+    cache.warm(Product, 'shopify_id', [shopify_product.id for shopify_product in shopify_products if shopify_product.id])
+    cache.warm(Variant, 'shopify_id', [shopify_variant.id for shopify_product in shopify_products
+                                       for shopify_variant in shopify_product.variants])
     for shopify_product in shopify_products:
-        update_or_create_product(shopify_product, active=False)
+        update_or_create_product(shopify_product, cache, active)
     sess.commit()
 
 
-def import_orders():
-    ORDER_NR = 'name'
-    AMOUNT = 'total_price'
+def import_orders(pages: Iterable[Page], cache: ImportCache = None, cursor: 'SyncCursor' = None):
+    cache = cache or ImportCache()
+    for page in to_resources(pages, decode_order, 'Bestellungen', cursor):
+        import_order_page(with_address(page), cache, cursor)
+        if cursor is not None:
+            cursor.committed(page.next_url)
 
-    shopify_orders = get_shopify_resources(shopify.Order)
 
+def with_address(shopify_orders: List[ShopifyOrder]) -> List[ShopifyOrder]:
+    """
+    Leaves out the orders which have neither a billing nor a shipping address (see `decode_order`) and reports them.
+
+    """
+    complete = []
     for shopify_order in shopify_orders:
-        attributes = shopify_order.attributes
-        nr = attributes[ORDER_NR]
-        order = get(Order, nr=nr)
+        if shopify_order.billing_address is None:
+            msg = f'Die Bestellung {shopify_order.name} hat weder eine Rechnungs- noch eine Lieferadresse. Die ' \
+                  f'Bestellung wird nicht importiert und nicht geupdated.'
+            logging.error(msg)
+            print(f'\nACHTUNG: {msg}')
+        else:
+            complete.append(shopify_order)
+    return complete
+
+
+def import_order_page(shopify_orders: List[ShopifyOrder], cache: ImportCache, cursor: 'SyncCursor' = None):
+    """
+    Imports one page of orders in a single transaction.
+
+    Everything the page references is loaded into the cache up front (see `warm_cache`). Orders whose products and
+    variants are all known cannot fail and are written straight away, so the page is flushed once, on commit. Any
+    other order needs stubs (see `assure_products`) and is written in its own SAVEPOINT, so an order with a missing
+    product variant is rolled back alone.
+
+    """
+    warm_cache(shopify_orders, cache)
+    for shopify_order in shopify_orders:
+        nr = shopify_order.name
+        if references_known(shopify_order, cache):
+            upsert_order(shopify_order, cache)
+            continue
         try:
-            address = get_or_create_address(attributes['billing_address'])
-            if not order:
-                customer = get_or_create_customer(shopify_order)
-                order = Order()
-                order.nr = nr
-                order.customer = customer
-                order.created_at = to_date(attributes['created_at'])
-                order.address = address
-                add_line_items(order, shopify_order)
-                sess.add(order)
-            order.discount = to_cent(attributes.get('total_discounts', 0))
-            order.address = address
-            order.shipping = to_cent(
-                attributes['total_shipping_price_set'].attributes['shop_money'].attributes['amount'])
-            tags = get_tags_with_keywords(attributes['tags'])
-            # a note the shop owner can make
-            if 'name' in tags:
-                order.note = tags['name']
-            # a note the customer can make
-            else:
-                NOTE = 'note'
-                if NOTE in attributes:
-                    order.note = attributes[NOTE]
-            sess.commit()
+            # entering and leaving a savepoint flushes the session
+            with sess.begin_nested():
+                upsert_order(shopify_order, cache)
         except ProductVariantMissing as e:
             msg = f'Die Produktvariante der Bestellung {nr} konnte nicht gefunden werden. Die Bestellung wird nicht ' \
                   f'importiert und nicht geupdated. '
             logging.error(msg)
-            sess.rollback()
+            cache.forget_transient()
+            if cursor is not None:
+                cursor.failed(shopify_order.updated_at)
             print(f'ACHTUNG: {msg}\n'
                   f'Grund: {utils.get_error_arg(e)}')
+    sess.commit()
 
 
-def void_orders():
-    shopify_orders = get_shopify_resources(shopify.Order, status='cancelled')
-    for shopify_order in shopify_orders:
-        name_ = shopify_order.attributes['name']
-        try:
-            sess.query(Order).filter(Order.nr == name_).delete()
-        except Exception as e:
-            print(e)
-        print(f'Bestellung {name_} hat Status "cancelled" und wird gelöscht.')
-        sess.commit()
-
-
-def get_shopify_resources(shopify_resource, update_after=settings['update_after'], **kwargs) -> List[shopify.ShopifyResource]:
-    next_page_url = None
-    first = True
-    resources = []
-    i = 0
-    while next_page_url is not None or first:
-        if i % 5 == 0 and i != 0:
-            print('Downloading resources from Shopify...')
-        i += 1
-
-        if first:
-            collection = shopify_resource.find(updated_at_min=update_after, **kwargs)
-            first = False
+def references_known(shopify_order: ShopifyOrder, cache: ImportCache) -> bool:
+    """Whether the products and variants of all line items of the order are in the database."""
+    return all(line_item.product_id and line_item.variant_id
+               and cache.get(Product, 'shopify_id', line_item.product_id) is not None
+               and cache.get(Variant, 'shopify_id', line_item.variant_id) is not None
+               for line_item in shopify_order.line_items)
+
+
+def upsert_order(shopify_order: ShopifyOrder, cache: ImportCache) -> Order:
+    nr = shopify_order.name
+    order = cache.get(Order, 'nr', nr)
+    address = get_or_create_address(shopify_order.billing_address, cache)
+    if not order:
+        customer = get_or_create_customer(shopify_order, cache)
+        order = Order()
+        order.nr = nr
+        order.customer = customer
+        order.created_at = to_date(shopify_order.created_at)
+        order.address = address
+        add_line_items(order, shopify_order, cache)
+        sess.add(order)
+        cache.add(order, 'nr')
+    order.discount = to_cent(shopify_order.total_discounts)
+    order.address = address
+    order.shipping = to_cent(shopify_order.shipping)
+    order.note = get_note(shopify_order)
+    return order
+
+
+def get_note(shopify_order: ShopifyOrder) -> Union[str, None]:
+    tags = get_tags_with_keywords(shopify_order.tags)
+    # a note the shop owner can make
+    if 'name' in tags:
+        return tags['name']
+    # a note the customer can make
+    return shopify_order.note
+
+
+def void_orders(pages: Iterable[Page], cursor: 'SyncCursor' = None, cache: ImportCache = None):
+    """Deletes the cancelled orders of the pages downloaded from Shopify (see `delete_cancelled_orders`)."""
+    cancelled = {}
+    for page in to_resources(pages, decode_cancelled_order, 'stornierte Bestellungen', cursor):
+        for shopify_order in page:
+            cancelled[shopify_order.name] = shopify_order.updated_at
+    delete_cancelled_orders(cancelled, cursor, cache)
+
+
+def delete_cancelled_orders(cancelled: Dict[str, str], cursor: 'SyncCursor' = None, cache: ImportCache = None):
+    """
+    Deletes the cancelled orders which are still in the database, together with their line items and reminders, in
+    one transaction.
+
+    Cancelled orders which transactions were already associated with are kept, since deleting them would silently drop
+    the payments. They are reported and stay behind the sync cursor, so they are reported again with every update
+    until the payments are resolved manually.
+
+    The deleted orders are evicted from `cache`, which would otherwise still hand them out.
+
+    Args:
+        cancelled: The "updated_at" timestamps of the cancelled orders by their nrs.
+    """
+    if not cancelled:
+        if cursor is not None:
+            cursor.committed(None)
+        return
+    present = []
+    for nrs in chunked(cancelled):
+        present += sess.query(Order.id, Order.nr, Order.order_transactions.any()).filter(Order.nr.in_(nrs)).all()
+    paid_nrs = sorted(nr for id_, nr, paid in present if paid)
+    void_ids = [id_ for id_, nr, paid in present if not paid]
+    for ids in chunked(void_ids):
+        sess.query(LineItem).filter(LineItem.order_id.in_(ids)).delete(synchronize_session=False)
+        sess.query(Reminder).filter(Reminder.order_id.in_(ids)).delete(synchronize_session=False)
+        sess.query(Order).filter(Order.id.in_(ids)).delete(synchronize_session=False)
+    if cache is not None:
+        cache.evict(Order, 'nr', [nr for id_, nr, paid in present if not paid])
+    sess.commit()
+    print(f'{len(cancelled)} stornierte Bestellungen: {len(void_ids)} gelöscht, {len(paid_nrs)} trotz Zahlung '
+          f'behalten, {len(cancelled) - len(present)} nicht (mehr) in der Datenbank.')
+    if paid_nrs:
+        msg = f'Folgende Bestellungen wurden storniert, haben aber bereits zugewiesene Transaktionen und werden ' \
+              f'deshalb nicht gelöscht: {", ".join(paid_nrs)}. Bitte prüfe die Zahlungen und lösche die Zuweisungen ' \
+              f'oder erstatte das Geld.'
+        logging.warning(msg)
+        print(f'ACHTUNG: {msg}')
+        if cursor is not None:
+            for nr in paid_nrs:
+                cursor.failed(cancelled[nr])
+    # the cancelled orders are deleted in one transaction, so there are no checkpoints in between
+    if cursor is not None:
+        cursor.committed(None)
+
+
+def get_fetcher(page_cache_mode: str = None) -> ShopifyFetcher:
+    page_cache = PageCache(settings.get('page_cache', paths['page_cache'])) if page_cache_mode else None
+    return ShopifyFetcher(shopify.ShopifyResource.site, settings['password'],
+                          workers=settings.get('download_workers', 4), max_retries=settings.get('download_retries', 5),
+                          backoff=settings.get('download_backoff', 1.0), page_cache=page_cache,
+                          page_cache_mode=page_cache_mode)
+
+
+class SyncCursor:
+    """
+    High-water mark of the "updated_at" timestamps of one stream.
+
+    The next download only asks for resources updated at or after the cursor. Resources which have not changed since
+    then are skipped. The cursor never moves past an order which could not be imported, so it is retried next time.
+
+    A cursor which belongs to a `stream` is persisted: after each committed page as a checkpoint, after the last page
+    as the stream's sync cursor.
+
+    """
+
+    def __init__(self, stored: str, stream: str = None):
+        self.start = stored
+        self.stored = to_datetime(stored)
+        self.stream = stream
+        self.newest = self.stored
+        self.oldest_failed: Union[datetime.datetime, None] = None
+        # the page at which an interrupted download continues
+        self.resume_url: Union[str, None] = None
+        self.pages = 0
+
+    @classmethod
+    def restore(cls, stream: str) -> 'SyncCursor':
+        """Returns the stream's sync cursor, continuing at its checkpoint if its last download was interrupted."""
+        cursor = cls(conf.get_sync_cursor(stream), stream)
+        checkpoint = conf.get_checkpoint(stream)
+        # a checkpoint of another download (e.g. the sync cursor was reset in the meantime) is useless
+        if checkpoint is not None and checkpoint['start'] == cursor.start:
+            cursor.newest = to_datetime(checkpoint['newest'])
+            if checkpoint['oldest_failed']:
+                cursor.oldest_failed = to_datetime(checkpoint['oldest_failed'])
+            cursor.resume_url = checkpoint['url']
+            cursor.pages = checkpoint['pages']
+        return cursor
+
+    def committed(self, next_url: Union[str, None]):
+        """Called after a page was committed. `next_url` is the url of the following page, None after the last one."""
+        self.pages += 1
+        if self.stream is None:
+            return
+        if next_url is None:
+            conf.save_sync_cursors({self.stream: str(self)})
+            conf.save_checkpoint(self.stream, None)
         else:
-            collection = shopify_resource.find(from_=next_page_url)
-        next_page_url = collection.next_page_url
-        resources += list(collection)
-    return resources
+            conf.save_checkpoint(self.stream, {
+                'start': self.start, 'url': next_url, 'pages': self.pages, 'newest': self.newest.isoformat(),
+                'oldest_failed': self.oldest_failed.isoformat() if self.oldest_failed else None})
+
+    def is_unchanged(self, updated_at: str) -> bool:
+        return to_datetime(updated_at) <= self.stored
+
+    def seen(self, updated_at: str):
+        self.newest = max(self.newest, to_datetime(updated_at))
+
+    def failed(self, updated_at: str):
+        updated_at = to_datetime(updated_at)
+        if self.oldest_failed is None or updated_at < self.oldest_failed:
+            self.oldest_failed = updated_at
+
+    @property
+    def value(self) -> datetime.datetime:
+        if self.oldest_failed is not None:
+            return min(self.newest, self.oldest_failed - datetime.timedelta(seconds=1))
+        return self.newest
+
+    def __str__(self):
+        return self.value.isoformat()
 
 
-def get_or_create_customer(shopify_order) -> Customer:
-    EMAIL = 'email'
+STREAMS = {ACTIVE_PRODUCTS: ('products', {'status': 'active', 'fields': ','.join(PRODUCT_FIELDS)}),
+           ARCHIVED_PRODUCTS: ('products', {'status': 'archived', 'fields': ','.join(PRODUCT_FIELDS)}),
+           ORDERS: ('orders', {'fields': ','.join(ORDER_FIELDS)}),
+           CANCELLED_ORDERS: ('orders', {'status': 'cancelled', 'fields': ','.join(CANCELLED_ORDER_FIELDS)})}
+
+
+def download_resources(cursors: Dict[str, SyncCursor], fetcher: ShopifyFetcher) -> Dict[str, PageStream]:
+    """
+    Starts downloading the active and archived products as well as the open and cancelled orders in parallel. Each
+    stream only asks for the resources which were updated since its cursor.
+
+    Returns:
+        The raw pages of each stream. Each stream only keeps a few pages in memory and continues downloading while
+        its pages are consumed.
+    """
+    return fetcher.stream_all(
+        {name: (resource, dict(params, updated_at_min=cursors[name].start)) for name, (resource, params) in
+         STREAMS.items()},
+        prefetch=settings.get('download_prefetch', 2),
+        start_urls={name: cursor.resume_url for name, cursor in cursors.items() if cursor.resume_url})
+
+
+def to_resources(pages: Iterable[Page], decode: Callable[[dict], T], description: str,
+                 cursor: SyncCursor = None) -> Iterator[Page]:
+    """
+    Decodes raw pages into pages of records (see `shopify_records`) and reports the progress to the user. Resources
+    which did not change since the last import are skipped.
 
-    shopify_customer = shopify_order.attributes['customer']
-    attributes = shopify_customer.attributes
-    customer = get(Customer, shopify_id=shopify_customer.id)
+    """
+    n_pages = 0
+    n_resources = 0
+    try:
+        for page in pages:
+            n_pages += 1
+            n_resources += len(page)
+            print(f'\rLade {description} von Shopify: {n_pages} Seiten, {n_resources} Einträge', end='', flush=True)
+            changed = page
+            if cursor is not None:
+                changed = [attributes for attributes in page if not cursor.is_unchanged(attributes['updated_at'])]
+                for attributes in changed:
+                    cursor.seen(attributes['updated_at'])
+            yield Page([decode(attributes) for attributes in changed], page.next_url)
+    finally:
+        if n_pages:
+            print()
+
+
+def warm_cache(shopify_orders: List[ShopifyOrder], cache: ImportCache):
+    """
+    Loads the orders, customers, addresses, products and variants referenced by a page of shopify orders with one
+    query per model.
+
+    """
+    line_items = [line_item for order in shopify_orders for line_item in order.line_items]
+    cache.warm(Order, 'nr', [order.name for order in shopify_orders])
+    cache.warm(Customer, 'shopify_id', [order.customer.id for order in shopify_orders])
+    cache.warm(Address, 'fingerprint', [address_fingerprint(order.billing_address) for order in shopify_orders])
+    cache.warm(Product, 'shopify_id', [line_item.product_id for line_item in line_items if line_item.product_id])
+    cache.warm(Variant, 'shopify_id', [line_item.variant_id for line_item in line_items if line_item.variant_id])
+
+
+def address_key(shopify_address: ShopifyAddress) -> tuple:
+    address2 = utils.strip_me(shopify_address.address2)
+    return (utils.strip_me(shopify_address.first_name), utils.strip_me(shopify_address.last_name),
+            utils.strip_me(shopify_address.address1), address2 if address2 else None,
+            utils.strip_me(shopify_address.city), utils.strip_me(shopify_address.zip))
+
+
+def address_fingerprint(shopify_address: ShopifyAddress) -> str:
+    return fingerprint(**dict(zip(ADDRESS_KEY, address_key(shopify_address))))
+
+
+def get_or_create_customer(shopify_order: ShopifyOrder, cache: ImportCache) -> Customer:
+    shopify_customer = shopify_order.customer
+    customer = cache.get(Customer, 'shopify_id', shopify_customer.id)
     if customer is None:
         customer = Customer()
         customer.shopify_id = shopify_customer.id
-        customer.email = attributes[EMAIL]
-        customer.first_name = attributes['first_name']
-        customer.last_name = attributes['last_name']
+        customer.email = shopify_customer.email
+        customer.first_name = shopify_customer.first_name
+        customer.last_name = shopify_customer.last_name
 
         utils.strip_me(customer)
+        cache.add(customer, 'shopify_id')
     return customer
 
 
-def get_or_create_address(shopify_address: shopify.Address) -> Address:
-    attributes = shopify_address.attributes
-
-    first_name = utils.strip_me(attributes['first_name'])
-    last_name = utils.strip_me(attributes['last_name'])
-    street = utils.strip_me(attributes['address1'])
-    address2 = utils.strip_me(attributes['address2'])
-    additional = None
-    if address2:
-        additional = address2
-    city = utils.strip_me(attributes['city'])
-    zip_ = utils.strip_me(attributes['zip'])
-    address = get_or_create(Address, first_name=first_name,
-                            last_name=last_name,
-                            street=street,
-                            additional=additional,
-                            city=city,
-                            zip_=zip_)
-    utils.strip_me(address)
+def get_or_create_address(shopify_address: ShopifyAddress, cache: ImportCache) -> Address:
+    key = address_key(shopify_address)
+    key_fingerprint = fingerprint(**dict(zip(ADDRESS_KEY, key)))
+    address = cache.get(Address, 'fingerprint', key_fingerprint)
+    if address is None:
+        address = Address(fingerprint=key_fingerprint)
+        address.first_name, address.last_name, address.street, address.additional, address.city, address.zip_ = key
+        sess.add(address)
+        cache.add(address, 'fingerprint')
 
     return address
 
@@ -191,39 +470,35 @@ def get_tags_with_keywords(tag_string) -> Dict[str, str]:
 def get_orders(nrs: List[str]) -> List[Order]:
     if not nrs:
         raise ValueError(f'nrs Parameter darf nicht leer oder None sein.')
-    orders = []
-    for nr in nrs:
-        order_nr = f'ABI{nr}'
-        try:
-            order = get(Order, require_result=True, nr=order_nr)
-            orders += [order]
-        except NoResultFound:
+    order_nrs = [f'ABI{nr}' for nr in nrs]
+    orders = get_many(Order, 'nr', order_nrs)
+    for order_nr in order_nrs:
+        if order_nr not in orders:
             msg = f'Bestellung "{order_nr}" existiert nicht.'
             raise OrderNrNotFound(msg, order_nr)
-    return orders
+    return [orders[order_nr] for order_nr in order_nrs]
 
 
-def get_school(shopify_order: shopify.Order) -> Union[School, None]:
-    for shopify_line_item in shopify_order.attributes['line_items']:
-        product_id = shopify_line_item.attributes['product_id']
+def get_school(shopify_order: ShopifyOrder, cache: ImportCache) -> Union[School, None]:
+    for shopify_line_item in shopify_order.line_items:
+        product_id = shopify_line_item.product_id
         if product_id:
-            product: Product = get(Product, shopify_id=int(product_id))
+            product: Product = cache.get(Product, 'shopify_id', int(product_id))
             if product:
                 return product.school
     return None
 
 
-def assure_products(shopify_order: shopify.Order):
+def assure_products(shopify_order: ShopifyOrder, cache: ImportCache):
     """
     Makes sure that the products in this shopify_order are still existing
     in the shopify database. Otherwise creates a stub.
 
     """
-    for shopify_line_item in shopify_order.attributes['line_items']:
-        attributes = shopify_line_item.attributes
-        product_id = attributes['product_id']
-        title = attributes['title']
-        product = get_product(attributes, False)
+    for shopify_line_item in shopify_order.line_items:
+        product_id = shopify_line_item.product_id
+        title = shopify_line_item.title
+        product = get_product(shopify_line_item, cache)
         if product is None:
             product = Product()
             product.shopify_id = product_id
@@ -236,118 +511,122 @@ def assure_products(shopify_order: shopify.Order):
                 print(f'ACHTUNG: {stub_msg}')
             product.active = False
             product.created_at = datetime.date.today()
-            product.school = get_school(shopify_order)
-
-            product.type_ = attributes.get('product_type', None)
+            product.school = get_school(shopify_order, cache)
+            # line items do not know the type of their product
+            product.type_ = None
 
             sess.add(product)
-            sess.commit()
+            cache.add(product, 'shopify_id' if product_id else 'name')
 
 
-def assure_variants(shopify_order: shopify.Order):
+def assure_variants(shopify_order: ShopifyOrder, cache: ImportCache):
     """
         Makes sure that the variants in this shopify_order are still existing
         in the shopify database. Otherwise creates a stub.
 
     """
-    for shopify_line_item in shopify_order.attributes['line_items']:
-        attributes = shopify_line_item.attributes
-        variant = get_variant(attributes, False)
+    for shopify_line_item in shopify_order.line_items:
+        variant = get_variant(shopify_line_item, cache)
         if variant is None:
-            product = get_product(attributes, require_result=True)
+            product = get_product(shopify_line_item, cache, require_result=True)
             variant = Variant()
-            variant_id = attributes['variant_id']
+            variant_id = shopify_line_item.variant_id
             variant.shopify_id = variant_id
             variant.active = False
             variant.product = product
             variant.size = 'stub'
             variant.color = 'stub'
             sess.add(variant)
-            sess.commit()
+            if variant_id:
+                cache.add(variant, 'shopify_id')
+            else:
+                sess.flush()
 
             stub_msg = f'Für Variante {variant_id} von Product {variant.product} wurde ein Stub generiert.'
             logging.warning(stub_msg)
             print(f'ACHTUNG: {stub_msg}')
 
 
-def get_variant(attributes, require_result=False):
-    variant_id = attributes['variant_id']
+def get_variant(shopify_line_item: ShopifyLineItem, cache: ImportCache, require_result=False) \
+        -> Union[Variant, None]:
+    variant_id = shopify_line_item.variant_id
     if variant_id:
-        variant = get(Variant, require_result=require_result, shopify_id=variant_id)
+        variant = cache.get(Variant, 'shopify_id', variant_id, require_result=require_result)
     # sometimes a variant does not have an id in the shopify db
     else:
-        product = get_product(attributes, True)
+        product = get_product(shopify_line_item, cache, True)
         variant = get(Variant, require_result=require_result, product=product)
     return variant
 
 
-def get_product(attributes, require_result=False):
-    product_id = attributes['product_id']
+def get_product(shopify_line_item: ShopifyLineItem, cache: ImportCache, require_result=False) \
+        -> Union[Product, None]:
+    product_id = shopify_line_item.product_id
     if product_id:
-        product = get(Product, require_result=require_result, shopify_id=product_id)
+        product = cache.get(Product, 'shopify_id', product_id, require_result=require_result)
     else:
-        product = get(Product, require_result=require_result, name=attributes['title'])
+        product = cache.get(Product, 'name', shopify_line_item.title, require_result=require_result)
     return product
 
 
-def add_line_items(order: Order, shopify_order: shopify.Order):
-    assure_products(shopify_order)
-    assure_variants(shopify_order)
-    for shopify_line_item in shopify_order.attributes['line_items']:
+def add_line_items(order: Order, shopify_order: ShopifyOrder, cache: ImportCache):
+    assure_products(shopify_order, cache)
+    assure_variants(shopify_order, cache)
+    for shopify_line_item in shopify_order.line_items:
         try:
-            attributes = shopify_line_item.attributes
             line_item = LineItem()
-            line_item.quantity = int(attributes['quantity'])
-            line_item.amount = to_cent(attributes['price'])
-            variant = get_variant(attributes)
+            line_item.quantity = int(shopify_line_item.quantity)
+            line_item.amount = to_cent(shopify_line_item.price)
+            variant = get_variant(shopify_line_item, cache, require_result=True)
             line_item.variant = variant
             line_item.order = order
         except NoResultFound as e:
-            msg = f'Produktvariante konnte nicht gefunden werden. ShopifyID der Variante: {attributes["variant_id"]}.'
+            msg = f'Produktvariante konnte nicht gefunden werden. ShopifyID der Variante: {shopify_line_item.variant_id}.'
             logging.warning(msg)
             print(f'ACHTUNG: {msg}')
-            raise e
+            raise ProductVariantMissing(msg) from e
 
 
-def update_or_create_product(shopify_product, active=True):
-    attributes = shopify_product.attributes
+def update_or_create_product(shopify_product: ShopifyProduct, cache: ImportCache, active=True):
     if shopify_product.id:
-        product = get(Product, shopify_id=shopify_product.id)
+        product = cache.get(Product, 'shopify_id', shopify_product.id)
     else:
-        product = get(Product, name=attributes['title'])
+        product = cache.get(Product, 'name', shopify_product.title)
     with sess.no_autoflush:
         if product is None:
             product = Product()
             product.shopify_id = shopify_product.id
+            product.name = shopify_product.title
             sess.add(product)
-        product.name = attributes['title']
-        product.type_ = attributes['product_type']
-        # 'status' is not always in shopify_product.attributes
+            # products without an id are looked up by their name, like the stubs of `assure_products`
+            cache.add(product, 'shopify_id' if shopify_product.id else 'name')
+        product.name = shopify_product.title
+        product.type_ = shopify_product.product_type
+        # the stream (active or archived products) tells the status
         product.active = active
-        product.created_at = to_date(attributes['created_at'])
-        product.variants = get_and_update_or_create_variants(shopify_product, product.variants)
-        tags = get_tags(attributes['tags'])
+        product.created_at = to_date(shopify_product.created_at)
+        product.variants = get_and_update_or_create_variants(shopify_product, product.variants, cache)
+        tags = get_tags(shopify_product.tags)
         if len(tags) != 0:
-            product.school = get_or_create(School, name=tags[0])
+            product.school = cache.get_or_create(School, 'name', tags[0])
         else:
             print(f'ACHTUNG: No school for product {product}.')
-    sess.commit()
     return product
 
 
-def get_and_update_or_create_variants(shopify_product: shopify.Product, variants: List[Variant]) -> List[Variant]:
+def get_and_update_or_create_variants(shopify_product: ShopifyProduct, variants: List[Variant],
+                                      cache: ImportCache) -> List[Variant]:
     active_variants = set()
-    shopify_variants = shopify_product.attributes['variants']
-    for shopify_variant in shopify_variants:
-        variant = get(Variant, shopify_id=shopify_variant.id)
+    for shopify_variant in shopify_product.variants:
+        variant = cache.get(Variant, 'shopify_id', shopify_variant.id)
         if not variant:
             variant = Variant()
             variant.shopify_id = shopify_variant.id
+            cache.add(variant, 'shopify_id')
 
-        variant_attributes = shopify_variant.attributes
         # the size (color) of a garment is usually stored in option1(2)
-        option1 = variant_attributes['option1']
-        option2 = variant_attributes['option2']
+        option1 = shopify_variant.option1
+        option2 = shopify_variant.option2
         warn_msg = f'ACHTUNG: "{{option}}" in Lineitem "{variant}" ist nicht in "{paths["resources"]}/{{list_}}.list". ' \
                    f'"{{option}}" wird daher nicht als {{attribute}} eingetragen. Ist "{{option}}" doch eine {{' \
                    f'attribute}}, so trage sie bitte in die Liste ein und aktualisiere die Daten erneut. '
@@ -373,3 +652,11 @@ def get_and_update_or_create_variants(shopify_product: shopify.Product, variants
 
 def to_date(date_str: str) -> datetime.date:
     return datetime.date.fromisoformat(date_str[:date_str.find('T')])
+
+
+def to_datetime(date_str: str) -> datetime.datetime:
+    """Parses shopify's timestamps as well as plain dates like "update_after". Times without a zone are UTC."""
+    timestamp = datetime.datetime.fromisoformat(date_str.replace('Z', '+00:00'))
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.replace(tzinfo=datetime.timezone.utc)
+    return timestamp
@@ -0,0 +1,104 @@
+from typing import List, NamedTuple, Optional
+
+# The importer reads only a few fields of Shopify's products and orders. Decoding the raw JSON straight into these
+# tuples is much cheaper than building `shopify.Product` and `shopify.Order` objects, which wrap every nested dict (line
+# items, addresses, prices, ...) in a resource object of its own.
+
+# top level fields requested from the API ("fields" parameter), everything else (images, fulfillments, tax lines, ...)
+# is not downloaded at all
+PRODUCT_FIELDS = ('id', 'title', 'product_type', 'created_at', 'updated_at', 'tags', 'variants')
+ORDER_FIELDS = ('id', 'name', 'created_at', 'updated_at', 'total_discounts', 'total_shipping_price_set', 'tags', 'note',
+                'billing_address', 'shipping_address', 'customer', 'line_items')
+CANCELLED_ORDER_FIELDS = ('id', 'name', 'updated_at')
+
+
+class ShopifyVariant(NamedTuple):
+    id: int
+    option1: Optional[str]
+    option2: Optional[str]
+
+
+class ShopifyProduct(NamedTuple):
+    id: Optional[int]
+    title: str
+    product_type: Optional[str]
+    created_at: str
+    updated_at: str
+    tags: str
+    variants: List[ShopifyVariant]
+
+
+class ShopifyAddress(NamedTuple):
+    first_name: Optional[str]
+    last_name: Optional[str]
+    address1: Optional[str]
+    address2: Optional[str]
+    city: Optional[str]
+    zip: Optional[str]
+
+
+class ShopifyCustomer(NamedTuple):
+    id: Optional[int]
+    email: Optional[str]
+    first_name: Optional[str]
+    last_name: Optional[str]
+
+
+class ShopifyLineItem(NamedTuple):
+    product_id: Optional[int]
+    variant_id: Optional[int]
+    title: Optional[str]
+    quantity: int
+    price: str
+
+
+class ShopifyOrder(NamedTuple):
+    id: int
+    name: str
+    created_at: str
+    updated_at: str
+    total_discounts: str
+    shipping: str
+    tags: str
+    note: Optional[str]
+    billing_address: Optional[ShopifyAddress]
+    customer: ShopifyCustomer
+    line_items: List[ShopifyLineItem]
+
+
+class ShopifyCancelledOrder(NamedTuple):
+    name: str
+    updated_at: str
+
+
+def decode_product(attributes: dict) -> ShopifyProduct:
+    return ShopifyProduct(attributes.get('id'), attributes['title'], attributes.get('product_type'),
+                          attributes['created_at'], attributes['updated_at'], attributes.get('tags', ''),
+                          [ShopifyVariant(variant['id'], variant.get('option1'), variant.get('option2'))
+                           for variant in attributes.get('variants', ())])
+
+
+def decode_address(attributes: Optional[dict]) -> Optional[ShopifyAddress]:
+    if attributes is None:
+        return None
+    return ShopifyAddress(attributes.get('first_name'), attributes.get('last_name'), attributes.get('address1'),
+                          attributes.get('address2'), attributes.get('city'), attributes.get('zip'))
+
+
+def decode_order(attributes: dict) -> ShopifyOrder:
+    customer = attributes.get('customer') or {}
+    return ShopifyOrder(attributes['id'], attributes['name'], attributes['created_at'], attributes['updated_at'],
+                        attributes.get('total_discounts', '0'),
+                        attributes['total_shipping_price_set']['shop_money']['amount'],
+                        attributes.get('tags', ''), attributes.get('note'),
+                        # the billing address is optional, the shipping address stands in for a missing one
+                        decode_address(attributes.get('billing_address') or attributes.get('shipping_address')),
+                        ShopifyCustomer(customer.get('id'), customer.get('email'), customer.get('first_name'),
+                                        customer.get('last_name')),
+                        [ShopifyLineItem(line_item.get('product_id'), line_item.get('variant_id'),
+                                         line_item.get('title'), line_item['quantity'], line_item['price'])
+                         for line_item in attributes.get('line_items', ())])
+
+
+def decode_cancelled_order(attributes: dict) -> ShopifyCancelledOrder:
+    return ShopifyCancelledOrder(attributes['name'], attributes['updated_at'])
@@ -0,0 +1,294 @@
+import csv
+import os
+import re
+import xml.etree.ElementTree as ET
+from datetime import date, datetime
+from typing import Callable, Dict, Iterator, List, NamedTuple, Optional
+
+from main.conf import settings
+from main.utils import Error, to_cent
+
+CSV = 'csv'
+CAMT053 = 'camt.053'
+MT940 = 'mt940'
+
+# bytes read to detect the format of a statement
+HEAD_SIZE = 4096
+# bytes read at once while searching the end of the last complete record
+TAIL_CHUNK_SIZE = 65536
+
+
+class UnknownStatementFormat(Error):
+    pass
+
+
+class StatementParser(NamedTuple):
+    """
+    detect: Tells from the first `HEAD_SIZE` bytes of a file (decoded as latin-1) whether the parser can read it.
+    parse: Yields the incoming transactions of a file as the column values of `Transaction` ("name", "iban",
+        "reference", "amount" and "date_"), one at a time. Parsers of append-only formats take the byte range to parse
+        as further arguments `start` and `end`.
+    complete_end: Returns the offset after the last complete record of a file, so a file which is still written can
+        be parsed up to there and the rest later on. None if the format can only be parsed as a whole.
+    """
+    detect: Callable[[str], bool]
+    parse: Callable[..., Iterator[dict]]
+    complete_end: Optional[Callable[[str], int]] = None
+
+
+# tried in the order of registration
+PARSERS: Dict[str, StatementParser] = {}
+
+
+def register_parser(format_: str, detect: Callable[[str], bool], parse: Callable[..., Iterator[dict]],
+                    complete_end: Callable[[str], int] = None):
+    PARSERS[format_] = StatementParser(detect, parse, complete_end)
+
+
+def detect_format(path: str) -> str:
+    with open(path, 'rb') as f:
+        head = f.read(HEAD_SIZE).decode('latin-1')
+    for format_, parser in PARSERS.items():
+        if parser.detect(head):
+            return format_
+    raise UnknownStatementFormat(f'Das Format der Datei "{path}" wurde nicht erkannt. Unterstützt werden: '
+                                 f'{", ".join(PARSERS)}.')
+
+
+def read_statement(path: str, format_: str = None, start=0, end: int = None) -> Iterator[dict]:
+    """
+    Yields the incoming transactions of a bank statement in any registered format.
+
+    Args:
+        start: The offset of the first record to parse. Only supported by append-only formats (see `is_appendable`).
+        end: The offset after the last record to parse, e.g. the result of `complete_end`. Defaults to the end of
+            the file.
+    """
+    parser = PARSERS[format_ or detect_format(path)]
+    if parser.complete_end is None:
+        if start or end is not None:
+            raise Error(f'Das Format der Datei "{path}" kann nur als Ganzes gelesen werden.')
+        return parser.parse(path)
+    return parser.parse(path, start, end)
+
+
+def is_appendable(format_: str) -> bool:
+    return PARSERS[format_].complete_end is not None
+
+
+def complete_end(path: str, format_: str) -> int:
+    """Returns the offset after the file's last complete record (the size of the file if not `is_appendable`)."""
+    parser = PARSERS[format_]
+    return os.path.getsize(path) if parser.complete_end is None else parser.complete_end(path)
+
+
+def read_lines(path: str, start=0, end: int = None, encoding='utf-8') -> Iterator[str]:
+    """Yields the decoded lines of the byte range from `start` to `end`, which must both be at the start of a line."""
+    with open(path, 'rb') as f:
+        f.seek(start)
+        position = start
+        for line in f:
+            if end is not None and position >= end:
+                return
+            position += len(line)
+            yield line.decode(encoding)
+
+
+def last_line_end(path: str, is_last_line: Callable[[bytes], bool] = None) -> int:
+    """
+    Returns the offset after the last line which is terminated by a newline and, if given, fulfills `is_last_line`.
+    The file is searched from its end, so only the lines after the returned offset are read. 0 if there is no such line.
+
+    """
+    with open(path, 'rb') as f:
+        chunk_start = f.seek(0, os.SEEK_END)
+        # the part of the file before `chunk_start` which is not searched yet
+        unchecked = b''
+        while chunk_start > 0:
+            previous_start = chunk_start
+            chunk_start = max(0, chunk_start - TAIL_CHUNK_SIZE)
+            f.seek(chunk_start)
+            unchecked = f.read(previous_start - chunk_start) + unchecked
+            line_end = len(unchecked)
+            while True:
+                newline = unchecked.rfind(b'\n', 0, line_end)
+                if newline == -1:
+                    break
+                line_start = unchecked.rfind(b'\n', 0, newline) + 1
+                if line_start == 0 and chunk_start > 0:
+                    # the line might start before the chunk
+                    break
+                if is_last_line is None or is_last_line(unchecked[line_start:newline].rstrip(b'\r')):
+                    return chunk_start + newline + 1
+                line_end = newline
+            unchecked = unchecked[:line_end]
+    return 0
+
+
+def transaction(name: Optional[str], iban: Optional[str], reference: Optional[str], amount: int, date_: date) \
+        -> dict:
+    return {'name': name or '', 'iban': iban or '', 'reference': reference or '', 'amount': amount, 'date_': date_}
+
+
+# CSV export of the online banking
+def is_csv(head: str) -> bool:
+    header = head.splitlines()[0] if head else ''
+    return all(column in header for column in ('Amount', 'Counterparty', 'Valuta Date'))
+
+
+def read_csv(path: str, start=0, end: int = None) -> Iterator[dict]:
+    INDEX = 'Index'
+    AMOUNT = 'Amount'
+    PAYMENT_REFERENCE = 'Payment reference'
+    NAME = 'Counterparty'
+    IBAN = 'Account number'
+
+    lines = read_lines(path, start, end)
+    # rows appended later on are read without the header at the start of the file
+    header = None if start == 0 else next(csv.reader(read_lines(path)), None)
+    reader = csv.DictReader(lines, header)
+    for row in reader:
+        index_ = int(row[INDEX])
+        try:
+            amount = convert_number(row[AMOUNT])
+        except ValueError as e:
+            print(f'CSV-Datei-Index {index_}: {row[AMOUNT]} konnte nicht zu einer Zahl formatiert werden.')
+            raise e
+        date_ = datetime.strptime(row['Valuta Date'], '%d/%m/%Y').date()
+        if amount > 0:
+            yield transaction(row[NAME], row[IBAN], row[PAYMENT_REFERENCE], amount, date_)
+
+
+def convert_number(number):
+    number = number.replace(',', '')
+    return to_cent(number)
+
+
+# ISO 20022 bank to customer statement (camt.053), any version
+def is_camt053(head: str) -> bool:
+    return head.lstrip().startswith('<') and 'camt.053' in head
+
+
+def read_camt053(path: str) -> Iterator[dict]:
+    """
+    Parses the entries ("Ntry") one by one while the file is read. Every parsed entry is removed from the tree, so
+    the memory used does not grow with the size of the statement.
+
+    """
+    ns = {}
+    parents: List[ET.Element] = []
+    for event, elem in ET.iterparse(path, events=('start', 'end')):
+        if event == 'start':
+            if not ns:
+                ns['c'] = elem.tag[1:].split('}')[0] if elem.tag.startswith('{') else ''
+            parents.append(elem)
+            continue
+        parents.pop()
+        if elem.tag.rsplit('}', 1)[-1] != 'Ntry':
+            continue
+        yield from camt053_entry_transactions(elem, ns)
+        elem.clear()
+        if parents:
+            parents[-1].remove(elem)
+
+
+def camt053_entry_transactions(entry: ET.Element, ns: Dict[str, str]) -> Iterator[dict]:
+    def qualified(path: str) -> str:
+        return 'c:' + path.replace('/', '/c:') if ns['c'] else path
+
+    def text(elem: ET.Element, path: str) -> Optional[str]:
+        found = elem.find(qualified(path), ns)
+        return found.text.strip() if found is not None and found.text else None
+
+    if text(entry, 'CdtDbtInd') != 'CRDT' or text(entry, 'RvslInd') == 'true':
+        return
+    date_str = text(entry, 'ValDt/Dt') or text(entry, 'BookgDt/Dt') or (text(entry, 'BookgDt/DtTm') or '')[:10]
+    date_ = date.fromisoformat(date_str)
+    details = entry.findall(qualified('NtryDtls/TxDtls'), ns)
+    for detail in details or [entry]:
+        # a batch entry holds the amount of each of its transactions in the transaction's details
+        amount = (text(detail, 'AmtDtls/TxAmt/Amt') or text(detail, 'Amt')) if details else None
+        references = [elem.text.strip() for elem in detail.iterfind('.//' + qualified('RmtInf/Ustrd'), ns)
+                      if elem.text]
+        reference = ' '.join(references) or text(detail, 'RmtInf/Strd/CdtrRefInf/Ref') \
+            or text(entry, 'AddtlNtryInf')
+        name = text(detail, 'RltdPties/Dbtr/Nm') or text(detail, 'RltdPties/Dbtr/Pty/Nm') \
+            or text(detail, 'RltdPties/UltmtDbtr/Nm')
+        iban = text(detail, 'RltdPties/DbtrAcct/Id/IBAN') or text(detail, 'RltdPties/DbtrAcct/Id/Othr/Id')
+        yield transaction(name, iban, reference, to_cent(amount or text(entry, 'Amt')), date_)
+
+
+# SWIFT MT940 (with the structured field 86 German banks use)
+MT940_STATEMENT_LINE = re.compile(r'(?P<value_date>\d{6})(?P<entry_date>\d{4})?(?P<mark>R?[CD])(?P<funds_code>[A-Z])?'
+                                  r'(?P<amount>\d+,\d*)')
+# subfields of field 86 holding the remittance information, the counterparty's name and account
+MT940_REFERENCE_SUBFIELDS = ('20', '21', '22', '23', '24', '25', '26', '27', '28', '29', '60', '61', '62', '63')
+MT940_NAME_SUBFIELDS = ('32', '33')
+MT940_IBAN_SUBFIELD = '31'
+
+
+def is_mt940(head: str) -> bool:
+    return bool(re.search(r'^:20:', head, re.MULTILINE) and re.search(r'^:(25|60F|61):', head, re.MULTILINE))
+
+
+def read_mt940(path: str, start=0, end: int = None) -> Iterator[dict]:
+    """Reads the statement line by line. Only the fields of the current transaction are held in memory."""
+    statement_line = None
+    for tag, content in mt940_fields(read_lines(path, start, end, settings.get('mt940_encoding', 'latin-1'))):
+        if tag == '61':
+            if statement_line is not None:
+                yield from mt940_transaction(statement_line, '')
+            statement_line = content
+        elif tag == '86' and statement_line is not None:
+            yield from mt940_transaction(statement_line, content)
+            statement_line = None
+    if statement_line is not None:
+        yield from mt940_transaction(statement_line, '')
+
+
+def mt940_complete_end(path: str) -> int:
+    # appended statements end with a line "-"; files without these are read up to their last line
+    return last_line_end(path, lambda line: line.startswith(b'-')) or last_line_end(path)
+
+
+def mt940_fields(lines: Iterator[str]) -> Iterator[tuple]:
+    """Yields the tag and the content of each field. Fields may continue over several lines."""
+    tag = None
+    field_lines = []
+    for line in lines:
+        line = line.rstrip('\r\n')
+        match = re.match(r':(\d{2}[A-Z]?):', line)
+        if match or line.startswith('-') or line.startswith('{'):
+            if tag is not None:
+                yield tag, '\n'.join(field_lines)
+            tag, field_lines = (match.group(1), [line[match.end():]]) if match else (None, [])
+        elif tag is not None:
+            field_lines.append(line)
+    if tag is not None:
+        yield tag, '\n'.join(field_lines)
+
+
+def mt940_transaction(statement_line: str, information: str) -> Iterator[dict]:
+    match = MT940_STATEMENT_LINE.match(statement_line)
+    if match is None:
+        raise Error(f'Ungültige MT940-Umsatzzeile: "{statement_line}"')
+    if match.group('mark') != 'C':
+        return
+    date_ = datetime.strptime(match.group('value_date'), '%y%m%d').date()
+    amount = to_cent(match.group('amount').replace(',', '.'))
+    information = information.replace('\n', '')
+    if len(information) > 3 and information[3] == '?':
+        subfields = {}
+        for subfield in information[4:].split('?'):
+            subfields[subfield[:2]] = subfields.get(subfield[:2], '') + subfield[2:]
+        reference = ''.join(subfields.get(key, '') for key in MT940_REFERENCE_SUBFIELDS)
+        name = ''.join(subfields.get(key, '') for key in MT940_NAME_SUBFIELDS)
+        iban = subfields.get(MT940_IBAN_SUBFIELD)
+    else:
+        reference, name, iban = information, None, None
+    yield transaction(name, iban, reference, amount, date_)
+
+
+register_parser(CSV, is_csv, read_csv, last_line_end)
+register_parser(CAMT053, is_camt053, read_camt053)
+register_parser(MT940, is_mt940, read_mt940, mt940_complete_end)
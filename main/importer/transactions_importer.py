@@ -1,18 +1,22 @@
-import csv
+import hashlib
 import logging
 import os
-import re
-import sqlite3
-from datetime import datetime
-from typing import List, Set
+import time
+from typing import Dict, List, Optional, Set, Tuple
 
-import sqlalchemy
+from sqlalchemy import bindparam, or_
 
-from main import utils
+from main import conf, utils
 from main.conf import paths, settings
 from main.db.orm import Transaction, OrderTransaction, Order, sess
+from main.db.sqlalchemy_utils import chunked, upsert
+from main.importer.amount_matcher import AmountMatch, AmountMatcher
+from main.importer.order_balances import OrderBalance, load_order_balances
+from main.importer.order_nr_matcher import OrderNrMatcher
+from main.importer.payer_index import PayerIndex, payer_customers, record_payment
+from main.importer.statement_parsers import UnknownStatementFormat, complete_end, detect_format, is_appendable, \
+    read_statement
 from main.utils import Error
-from main.utils import to_cent
 
 
 class UnexpectedOrderAmountSum(Error):
@@ -20,77 +24,209 @@ class UnexpectedOrderAmountSum(Error):
         super(msg)
 
 
-def import_transactions():
-    filepath = get_trasaction_file()
-
-    INDEX = 'Index'
-    AMOUNT = 'Amount'
-    PAYMENT_REFERENCE = 'Payment reference'
-    NAME = 'Counterparty'
-    IBAN = 'Account number'
-    print(f'Transaktionen in Datei "{filepath}" werden importiert.')
-
-    with open(filepath, encoding='utf-8') as f:
-        reader = csv.DictReader(f)
-        print(f'Importiere alle Transaktionen.')
-        for row in reader:
-            index_ = int(row[INDEX])
-            try:
-                amount = convert_number(row[AMOUNT])
-            except ValueError as e:
-                print(f'CSV-Datei-Index {index_}: {row[AMOUNT]} konnte nicht zu einer Zahl formatiert werden.')
-                raise e
-            date_ = datetime.strptime(row['Valuta Date'], '%d/%m/%Y').date()
-            if amount > 0:
-                try:
-                    transaction = Transaction()
-                    transaction.amount = amount
-                    transaction.reference = row[PAYMENT_REFERENCE]
-                    transaction.name = row[NAME]
-                    transaction.iban = row[IBAN]
-                    transaction.date_ = date_
-                    sess.add(transaction)
-                    sess.commit()
-                    logging.info(f'{transaction} hinzugefügt.')
-                except (sqlite3.IntegrityError, sqlalchemy.exc.IntegrityError):
-                    sess.rollback()
-                    logging.info(f'{transaction} bereits importiert.')
-
-
-def get_trasaction_file() -> str:
-    TRANSACTION_FILE_KEYWORD = 'transaction'
-    transaction_files = list(
-        filter(lambda name: TRANSACTION_FILE_KEYWORD in name.lower(), os.listdir(paths['transactions'])))
+# rows which are inserted with one statement
+CHUNK_SIZE = 500
+# the unique constraint of `Transaction`
+TRANSACTION_KEY = ('name', 'iban', 'reference', 'date_', 'amount')
+# bytes hashed at the start and at the end of the imported part of a transaction file
+FINGERPRINT_SIZE = 4096
+# seconds after which a file which was not modified anymore is considered complete, i.e. its last record is read even
+# if it is not terminated by a newline
+SETTLE_TIME = 2
+
+
+def import_transactions(quiet=False) -> int:
+    """
+    Imports the new transactions of every bank statement in the transactions folder (see `get_transaction_files` and
+    `import_new_transactions`).
+
+    Returns:
+        The number of imported transactions.
+    """
+    transaction_files = get_transaction_files()
+    names = {os.path.basename(filepath) for filepath in transaction_files}
+    for name in conf.get_statement_offsets().keys() - names:
+        conf.save_statement_offset(name, None)
+    inserted = 0
+    for filepath in transaction_files:
+        inserted += import_new_transactions(filepath, quiet) or 0
+    return inserted
+
+
+def import_new_transactions(filepath: str, quiet=False) -> Optional[int]:
+    """
+    Imports the transactions which were added to the file since it was imported the last time.
+
+    The size, modification time and a fingerprint of the imported part of every file are stored in internal_paras.json
+    (see `file_state`). Unchanged files are not read at all. Files of append-only formats (see
+    `statement_parsers.is_appendable`) whose imported part is unchanged are only parsed from where the last import
+    stopped, up to their last complete record. A record at the end of a file which was not modified for `SETTLE_TIME`
+    seconds is complete, even without a terminating newline. Any other change leads to importing the whole file again,
+    the transactions already imported are skipped then. Files whose format is not recognized are skipped.
+
+    Args:
+        quiet: Whether to omit the message about unchanged files.
+
+    Returns:
+        The number of imported transactions, None if the file was unchanged or skipped.
+    """
+    name = os.path.basename(filepath)
+    state = conf.get_statement_offsets().get(name)
+    stat = os.stat(filepath)
+    if state is not None and state['size'] == stat.st_size and state['mtime'] == stat.st_mtime_ns \
+            and state['offset'] >= stat.st_size:
+        if not quiet:
+            print(f'Die Datei "{filepath}" ist seit dem letzten Import unverändert.')
+        return None
+    try:
+        format_ = detect_format(filepath)
+    except UnknownStatementFormat as e:
+        logging.warning(e)
+        print(f'ACHTUNG: {e} Die Datei wird übersprungen.')
+        conf.save_statement_offset(name, file_state(filepath, stat.st_size, stat))
+        return None
+    start = 0
+    if state is not None and is_appendable(format_) and state['offset'] <= stat.st_size \
+            and fingerprint(filepath, state['offset']) == state['fingerprint']:
+        start = state['offset']
+    end = complete_end(filepath, format_)
+    if end < stat.st_size and time.time_ns() - stat.st_mtime_ns >= SETTLE_TIME * 10 ** 9:
+        # the file is not written anymore, so its unterminated last line is a complete record
+        end = stat.st_size
+    if end <= start:
+        # nothing but an incomplete record was appended
+        conf.save_statement_offset(name, file_state(filepath, start, stat))
+        return None
+    part = 'im neuen Teil der Datei' if start else 'in der Datei'
+    print(f'Transaktionen {part} "{filepath}" ({format_}) werden importiert.')
+    inserted, skipped = import_transaction_file(filepath, format_, start, end if is_appendable(format_) else None)
+    conf.save_statement_offset(name, file_state(filepath, end, stat))
+    msg = f'{inserted} neue Transaktionen importiert, {skipped} bereits importierte übersprungen.'
+    logging.info(f'{filepath} ab Byte {start}: {msg}')
+    print(msg)
+    return inserted
+
+
+def file_state(filepath: str, offset: int, stat: os.stat_result) -> dict:
+    """The part of the file up to `offset` is imported. `stat` is the file's status before it was imported."""
+    return {'offset': offset, 'size': stat.st_size, 'mtime': stat.st_mtime_ns,
+            'fingerprint': fingerprint(filepath, offset)}
+
+
+def fingerprint(filepath: str, offset: int) -> str:
+    """
+    Hashes the first and the last `FINGERPRINT_SIZE` bytes before `offset`. Tells with constant effort whether the
+    part of a file which was imported was replaced rather than appended to.
+
+    """
+    digest = hashlib.sha256(str(offset).encode())
+    with open(filepath, 'rb') as f:
+        digest.update(f.read(min(offset, FINGERPRINT_SIZE)))
+        f.seek(max(0, offset - FINGERPRINT_SIZE))
+        digest.update(f.read(min(offset, FINGERPRINT_SIZE)))
+    return digest.hexdigest()
+
+
+def import_transaction_file(filepath: str, format_: str = None, start=0, end: int = None) -> Tuple[int, int]:
+    """
+    Inserts the file's transactions in chunks within one database transaction. Transactions which were already
+    imported (see the unique constraint of `Transaction`) are skipped by the database, so a file can be imported again
+    and again.
+
+    Args:
+        format_: The format of the bank statement. If None, it is detected from the file's content.
+        start, end: The byte range to import (see `statement_parsers.read_statement`).
+
+    Returns:
+        The number of inserted and skipped transactions.
+    """
+    inserted = 0
+    n_rows = 0
+    try:
+        for chunk in chunked(read_statement(filepath, format_, start, end), CHUNK_SIZE):
+            n_rows += len(chunk)
+            inserted += upsert(Transaction, chunk, TRANSACTION_KEY)
+        sess.commit()
+    except BaseException:
+        sess.rollback()
+        raise
+    return inserted, n_rows - inserted
+
+
+def get_transaction_files() -> List[str]:
+    """Returns the files of the transactions folder, e.g. CSV exports, CAMT.053 or MT940 statements of the bank."""
+    folder = paths['transactions']
+    transaction_files = sorted(name for name in os.listdir(folder)
+                               if not name.startswith('.') and os.path.isfile(os.path.join(folder, name)))
     if not transaction_files:
-        raise FileNotFoundError('Bitte speichere eine Datei, deren Namen {TRANSACTION_FILE_KEYWORD} enthält im Ordner '
-                                '" ' + paths["transactions"] + '".')
+        raise FileNotFoundError(f'Bitte speichere die Kontoauszüge (CSV, CAMT.053 oder MT940) im Ordner "{folder}".')
 
-    return f'{paths["transactions"]}/{transaction_files[0]}'
+    return [f'{folder}/{name}' for name in transaction_files]
 
 
-def associate_transactions() -> List[Transaction]:
+def associate_transactions(match_amounts: bool = None) -> Tuple[List[Transaction], Dict[int, AmountMatch]]:
     """
     Tries to automatically associate the database's transactions to the orders they paid for.
     It does so by analysing a transaction's reference.
 
+    The balances of all orders and the unassociated amounts of all open transactions are loaded with one query each.
+    The associations are planned in memory, in the same order and with the same results as `associate_transaction`
+    would create them one by one, and written within one database transaction.
+
+    Transactions without an order nr are matched to open orders by their amount and name (see `AmountMatcher`). The
+    best match is associated if its confidence reaches "amount_match_threshold" in the settings, otherwise it is
+    returned as a proposal for the user. Open orders of customers the payer paid for before count as
+    named (see `PayerIndex`), the index learns from every planned association at once.
+
+    Args:
+        match_amounts: Whether to match transactions without an order nr by their amount. Defaults to
+            "match_amounts" in the settings.
+
     Returns:
-        Transactions which could not be automatically imported AND have the associate flag set to True.
+        Transactions which could not be automatically imported AND have the associate flag set to True, and the
+        proposals for some of them by their id.
 
     """
-    transactions: List[Transaction] = sess.query(Transaction).filter(
-        Transaction.associated_completely == False,
-        Transaction.associate == True).all()
+    if match_amounts is None:
+        match_amounts = settings.get('match_amounts', True)
+    threshold = settings.get('amount_match_threshold', 0.85)
+    orders = load_order_balances()
+    orders_by_id = {order.id: order for order in orders.values()}
+    payer_index = PayerIndex.load()
+    matcher = OrderNrMatcher.from_settings(known_nrs=orders.keys())
+    amount_matcher = AmountMatcher(orders.values(), settings.get('amount_match_max_orders', 3)) \
+        if match_amounts else None
+    order_transactions = []
     problematic_transactions = []
-    for transaction in transactions:
-        nrs = get_order_nrs(transaction.reference)
-        orders = sess.query(Order).filter(Order.nr.in_(nrs)).all()
-        if len(orders) == len(nrs):
-            if len(orders) != 0:
-                associate_transaction(transaction, orders, False)
-                if transaction.unassociated_amount > 0:
+    proposals = {}
+    for transaction, unassociated_amount in load_open_transactions():
+        nrs = get_order_nrs(transaction.reference, matcher)
+        match = None
+        if not nrs and amount_matcher is not None:
+            match = amount_matcher.match(transaction.name, unassociated_amount,
+                                         payer_index.lookup(transaction.iban, transaction.name))
+            if match is not None and match.confidence < threshold:
+                proposals[transaction.id] = match
+                match = None
+            elif match is not None:
+                logging.info(f'Transaktion {transaction} bezahlt laut Betrag und Name die Bestellungen {match}.')
+        if all(nr in orders for nr in nrs):
+            if len(nrs) != 0 or match is not None:
+                # the order of the rows `Order.nr.in_(nrs)` yields (by the unique index of "nr")
+                paid_orders = [orders[nr] for nr in sorted(nrs)] if nrs else match.orders
+                n_planned = len(order_transactions)
+                unassociated_amount = plan_associations(transaction, unassociated_amount, paid_orders,
+                                                        order_transactions)
+                for order_transaction in order_transactions[n_planned:]:
+                    payer_index.record(transaction.iban, transaction.name,
+                                       orders_by_id[order_transaction['order_id']].customer_id)
+                if amount_matcher is not None:
+                    for order in paid_orders:
+                        amount_matcher.update(order)
+                if unassociated_amount > 0:
                     logging.warning(
-                        f'{transaction.unassociated_amount} Cent der Transaktion konnten keiner Bestellung zugewiesen werden.')
-                    if transaction.unassociated_amount > 100:
+                        f'{unassociated_amount} Cent der Transaktion konnten keiner Bestellung zugewiesen werden.')
+                    if unassociated_amount > 100:
                         problematic_transactions += [transaction]
             else:
                 logging.info(f'In der Transaktion {transaction} konnte keine Bestellnr. gefunden werden.')
@@ -100,8 +236,68 @@ def associate_transactions() -> List[Transaction]:
                          f' Referenzierte Bestellungen: {nrs}.')
             problematic_transactions += [transaction]
 
-    sess.commit()
-    return problematic_transactions
+    try:
+        if order_transactions:
+            sess.execute(OrderTransaction.__table__.insert(), order_transactions)
+        decrees = [{'order_id': order.id, 'decree': order.decree} for order in orders.values()
+                   if order.decree != order.stored_decree]
+        if decrees:
+            sess.execute(Order.__table__.update().where(Order.id == bindparam('order_id')).values(
+                decree=bindparam('decree')), decrees)
+        payer_index.save()
+        sess.commit()
+    except BaseException:
+        sess.rollback()
+        raise
+    return problematic_transactions, proposals
+
+
+def load_open_transactions() -> List[Tuple[Transaction, int]]:
+    """Returns the transactions to associate (see `Transaction.associate`) with their unassociated amount."""
+    unassociated_amount = Transaction.stored_unassociated_amount
+    # two ranges instead of "!= 0", so the index of the stored balance is used
+    return sess.query(Transaction, unassociated_amount) \
+        .filter(Transaction.associate == True, or_(unassociated_amount > 0, unassociated_amount < 0)) \
+        .order_by(Transaction.id).all()
+
+
+def plan_associations(transaction: Transaction, unassociated_amount: int, orders: List[OrderBalance],
+                      order_transactions: List[dict]) -> int:
+    """
+    Plans the associations `associate_transaction` would create (and prints the same messages).
+
+    Returns:
+        The amount of the transaction which is left unassociated.
+    """
+    remaining = unassociated_amount
+    paid_orders = []
+    for order in orders:
+        if remaining > 0 and order.unpaid_amount > 0:
+            paying = min(order.unpaid_amount, remaining)
+            remaining -= paying
+            uncovered = order.unpaid_amount
+            order.associated_amount += paying
+            order_transactions.append({'order_id': order.id, 'transaction_id': transaction.id, 'amount': paying})
+            paid_orders.append(order)
+            logging.info(f'\tTransaktion {transaction} bezahlt {paying} Cent für Bestellung {order}.')
+            if paying != uncovered:
+                if order.unpaid_amount <= settings['ignore_missing_payment_max']:
+                    order.decree = order.unpaid_amount
+                    print(f'ACHTUNG: Der Bestellung {order} wurden {order.decree} Cent erlassen.')
+                else:
+                    print(
+                        f'ACHTUNG: Transaktion {transaction} kann die Bestellung {order} nicht komplett bezahlen. Es '
+                        f'fehlen noch {order.unpaid_amount} Cent.')
+        elif order.unpaid_amount == 0:
+            print(f'ACHTUNG: Bestellung {order} wurde bereits bezahlt.')
+        elif remaining == 0:
+            print(
+                f'ACHTUNG: Bestellung {order} kann nicht mehr bezahlt werden. Die zur Transaktion zugewiesenen '
+                f'Bestellungen schöpfen bereits den Betrag der Transaktion aus. Zugewiesene Bestellungen: '
+                f'{utils.iterable_to_str(transaction.orders + paid_orders)}.')
+        else:
+            raise Error('Should not happen-Error.')
+    return remaining
 
 
 def associate_transaction(transaction: Transaction, orders: List[Order], detailed=False, user_mode=True):
@@ -117,6 +313,7 @@ def associate_transaction(transaction: Transaction, orders: List[Order], detaile
             order_transaction.amount = paying
             order_transaction.transaction = transaction
             sess.add(order_transaction)
+            record_payment(transaction, order)
             msg = f'\tTransaktion {transaction} bezahlt {paying} Cent für Bestellung {order}.'
             if detailed:
                 print(f'INFO: {msg}')
@@ -146,26 +343,20 @@ def associate_transaction(transaction: Transaction, orders: List[Order], detaile
     sess.commit()
 
 
+def get_payer_open_orders(transaction: Transaction) -> List[Order]:
+    """Returns the open orders of the customers the transaction's payer paid for before (see `PayerIndex`)."""
+    customer_ids = payer_customers(transaction.iban, transaction.name)
+    if not customer_ids:
+        return []
+    return [order for order in sess.query(Order).filter(Order.customer_id.in_(customer_ids)).order_by(Order.nr)
+            if order.unpaid_amount > 0]
+
+
 def set_associate_to_false(transaction: Transaction):
     transaction.associate = False
     sess.commit()
 
 
-def convert_number(number):
-    number = number.replace(',', '')
-    return to_cent(number)
-
-
-def get_order_nrs(reference) -> Set[str]:
-    orders = set()
-    if re.search(r"ABI\d{4}\d?", reference, re.IGNORECASE):
-        orders |= set(re.findall(r"ABI\d{4}\d?", reference, re.IGNORECASE))
-    if re.search(r"ABI \d{4}\d?", reference, re.IGNORECASE):
-        order_nr = re.findall(r"ABI \d{4}d?", reference, re.IGNORECASE)
-        orders |= set([o.replace(" ", "") for o in order_nr])
-    if re.search(r"AB/\d{4}\d?", reference, re.IGNORECASE):
-        order_nr = re.findall(r"AB/\d{4}d?", reference, re.IGNORECASE)
-        orders |= set([o.replace("/", "I") for o in order_nr])
-    if len(orders) != 0:
-        return set(map(str.upper, orders))
-    return orders
+def get_order_nrs(reference: str, matcher: OrderNrMatcher = None) -> Set[str]:
+    """Returns the order nrs referenced in `reference` (see `OrderNrMatcher`, configured in the settings by default)."""
+    return (matcher or OrderNrMatcher.from_settings()).match(reference)
@@ -0,0 +1,189 @@
+import contextlib
+import json
+import os
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+from typing import List, Optional
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# statements whose row count is counted as rows written
+WRITE_STATEMENTS = ('INSERT', 'UPDATE', 'DELETE', 'REPLACE')
+
+# the columns of the summary table: counter, heading and the divisor of the value shown
+COLUMNS = [('sql_statements', 'SQL', 1), ('rows_written', 'Zeilen', 1), ('api_pages', 'Seiten', 1),
+           ('api_bytes', 'KB', 1024), ('cache_hits', 'Cache-Treffer', 1), ('cache_misses', 'Cache-Fehlschläge', 1)]
+
+
+class Phase:
+    def __init__(self, name: str):
+        self.name = name
+        self.duration = 0.0
+        self.counters = Counter()
+
+    @property
+    def cache_hit_rate(self) -> Optional[float]:
+        lookups = self.counters['cache_hits'] + self.counters['cache_misses']
+        return self.counters['cache_hits'] / lookups if lookups else None
+
+    def to_dict(self) -> dict:
+        return {'name': self.name, 'duration': round(self.duration, 6), 'cache_hit_rate': self.cache_hit_rate,
+                **self.counters}
+
+
+class Profile:
+    """
+    The wall time and the counters of each phase of one run of a command (see `start`). Counts outside any phase are
+    recorded in the phase "sonstiges".
+
+    """
+
+    def __init__(self, command: str):
+        self.command = command
+        self.started_at = datetime.now()
+        # the wall time of the whole run, set by `stop`
+        self.duration: Optional[float] = None
+        self._start_time = time.perf_counter()
+        self.phases: List[Phase] = []
+        self.caches = []
+        self._current: Optional[Phase] = None
+        self._lock = threading.Lock()
+
+    def count(self, counter: str, n=1):
+        with self._lock:
+            if self._current is None:
+                self._current = self.phase_named('sonstiges')
+            self._current.counters[counter] += n
+
+    def phase_named(self, name: str) -> Phase:
+        for phase in self.phases:
+            if phase.name == name:
+                return phase
+        self.phases.append(Phase(name))
+        return self.phases[-1]
+
+    def cache_counters(self) -> Counter:
+        return Counter({'cache_hits': sum(cache.hits for cache in self.caches),
+                        'cache_misses': sum(cache.misses for cache in self.caches),
+                        'cache_queries': sum(cache.queries for cache in self.caches)})
+
+    def total(self) -> Phase:
+        total = Phase('gesamt')
+        for phase in self.phases:
+            total.duration += phase.duration
+            total.counters.update(phase.counters)
+        if self.duration is not None:
+            total.duration = self.duration
+        return total
+
+    def to_dict(self) -> dict:
+        return {'command': self.command, 'started_at': self.started_at.isoformat(timespec='seconds'),
+                'phases': [phase.to_dict() for phase in self.phases], 'total': self.total().to_dict()}
+
+    def summary(self) -> str:
+        """A table with a row for each phase and the totals."""
+        headings = ['Phase', 'Zeit (s)'] + [heading for counter, heading, divisor in COLUMNS] + ['Trefferquote']
+        rows = []
+        for phase in self.phases + [self.total()]:
+            hit_rate = phase.cache_hit_rate
+            rows.append([phase.name, f'{phase.duration:.2f}']
+                        + [f'{phase.counters[counter] / divisor:.0f}' for counter, heading, divisor in COLUMNS]
+                        + ['-' if hit_rate is None else f'{hit_rate:.1%}'])
+        widths = [max(len(row[i]) for row in [headings] + rows) for i in range(len(headings))]
+        lines = ['  '.join(cell.ljust(width) if i == 0 else cell.rjust(width)
+                           for i, (cell, width) in enumerate(zip(row, widths))) for row in [headings] + rows]
+        lines.insert(1, '-' * len(lines[0]))
+        lines.insert(-1, '-' * len(lines[0]))
+        return '\n'.join(lines)
+
+    def write_report(self, directory: str) -> str:
+        """Writes the profile as JSON to a file of its own in `directory` and returns its path."""
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, f'{self.command}_{self.started_at:%Y-%m-%d_%H-%M-%S}.json')
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(self.to_dict(), f, ensure_ascii=False, indent=2)
+        return path
+
+
+# the profile of the running command, None if profiling is off
+_profile: Optional[Profile] = None
+
+
+def start(command: str) -> Profile:
+    """
+    Starts profiling a command. Until `stop`, every SQL statement of SQLAlchemy is counted, and the instrumented code
+    records its phases (see `phase`) and counts (see `count`). While profiling is off, neither costs more than a
+    function call.
+
+    """
+    global _profile
+    _profile = Profile(command)
+    event.listen(Engine, 'before_cursor_execute', _count_statement)
+    event.listen(Engine, 'after_cursor_execute', _count_rows_written)
+    return _profile
+
+
+def stop() -> Optional[Profile]:
+    global _profile
+    profile, _profile = _profile, None
+    if profile is not None:
+        profile.duration = time.perf_counter() - profile._start_time
+        event.remove(Engine, 'before_cursor_execute', _count_statement)
+        event.remove(Engine, 'after_cursor_execute', _count_rows_written)
+    return profile
+
+
+@contextlib.contextmanager
+def _timed_phase(profile: Profile, name: str):
+    with profile._lock:
+        outer = profile._current
+        profile._current = profile.phase_named(name)
+    caches_before = profile.cache_counters()
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        with profile._lock:
+            profile._current.duration += time.perf_counter() - start_time
+            profile._current.counters.update(profile.cache_counters() - caches_before)
+            profile._current = outer
+
+
+_NO_PHASE = contextlib.nullcontext()
+
+
+def phase(name: str):
+    """
+    A context manager measuring the wall time of a phase, e.g. `with profiling.phase('Bestellungen'): ...`. The counts
+    recorded meanwhile belong to the phase, also those of background threads, e.g. the pages downloaded while the
+    previous ones are imported. Phases with the same name are added up. Phases must not be nested, an outer phase
+    would miss the counts of the inner one.
+
+    """
+    if _profile is None:
+        return _NO_PHASE
+    return _timed_phase(_profile, name)
+
+
+def count(counter: str, n=1):
+    """Adds `n` to a counter of the current phase, e.g. "api_pages"."""
+    if _profile is not None:
+        _profile.count(counter, n)
+
+
+def track_cache(cache):
+    """Adds the hits and misses of an `ImportCache` to the phases running while it is used."""
+    if _profile is not None:
+        _profile.caches.append(cache)
+
+
+def _count_statement(conn, cursor, statement, parameters, context, executemany):
+    count('sql_statements')
+
+
+def _count_rows_written(conn, cursor, statement, parameters, context, executemany):
+    if statement.lstrip()[:7].upper().startswith(WRITE_STATEMENTS) and cursor.rowcount > 0:
+        count('rows_written', cursor.rowcount)
@@ -2,19 +2,26 @@ import cmd
 import logging
 import os
 import sqlite3
+import time
 import traceback
-from typing import List
+from typing import Dict, List
 
 from sqlalchemy.orm.exc import NoResultFound
 
-from main.conf import paths
-from main import utils, conf
-from main.importer import shopify_importer, transactions_importer
-from main.db.orm import Transaction, OrderTransaction, Order, update_schemas
+from main.conf import paths, settings
+from main import profiling, utils
+from main.importer import bulk_importer, shopify_importer, transactions_importer
+from main.db import balances
+from main.db.orm import Transaction, OrderTransaction, Order, sess, update_schemas
+from main.importer.amount_matcher import AmountMatch
 from main.importer.shopify_importer import OrderNrNotFound
-from main.db.sqlalchemy_utils import count, get
+from main.importer.page_cache import RECORD, REPLAY
+from main.db.sqlalchemy_utils import count, get, get_many
 from main.utils import Error
 
+# argument of "update" which profiles the update (see `profiling`)
+PROFILE = 'profile'
+
 
 # exceptions
 class DBInitError(Error):
@@ -46,20 +53,39 @@ class CmdTool(cmd.Cmd):
         return True
 
     def do_update(self, args):
-        """Aktualisiert und downloadet alle Bestellungen, die ab dem Datum "update_after" (in
-        main/resources/internal_paras.json) geändert wurden. """
+        """Aktualisiert und downloadet alle Produkte und Bestellungen, die seit dem letzten Update geändert wurden (
+        s. "sync_cursors" in main/resources/internal_paras.json).
+        "update record" speichert die heruntergeladenen Seiten zusätzlich im Seiten-Cache (main/resources/page_cache).
+        "update replay" importiert die Seiten aus dem Seiten-Cache, ohne Shopify zu kontaktieren.
+        "update profile" misst die Dauer, die SQL-Anweisungen, die geschriebenen Zeilen, die geladenen Seiten und die
+        Cache-Treffer jeder Phase bis zur manuellen Zuweisung und speichert sie in main/resources/profiles. """
+        page_cache_mode = None
+        profile = False
+        for arg in args.split():
+            if arg == PROFILE:
+                profile = True
+            elif arg in (RECORD, REPLAY):
+                page_cache_mode = arg
+            else:
+                print(f'Unbekanntes Argument "{arg}".')
+                return
         self.init_db()
+        if profile:
+            profiling.start('update')
         try:
-            self.update_orders()
-            self.import_transactions()
+            self.update_orders(page_cache_mode)
+            with profiling.phase('Kontoauszüge'):
+                self.import_transactions()
 
-            suspicious: List[Transaction] = transactions_importer.associate_transactions()
+            with profiling.phase('Zuweisung'):
+                suspicious, proposals = transactions_importer.associate_transactions()
+            if profile:
+                self.report_profile(profiling.stop())
             print()
             try:
-                self.user_associate_transactions(suspicious)
+                self.user_associate_transactions(suspicious, proposals)
             except UserExit:
                 pass
-            conf.update_update_after()
         except (sqlite3.Error, utils.Error) as e:
             sqlite_msg = ''
             if isinstance(e, sqlite3.Error):
@@ -71,6 +97,72 @@ class CmdTool(cmd.Cmd):
             logging.error(f'msg {error_arg}. Traceback:\n'
                           f'{traceback.print_exc()}')
             print(msg)
+        finally:
+            profiling.stop()
+
+    def do_bulk_import(self, args):
+        """Importiert Produkte und Bestellungen aus dem JSONL-Export einer Shopify-Bulk-Operation, z. B.
+        "bulk_import export.jsonl". Die Sync-Cursor von "update" bleiben unverändert."""
+        path = args.strip()
+        if not os.path.isfile(path):
+            print(f'Die Datei "{path}" existiert nicht.')
+            return
+        self.init_db()
+        before = count(Order)
+        try:
+            bulk_importer.import_file(path)
+        except (sqlite3.Error, utils.Error) as e:
+            logging.error(f'Bulk-Import von "{path}" fehlgeschlagen. Traceback:\n{traceback.format_exc()}')
+            print(f'Ein Fehler wurde entdeckt: {utils.get_error_arg(e)}.\n'
+                  f'ACHTUNG: Die bis dahin importierten Seiten bleiben erhalten. Behebe den Fehler und versuche es '
+                  f'erneut.')
+            return
+        self.number_imported_msg(Order, before)
+
+    def do_watch(self, args):
+        """Überwacht den Ordner der Kontoauszüge (main/resources/transactions) und importiert neue Transaktionen,
+        sobald eine Datei hinzugefügt oder verlängert wird. Sie werden automatisch zugewiesen, übrige Transaktionen können
+        später mit "associate" oder "update" zugewiesen werden. "watch 10" prüft den Ordner alle 10 Sekunden
+        (Standard: "watch_interval" in den Einstellungen). Beende mit Strg+C."""
+        try:
+            interval = float(args) if args.strip() else settings.get('watch_interval', 5.0)
+        except ValueError:
+            print(f'"{args}" ist keine Anzahl an Sekunden.')
+            return
+        self.init_db()
+        print(f'Überwache "{paths["transactions"]}" alle {interval:g} Sekunden. Beende mit Strg+C.')
+        try:
+            while True:
+                try:
+                    if transactions_importer.import_transactions(quiet=True):
+                        suspicious, _ = transactions_importer.associate_transactions()
+                        print(f'{len(suspicious)} Transaktionen konnten nicht automatisch zugewiesen werden.')
+                except FileNotFoundError:
+                    # the folder is empty for now
+                    pass
+                except (sqlite3.Error, utils.Error) as e:
+                    logging.error(f'Import der Transaktionen fehlgeschlagen. Traceback:\n{traceback.format_exc()}')
+                    print(f'Ein Fehler wurde entdeckt: {utils.get_error_arg(e)}. Die Datei wird beim nächsten '
+                          f'Durchlauf erneut importiert.')
+                time.sleep(interval)
+        except KeyboardInterrupt:
+            print('\nÜberwachung beendet.')
+
+    def do_balances(self, args):
+        """Prüft die gespeicherten Salden der Bestellungen und Transaktionen gegen die Positionen und Zuweisungen.
+        "balances rebuild" berechnet alle Salden neu."""
+        if args.strip() not in ('', 'rebuild'):
+            print(f'Unbekanntes Argument "{args.strip()}".')
+            return
+        self.init_db()
+        if args.strip() == 'rebuild':
+            balances.rebuild()
+            sess.commit()
+            print('Die Salden wurden neu berechnet.')
+        differences = balances.verify()
+        for difference in differences:
+            print(f'ACHTUNG: {difference}')
+        print(f'{len(differences)} abweichende Salden gefunden.')
 
     def do_associate(self, args):
         """Weise Transaktionen eine oder mehrere Bestellungen zu."""
@@ -83,12 +175,16 @@ class CmdTool(cmd.Cmd):
         except UserExit:
             return
 
+    def report_profile(self, profile: profiling.Profile):
+        print(f'\nProfil von "{profile.command}":\n{profile.summary()}')
+        print(f'Das Profil wurde in "{profile.write_report(paths["profiles"])}" gespeichert.')
+
     def number_imported_msg(self, model, before):
         print(f'Es wurden {count(model) - before} {model.class_name}en importiert.')
 
-    def update_orders(self):
+    def update_orders(self, page_cache_mode=None):
         before = count(Order)
-        shopify_importer.import_all()
+        shopify_importer.import_all(page_cache_mode)
         self.number_imported_msg(Order, before)
 
     def import_transactions(self):
@@ -100,7 +196,8 @@ class CmdTool(cmd.Cmd):
         self.number_imported_msg(Transaction, count_)
 
 
-    def user_associate_transactions(self, unassociated_transactions):
+    def user_associate_transactions(self, unassociated_transactions: List[Transaction],
+                                    proposals: Dict[int, AmountMatch] = None):
         before = count(OrderTransaction)
         print(
             f'{len(unassociated_transactions)} Transaktionen konnten keiner Bestellung zugeordnet werden. Bitte ordne '
@@ -109,17 +206,26 @@ class CmdTool(cmd.Cmd):
             f'1001".\n '
             f'Um eine Transaktion zu überspringen, gib "w" ein. Um in Zukunft nicht mehr nach einer Transaktion '
             f'gefragt zu werden, gib "i" ein. '
-            f'Um den Vorgang vorzeitig abzuschließen, gib "s" ein.')
+            f'Um den Vorgang vorzeitig abzuschließen, gib "s" ein. Wurden Bestellungen anhand des Betrags gefunden, '
+            f'weist "v" sie zu.')
+        proposals = proposals or {}
         for transaction in unassociated_transactions:
-            self.handle_transaction(transaction)
+            self.handle_transaction(transaction, proposals.get(transaction.id))
         self.number_imported_msg(OrderTransaction, before)
 
-    def handle_transaction(self, transaction: Transaction):
+    def handle_transaction(self, transaction: Transaction, proposal: AmountMatch = None):
         print(transaction.description)
+        payer_orders = transactions_importer.get_payer_open_orders(transaction)
+        if payer_orders:
+            print(f'Offene Bestellungen von Kunden, für die bereits von diesem Konto bezahlt wurde: '
+                  f'{utils.iterable_to_str(payer_orders)}.')
+        if proposal is not None:
+            print(f'Vorschlag anhand des Betrags: {proposal}. Gib "v" ein, um ihn zu übernehmen.')
         try:
             print(f'Bitte gib die Bestellungen an, die du der Transaktion zuweisen möchtest.')
             while True:
-                orders = self.user_get_orders()
+                orders = self.user_get_orders(proposal)
+                proposal = None
                 transactions_importer.associate_transaction(transaction, orders, True)
                 if transaction.associated_completely:
                     return
@@ -136,7 +242,7 @@ class CmdTool(cmd.Cmd):
         except UserNextTransaction:
             return
 
-    def user_get_orders(self) -> List[Order]:
+    def user_get_orders(self, proposal: AmountMatch = None) -> List[Order]:
         while True:
             answer = input('--> ABI')
             try:
@@ -146,6 +252,9 @@ class CmdTool(cmd.Cmd):
                     raise UserNextTransaction
                 if answer == 'i':
                     raise IgnoreTransaction
+                if answer == 'v' and proposal is not None:
+                    orders = get_many(Order, 'nr', [order.nr for order in proposal.orders])
+                    return [orders[order.nr] for order in proposal.orders]
                 nrs = utils.strip_me(answer.split())
                 return shopify_importer.get_orders(nrs)
             except OrderNrNotFound as e:
@@ -173,13 +282,18 @@ class CmdTool(cmd.Cmd):
             raise UserExit
         
     def init_db(self):
-        if not os.path.exists(paths['sqlite']):
-            try:
-                print(f'Erstelle sqlite-Datenbank in Datei "{paths["sqlite"]}".')
-                update_schemas()
-            except Exception as e:
-                print(f'Erstellen der Datenbank fehlgeschlagen. Fehlermeldung: {utils.get_error_arg(e)}.')
-                raise DBInitError()
+        exists = os.path.exists(paths['sqlite'])
+        if not exists:
+            print(f'Erstelle sqlite-Datenbank in Datei "{paths["sqlite"]}".')
+        try:
+            migrations = update_schemas()
+        except Exception as e:
+            print(f'{"Aktualisieren" if exists else "Erstellen"} der Datenbank fehlgeschlagen. Fehlermeldung: '
+                  f'{utils.get_error_arg(e)}.')
+            raise DBInitError()
+        if exists:
+            for description in migrations:
+                print(f'Datenbank aktualisiert: {description}.')
 
 
 tool = CmdTool()
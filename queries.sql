@@ -30,45 +30,30 @@ SELECT schools.name
        variants.color                                                                AS "Farbe",
        variants.size                                                                 AS "Größe",
        orders.nr                                                                     AS "Bestellnummer",
-       ((SELECT TOTAL(line_items.amount * line_items.quantity) AS total_1
-         FROM line_items
-         WHERE line_items.order_id = orders.id) - orders.discount) + orders.shipping AS "Betrag",
-       (((SELECT TOTAL(line_items.amount * line_items.quantity) AS total_2
-          FROM line_items
-          WHERE line_items.order_id = orders.id) - orders.discount) + orders.shipping) -
-       ((SELECT TOTAL(order_transactions.amount) AS total_3
-         FROM order_transactions
-         WHERE order_transactions.order_id = orders.id) + orders.decree)             AS "fällig",
+       orders.stored_amount                                                          AS "Betrag",
+       orders.stored_unpaid_amount                                                   AS "fällig",
        customers.first_name                                                          AS "Vorname",
        customers.last_name                                                           AS "Nachname",
        customers.email AS Email
-FROM schools
-         JOIN products ON schools.id = products.school_id
-         JOIN variants ON products.id = variants.product_id
-         JOIN line_items ON variants.id = line_items.variant_id
-         JOIN orders ON orders.id = line_items.order_id
-         JOIN customers ON customers.id = orders.customer_id
-WHERE ((SELECT TOTAL(order_transactions.amount) AS total_4
-        FROM order_transactions
-        WHERE order_transactions.order_id = orders.id) + orders.decree >=
-       ((SELECT TOTAL(line_items.amount * line_items.quantity) AS total_5
-         FROM line_items
-         WHERE line_items.order_id = orders.id) - orders.discount) + orders.shipping) = 0;
+-- SQLite keeps the order of CROSS JOINs, so only the unpaid orders are read (by the index of stored_unpaid_amount)
+FROM orders
+         CROSS JOIN customers ON customers.id = orders.customer_id
+         CROSS JOIN line_items ON orders.id = line_items.order_id
+         CROSS JOIN variants ON variants.id = line_items.variant_id
+         CROSS JOIN products ON products.id = variants.product_id
+         CROSS JOIN schools ON schools.id = products.school_id
+WHERE orders.stored_unpaid_amount > 0;
 
 -- Emails von Kunden, die noch nicht vollst. bezahlt haben
 SELECT DISTINCT customers.email AS Email
-FROM schools
-         JOIN products ON schools.id = products.school_id
-         JOIN variants ON products.id = variants.product_id
-         JOIN line_items ON variants.id = line_items.variant_id
-         JOIN orders ON orders.id = line_items.order_id
-         JOIN customers ON customers.id = orders.customer_id
-WHERE ((SELECT TOTAL(order_transactions.amount) AS total_4
-        FROM order_transactions
-        WHERE order_transactions.order_id = orders.id) + orders.decree >=
-       ((SELECT TOTAL(line_items.amount * line_items.quantity) AS total_5
-         FROM line_items
-         WHERE line_items.order_id = orders.id) - orders.discount) + orders.shipping) = 0;
+-- SQLite keeps the order of CROSS JOINs, so only the unpaid orders are read (by the index of stored_unpaid_amount)
+FROM orders
+         CROSS JOIN customers ON customers.id = orders.customer_id
+         CROSS JOIN line_items ON orders.id = line_items.order_id
+         CROSS JOIN variants ON variants.id = line_items.variant_id
+         CROSS JOIN products ON products.id = variants.product_id
+         CROSS JOIN schools ON schools.id = products.school_id
+WHERE orders.stored_unpaid_amount > 0;
 
 
 -- alle Bestellungen
@@ -78,9 +63,7 @@ SELECT schools.name
        variants.size                                                                 AS "Größe",
               orders.note AS Name,
        orders.nr                                                                     AS "Bestellnummer",
-       ((SELECT TOTAL(line_items.amount * line_items.quantity) AS total_1
-         FROM line_items
-         WHERE line_items.order_id = orders.id) - orders.discount) + orders.shipping AS "Betrag"
+       orders.stored_amount                                                          AS "Betrag"
 FROM schools
          JOIN products ON schools.id = products.school_id
          JOIN variants ON products.id = variants.product_id